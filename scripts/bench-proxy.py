@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+serve-ui 代理请求预处理 CPU 开销 micro-benchmark（不发网络请求）
+
+对一个 chat completion 请求，serve-ui 在转发前要完成：按 model 路由、Ollama
+model id 改写、日志摘要、KV 预算估算与 stream 判断。本脚本直接 import
+serve-ui.py，对不同大小的请求体重复执行这一段，报告每请求 CPU 时间。
+
+用法:
+  ./scripts/bench-proxy.py
+  ./scripts/bench-proxy.py --sizes 10k,1m,4m --rounds 20
+  ./scripts/bench-proxy.py --serve-ui /tmp/serve-ui-old.py   # 对比旧版本
+  ./scripts/bench-proxy.py --json
+
+旧版本可用 git show <rev>:serve-ui.py > /tmp/serve-ui-old.py 导出；
+没有 RequestContext 的版本按逐函数解析 body 的旧调用方式测量。
+"""
+from __future__ import annotations
+
+import argparse
+import importlib.util
+import json
+import math
+import os
+import statistics
+import sys
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+
+ROUTES = {
+    "llama": {"pid": None, "port": 18001, "model": "bench-llama"},
+    "ollama": {
+        "pid": None, "port": 11434, "model": "bench-ollama",
+        "ollama": True, "ollama_model": "qwen3:32b",
+    },
+}
+
+
+def load_serve_ui(path):
+    spec = importlib.util.spec_from_file_location("serve_ui_bench", path)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    # 固定路由表：不扫描 run/、不探测 Ollama
+    mod.route_registry._table = mod._RouteTable(dict(ROUTES), {})
+    mod.route_registry.interval = math.inf
+    return mod
+
+
+def parse_size(text):
+    text = text.strip().lower()
+    unit = {"k": 1 << 10, "m": 1 << 20}.get(text[-1:], 1)
+    return int(float(text.rstrip("km")) * unit)
+
+
+def make_body(size, model):
+    """约 size 字节的多轮对话请求体（中英混排，含重复的 system prompt）。"""
+    turn = "请总结以下内容并给出要点。The quick brown fox jumps over the lazy dog. " * 8
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    approx = 0
+    i = 0
+    while approx < size:
+        role = "user" if i % 2 == 0 else "assistant"
+        messages.append({"role": role, "content": turn})
+        approx += len(turn.encode("utf-8")) + 32
+        i += 1
+    data = {"model": model, "messages": messages, "stream": True, "max_tokens": 1024, "temperature": 0.7}
+    return json.dumps(data, ensure_ascii=False).encode("utf-8")
+
+
+def prepare(mod, body):
+    """serve-ui 转发前对请求体做的全部处理。"""
+    if hasattr(mod, "RequestContext"):
+        ctx = mod.RequestContext(body)
+        model_name, _ = mod._resolve_model_from_body(ctx)
+        mod._prepare_inference_body(ctx, model_name)
+        ctx.summary("infer")
+        mod.estimate_kv_tokens(ctx, model_name)
+        return ctx.stream
+    model_name, _ = mod._resolve_model_from_body(body)
+    body = mod._prepare_inference_body(body, model_name)
+    mod._parse_body_summary(body, "infer")
+    mod.estimate_kv_tokens(body, model_name)
+    return json.loads(body).get("stream", False)
+
+
+def bench(mod, body, rounds):
+    samples = []
+    for _ in range(rounds):
+        t0 = time.process_time()
+        prepare(mod, body)
+        samples.append((time.process_time() - t0) * 1000)
+    return {
+        "median_ms": round(statistics.median(samples), 3),
+        "min_ms": round(min(samples), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="serve-ui 请求预处理 CPU benchmark")
+    parser.add_argument("--serve-ui", default=os.path.join(PROJECT_ROOT, "serve-ui.py"),
+                        help="要测量的 serve-ui.py 路径（默认项目内版本）")
+    parser.add_argument("--sizes", default="10k,256k,1m,4m", help="请求体大小列表，如 10k,1m")
+    parser.add_argument("--rounds", type=int, default=15, help="每组重复次数")
+    parser.add_argument("--json", action="store_true", help="输出 JSON")
+    args = parser.parse_args()
+
+    mod = load_serve_ui(args.serve_ui)
+    results = []
+    for size_text in args.sizes.split(","):
+        size = parse_size(size_text)
+        for route in ROUTES.values():
+            body = make_body(size, route["model"])
+            r = bench(mod, body, args.rounds)
+            r.update({"size": size_text, "bytes": len(body), "backend": "ollama" if route.get("ollama") else "llama"})
+            results.append(r)
+
+    if args.json:
+        json.dump({"serve_ui": args.serve_ui, "results": results}, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+        return
+    print(f"serve-ui: {args.serve_ui}")
+    print(f"{'size':>6}  {'bytes':>9}  {'backend':<7}  {'median ms':>10}  {'min ms':>8}")
+    for r in results:
+        print(f"{r['size']:>6}  {r['bytes']:>9}  {r['backend']:<7}  {r['median_ms']:>10.3f}  {r['min_ms']:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
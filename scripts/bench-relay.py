@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+serve-ui 响应转发（relay）CPU 开销 benchmark
+
+在本机起一个假后端（定长 JSON 与 chunked SSE 两种响应）和一个 serve-ui 代理子进程，
+经 /api/bench/* 拉取若干 MB 响应，用代理子进程的 getrusage 计算每转发 1 MB 的 CPU 时间。
+后端与客户端在父进程中运行，不计入结果。
+
+用法:
+  ./scripts/bench-relay.py
+  ./scripts/bench-relay.py --mb 64 --rounds 5 --engine asyncio
+  ./scripts/bench-relay.py --serve-ui /tmp/serve-ui-old.py   # 对比旧版本
+  ./scripts/bench-relay.py --json
+
+旧版本可用 git show <rev>:serve-ui.py > /tmp/serve-ui-old.py 导出。
+"""
+from __future__ import annotations
+
+import argparse
+import http.client
+import importlib.util
+import json
+import math
+import multiprocessing
+import os
+import resource
+import socket
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+
+JSON_BLOCK = (json.dumps({"index": 0, "embedding": [0.0123456789] * 64}) + ",").encode()
+SSE_EVENT = b'data: {"choices":[{"delta":{"content":"' + "字".encode() * 8 + b'"}}]}\n\n'
+
+
+class FakeBackend(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        size = int(query.split("=", 1)[1]) if "=" in query else 1 << 20
+        if path == "/json":
+            body = (JSON_BLOCK * (size // len(JSON_BLOCK) + 1))[:size]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        # SSE：每个 HTTP chunk 一个事件，与 llama-server 流式输出的形态一致
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        frame = b"%x\r\n%s\r\n" % (len(SSE_EVENT), SSE_EVENT)
+        batch = frame * 64
+        sent = 0
+        while sent < size:
+            self.wfile.write(batch)
+            sent += len(SSE_EVENT) * 64
+        self.wfile.write(b"0\r\n\r\n")
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def proxy_child(path, engine, backend_port, port, conn):
+    """子进程：加载 serve-ui 并在 port 上提供代理，按父进程指令回报 CPU 时间。"""
+    spec = importlib.util.spec_from_file_location("serve_ui_bench", path)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    mod.route_registry._table = mod._RouteTable(
+        {"bench": {"pid": None, "port": backend_port, "model": "bench"}}, {})
+    mod.route_registry.interval = math.inf
+    if engine == "asyncio":
+        target = lambda: mod.serve_asyncio(port)  # noqa: E731
+    else:
+        server = ThreadingHTTPServer(("127.0.0.1", port), mod.ProxyHandler)
+        target = server.serve_forever
+    threading.Thread(target=target, daemon=True).start()
+    conn.send("ready")
+    while conn.recv() == "cpu":
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        conn.send(usage.ru_utime + usage.ru_stime)
+
+
+def fetch(port, path):
+    c = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+    c.request("GET", path)
+    resp = c.getresponse()
+    total = 0
+    while True:
+        data = resp.read(1 << 20)
+        if not data:
+            break
+        total += len(data)
+    c.close()
+    return total, resp.getheader("Content-Length") is not None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="serve-ui 响应转发 CPU benchmark")
+    parser.add_argument("--serve-ui", default=os.path.join(PROJECT_ROOT, "serve-ui.py"),
+                        help="要测量的 serve-ui.py 路径（默认项目内版本）")
+    parser.add_argument("--engine", choices=("threading", "asyncio"), default="threading")
+    parser.add_argument("--mb", type=int, default=32, help="每次转发的响应大小（MB）")
+    parser.add_argument("--rounds", type=int, default=5, help="每组重复次数")
+    parser.add_argument("--json", action="store_true", help="输出 JSON")
+    args = parser.parse_args()
+
+    backend = ThreadingHTTPServer(("127.0.0.1", 0), FakeBackend)
+    threading.Thread(target=backend.serve_forever, daemon=True).start()
+    port = free_port()
+    parent, child = multiprocessing.Pipe()
+    proc = multiprocessing.Process(
+        target=proxy_child, args=(args.serve_ui, args.engine, backend.server_address[1], port, child),
+        daemon=True,
+    )
+    proc.start()
+    parent.recv()
+    time.sleep(0.3)
+
+    size = args.mb << 20
+    results = []
+    for kind in ("json", "sse"):
+        samples = []
+        fixed = False
+        for _ in range(args.rounds):
+            parent.send("cpu")
+            before = parent.recv()
+            t0 = time.perf_counter()
+            total, fixed = fetch(port, f"/api/bench/{kind}?size={size}")
+            wall = time.perf_counter() - t0
+            parent.send("cpu")
+            cpu = parent.recv() - before
+            samples.append((cpu * 1000 / (total / (1 << 20)), total / (1 << 20) / wall))
+        results.append({
+            "kind": kind,
+            "mb": args.mb,
+            "cpu_ms_per_mb": round(statistics.median(s[0] for s in samples), 3),
+            "mb_per_s": round(statistics.median(s[1] for s in samples), 1),
+            "content_length": fixed,
+        })
+    parent.send("quit")
+    proc.join(timeout=2)
+
+    if args.json:
+        json.dump({"serve_ui": args.serve_ui, "engine": args.engine, "results": results},
+                  sys.stdout, ensure_ascii=False, indent=2)
+        print()
+        return
+    print(f"serve-ui: {args.serve_ui}  engine: {args.engine}")
+    print(f"{'kind':<5}  {'MB':>4}  {'CPU ms/MB':>10}  {'MB/s':>8}  Content-Length")
+    for r in results:
+        print(f"{r['kind']:<5}  {r['mb']:>4}  {r['cpu_ms_per_mb']:>10.3f}  {r['mb_per_s']:>8.1f}  "
+              f"{'yes' if r['content_length'] else 'no'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -20,30 +20,78 @@ Local LLM Deploy — 前端静态服务 + 多模型 API 代理 + 推理请求队
   每模型按 KV token 预算控制并发（短请求可多路并行，长请求自动串行）。
   全局跨模型并发上限防止统一内存带宽被打满。
   排队期间对流式请求发送 SSE keepalive 保持连接。
+
+后端连接池:
+  每个后端（按 _backend_base_url）维护 HTTP/1.1 keep-alive 空闲连接，复用时先做存活检查，
+  后端从运行列表消失时回收；命中/未命中计数见 /api/models 的 pools 字段。
+
+路由表:
+  后台线程按 ROUTE_REFRESH_SEC 检查 run/*.pid（目录/文件 mtime 变化才重读）、进程存活与外部/Ollama 探测结果，
+  请求路径只读内存中的 alias / ollama_model / 运行名索引。
+
+服务模式（--engine 或 SERVE_UI_ENGINE）:
+  threading  每个客户端连接一个线程（默认）
+  asyncio    单事件循环，客户端 HTTP/1.1 keep-alive，SSE 中继与排队保活不再占用额外线程
 """
+import argparse
+import asyncio
+import atexit
+import bisect
+import codecs
+import collections
+import email.utils
 import errno
+import functools
+import gzip
+import hashlib
+import heapq
+import html
+import http.client
+import io
+import itertools
 import json
+import mimetypes
 import os
 import queue
+import random
 import re
+import select
+import signal
 import socket
 import subprocess
 import sys
+import tempfile
 import threading
 import time
 import urllib.parse
 import urllib.request
-import urllib.error
 from http import HTTPStatus
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+from http.server import (
+    DEFAULT_ERROR_CONTENT_TYPE,
+    DEFAULT_ERROR_MESSAGE,
+    HTTPServer,
+    SimpleHTTPRequestHandler,
+)
 from socketserver import ThreadingMixIn
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 STATIC_DIR = os.path.join(SCRIPT_DIR, "static")
 API_KEY_FILE = os.path.join(SCRIPT_DIR, ".api-key")
+API_KEY_LANES_FILE = os.path.join(SCRIPT_DIR, ".api-key-lanes")
 RUN_DIR = os.path.join(SCRIPT_DIR, "run")
+LOGS_DIR = os.path.join(SCRIPT_DIR, "logs")
 API_PROXY_TIMEOUT = int(os.environ.get("API_PROXY_TIMEOUT", "3600"))
 MONITOR_PROXY_TIMEOUT = int(os.environ.get("MONITOR_PROXY_TIMEOUT", "8"))
+# 转发后端响应：流式每次最多读 RELAY_CHUNK_SIZE（read1，有多少转多少）；
+# 定长响应用 RELAY_BUFFER_SIZE 的预分配缓冲区 readinto，原样保留 Content-Length
+RELAY_CHUNK_SIZE = 64 * 1024
+RELAY_BUFFER_SIZE = 256 * 1024
+# 不小于该大小的非推理请求体（ASR 音频、大批量 embeddings 等）边读边转发，0 关闭
+STREAM_UPLOAD_MIN = int(os.environ.get("SERVE_UI_STREAM_UPLOAD_KB", "1024")) * 1024
+# 流式上传时按 model 字段路由最多查看的请求体前缀
+ROUTE_PREFIX_BYTES = 64 * 1024
+# asyncio 模式下 chunked 请求体（无 Content-Length，无法边读边转发）的大小上限，超出返回 413
+MAX_CHUNKED_BODY = int(os.environ.get("SERVE_UI_MAX_CHUNKED_BODY_MB", "64")) * 1024 * 1024
 
 INFERENCE_PATHS = frozenset({
     "v1/chat/completions", "v1/completions",
@@ -56,21 +104,78 @@ ASR_PATHS = frozenset({
     "v1/audio/transcriptions", "audio/transcriptions",
 })
 MAX_QUEUE_DEPTH = int(os.environ.get("MAX_QUEUE_DEPTH", "5"))
+QUEUE_POLICY = os.environ.get("QUEUE_POLICY", "fifo").strip().lower()
+LANE_RESERVED_SLOTS = os.environ.get("LANE_RESERVED_SLOTS", "")
+LANE_RESERVED_KV_RATIO = os.environ.get("LANE_RESERVED_KV_RATIO", "")
+GLOBAL_LANE_RESERVED_SLOTS = os.environ.get("GLOBAL_LANE_RESERVED_SLOTS", "")
 QUEUE_KEEPALIVE_SEC = int(os.environ.get("QUEUE_KEEPALIVE_SEC", "5"))
 MAX_GLOBAL_CONCURRENT = int(os.environ.get("MAX_GLOBAL_CONCURRENT", "3"))
 KV_CHARS_PER_TOKEN = float(os.environ.get("KV_CHARS_PER_TOKEN", "2.5"))
+KV_EXACT_TOKENS = os.environ.get("KV_EXACT_TOKENS", "").strip().lower()
+KV_TEMPLATE_TOKENS_PER_MSG = int(os.environ.get("KV_TEMPLATE_TOKENS_PER_MSG", "4"))
+TOKENIZE_TIMEOUT = float(os.environ.get("TOKENIZE_TIMEOUT", "0.5"))
+TOKENIZE_CACHE_SIZE = int(os.environ.get("TOKENIZE_CACHE_SIZE", "4096"))
+TOKENIZE_MAX_INFLIGHT = int(os.environ.get("TOKENIZE_MAX_INFLIGHT", "2"))
+TOKENIZE_BACKOFF_SEC = 30
+TOKENIZE_UNSUPPORTED_BACKOFF = 300
+KV_CALIBRATION_FILE = os.environ.get(
+    "KV_CALIBRATION_FILE", os.path.join(LOGS_DIR, "kv-calibration.json")
+).strip() or None
+KV_CALIBRATION_ALPHA = float(os.environ.get("KV_CALIBRATION_ALPHA", "0.2"))
+KV_CALIBRATION_MIN_SAMPLES = 3
+KV_CALIBRATION_MIN_CHARS = 200
+KV_CALIBRATION_SAVE_SEC = 30
+KV_INCREMENTAL = os.environ.get("KV_INCREMENTAL", "").strip().lower() in ("1", "true", "yes")
+KV_GEN_ALLOWANCE = int(os.environ.get("KV_GEN_ALLOWANCE", "1024"))
+KV_GROW_STEP = int(os.environ.get("KV_GROW_STEP", "1024"))
 MODELS_JSON = os.path.join(SCRIPT_DIR, "models.json")
 EXTERNAL_BACKEND_PROBE_TTL = float(os.environ.get("EXTERNAL_BACKEND_PROBE_TTL", "2"))
 ACCESS_LOG_FILE = os.environ.get("SERVE_UI_ACCESS_LOG", "").strip() or None
 LOG_BODY = os.environ.get("SERVE_UI_LOG_BODY", "").strip().lower() in ("1", "true", "yes")
+ACCESS_LOG_QUEUE = int(os.environ.get("SERVE_UI_ACCESS_LOG_QUEUE", "10000"))
+ACCESS_LOG_POLICY = os.environ.get("SERVE_UI_ACCESS_LOG_POLICY", "drop").strip().lower()
+ACCESS_LOG_MAX_MB = float(os.environ.get("SERVE_UI_ACCESS_LOG_MAX_MB", "0"))
+ACCESS_LOG_ROTATE_SEC = float(os.environ.get("SERVE_UI_ACCESS_LOG_ROTATE_SEC", "0"))
+ACCESS_LOG_KEEP = int(os.environ.get("SERVE_UI_ACCESS_LOG_KEEP", "0"))
+ACCESS_LOG_BATCH = 256
+LOG_RESPONSE = os.environ.get("SERVE_UI_LOG_RESPONSE", "").strip().lower() in ("1", "true", "yes")
+LOG_SPILL_KB = int(os.environ.get("SERVE_UI_LOG_SPILL_KB", "1024"))
+LOG_CONTENT_CHARS = 1000
+LOG_JSON_PARSE_LIMIT = 1 << 20
+LOG_SSE_LINE_LIMIT = 1 << 20
+TRACE_FILE = os.environ.get("SERVE_UI_TRACE_FILE", "").strip() or None
+TRACE_SAMPLE = float(os.environ.get("SERVE_UI_TRACE_SAMPLE", "1"))
+COMPLETION_CACHE = os.environ.get("COMPLETION_CACHE", "").strip().lower() in ("1", "true", "yes")
+COMPLETION_CACHE_MAX_MB = float(os.environ.get("COMPLETION_CACHE_MAX_MB", "256"))
+COMPLETION_CACHE_TTL = float(os.environ.get("COMPLETION_CACHE_TTL", "3600"))
+COMPLETION_CACHE_DIR = os.environ.get("COMPLETION_CACHE_DIR", "").strip() or None
+COMPLETION_CACHE_DISK_MAX_MB = float(os.environ.get("COMPLETION_CACHE_DISK_MAX_MB", "2048"))
+COMPLETION_CACHE_DISK_TTL = float(os.environ.get("COMPLETION_CACHE_DISK_TTL", "86400"))
+COMPLETION_CACHE_MAX_ENTRY = 8 << 20
+EMBED_BATCH_WAIT_MS = float(os.environ.get("EMBED_BATCH_WAIT_MS", "0"))
+EMBED_BATCH_MAX = int(os.environ.get("EMBED_BATCH_MAX", "32"))
 OLLAMA_HOST = os.environ.get("OLLAMA_HOST", "http://localhost:11434").rstrip("/")
 OLLAMA_AUTO_DISCOVER = os.environ.get("OLLAMA_AUTO_DISCOVER", "1").strip().lower() not in (
     "0", "false", "no",
 )
 SYSTEM_CACHE_TTL = 3
+SYSTEM_SAMPLE_SEC = float(os.environ.get("SERVE_UI_SAMPLE_SEC", "5"))
+SYSTEM_SAMPLE_HISTORY = int(os.environ.get("SERVE_UI_SAMPLE_HISTORY", "720"))
+MONITOR_STREAM_SEC = float(os.environ.get("SERVE_UI_STREAM_SEC", "5"))
+MONITOR_STREAM_BACKLOG = 64  # 每个 /api/stream 订阅者最多积压的事件批次，超出丢弃最旧的
 OLLAMA_CACHE_TTL = 5
-
-_access_log_lock = threading.Lock()
+ROUTE_REFRESH_SEC = float(os.environ.get("ROUTE_REFRESH_SEC", "1"))
+BACKEND_POLL_SEC = float(os.environ.get("BACKEND_POLL_SEC", "2"))
+REPLICA_ROUTING = os.environ.get("REPLICA_ROUTING", "least").strip().lower()
+ROUTE_AFFINITY_TURNS = int(os.environ.get("ROUTE_AFFINITY_TURNS", "2"))
+ROUTE_AFFINITY_ENTRIES = int(os.environ.get("ROUTE_AFFINITY_ENTRIES", "8192"))
+BACKEND_POLL_TIMEOUT = 1.0
+BACKEND_POLL_UNSUPPORTED_BACKOFF = 300
+BACKEND_POOL_MAX_IDLE = int(os.environ.get("BACKEND_POOL_MAX_IDLE", "8"))
+BACKEND_POOL_IDLE_TTL = float(os.environ.get("BACKEND_POOL_IDLE_TTL", "60"))
+SERVE_UI_ENGINE = os.environ.get("SERVE_UI_ENGINE", "threading").strip().lower() or "threading"
+CLIENT_IDLE_TIMEOUT = float(os.environ.get("CLIENT_IDLE_TIMEOUT", "75"))
+MAX_HEADER_BYTES = 64 * 1024
 
 
 def _log(msg):
@@ -78,30 +183,65 @@ def _log(msg):
     sys.stderr.flush()
 
 
+def _multipart_boundary(content_type):
+    """multipart Content-Type 中的 boundary（bytes），没有则返回 None。"""
+    for param in content_type.split(";")[1:]:
+        key, _, value = param.strip().partition("=")
+        if key.lower() == "boundary" and value:
+            return value.strip('"').encode("latin-1", errors="replace")
+    return None
+
+
+_DISPOSITION_PARAM_RE = re.compile(r';\s*([\w*-]+)\s*=\s*(?:"((?:[^"\\]|\\.)*)"|([^;\s]*))')
+
+
+def _part_disposition(header_block):
+    """multipart 部分头中 Content-Disposition 的 (name, filename)，缺省为 None。"""
+    for line in header_block.split(b"\r\n"):
+        key, _, value = line.partition(b":")
+        if key.strip().lower() != b"content-disposition":
+            continue
+        params = {}
+        for m in _DISPOSITION_PARAM_RE.finditer(value.decode("utf-8", errors="replace")):
+            params[m.group(1).lower()] = m.group(2) if m.group(2) is not None else m.group(3)
+        return params.get("name"), params.get("filename")
+    return None, None
+
+
+def _iter_multipart_fields(body, content_type):
+    """按 boundary 逐个扫描 multipart/form-data，产出文本字段 (name, value)。
+
+    只复制文本字段的值；文件部分（带 filename）用 bytes.find 跳过，不复制也不解码。
+    body 可以只是请求体前缀：扫描在最后一个完整的部分处结束。调用方找到所需字段
+    后即可停止迭代，位于文件之前的字段不会触及音频数据。
+    """
+    boundary = _multipart_boundary(content_type)
+    if not body or not boundary or not content_type.lower().startswith("multipart/form-data"):
+        return
+    delimiter = b"\r\n--" + boundary
+    # 第一个分隔行前没有 CRLF
+    pos = body.find(delimiter[2:])
+    if pos < 0:
+        return
+    pos += len(delimiter) - 2
+    while body[pos:pos + 2] != b"--":
+        head_end = body.find(b"\r\n\r\n", pos)
+        if head_end < 0:
+            return
+        end = body.find(delimiter, head_end + 4)
+        if end < 0:
+            return
+        name, filename = _part_disposition(body[pos:head_end])
+        if name is not None and filename is None:
+            yield name, body[head_end + 4:end].decode("utf-8", errors="replace")
+        pos = end + len(delimiter)
+
+
 def _extract_multipart_field(body, content_type, field_name):
-    """从 multipart/form-data 中提取指定文本字段，失败返回 None。"""
-    if not body or not content_type.lower().startswith("multipart/form-data"):
-        return None
-    try:
-        from email import message_from_bytes
-        from email.policy import HTTP
-
-        header_block = (
-            f"Content-Type: {content_type}\r\nMIME-Version: 1.0\r\n\r\n"
-        ).encode()
-        msg = message_from_bytes(header_block + body, policy=HTTP)
-        if not msg.is_multipart():
-            return None
-        for part in msg.iter_parts():
-            name = part.get_param("name", header="content-disposition")
-            if name != field_name:
-                continue
-            payload = part.get_payload(decode=True)
-            if payload is None:
-                return ""
-            return payload.decode("utf-8", errors="replace")
-    except Exception:
-        return None
+    """从 multipart/form-data（或其前缀）中提取指定文本字段，没有返回 None。"""
+    for name, value in _iter_multipart_fields(body, content_type):
+        if name == field_name:
+            return value
     return None
 
 
@@ -114,36 +254,357 @@ def _is_client_disconnected(exc):
     return False
 
 
-def _parse_body_summary(body, kind="infer"):
-    """从 body 解析摘要字段，不抛异常。kind: 'infer' | 'embed'"""
-    summary = {}
-    if not body:
+class RequestContext:
+    """One proxied JSON body, parsed at most once.
+
+    Routing, the log summary, KV estimation, the stream check and the Ollama
+    model rewrite all read from the same ``json.loads`` result instead of each
+    re-parsing the body (several multi-megabyte parses per request with
+    long-context prompts).  Fields are computed lazily so a request that never
+    needs the body (e.g. no running backend) never parses it.
+    """
+
+    __slots__ = ("body", "cache_key", "received_at", "trace", "_data", "_parse_error", "_prompt_chars")
+
+    _MISSING = object()
+
+    def __init__(self, body):
+        self.body = body
+        self.cache_key = None  # CompletionCache key when the response should be stored
+        self.received_at = time.monotonic()  # 请求体读完的时间，/metrics 的耗时从这里算起
+        self.trace = RequestTrace(self.received_at)
+        self._data = self._MISSING
+        self._parse_error = False
+        self._prompt_chars = None
+
+    @property
+    def data(self):
+        """Top-level JSON object, or None when the body is empty / not a JSON object."""
+        if self._data is self._MISSING:
+            data = None
+            if self.body:
+                try:
+                    data = json.loads(self.body)
+                except (json.JSONDecodeError, UnicodeDecodeError, TypeError):
+                    self._parse_error = True
+            self._data = data if isinstance(data, dict) else None
+            self.trace.mark("parsed")
+        return self._data
+
+    def get(self, key, default=None):
+        data = self.data
+        return data.get(key, default) if data is not None else default
+
+    @property
+    def model(self):
+        return self.get("model")
+
+    @property
+    def stream(self):
+        return bool(self.get("stream", False))
+
+    @property
+    def max_tokens(self):
+        return self.get("max_tokens") or 0
+
+    @property
+    def messages(self):
+        messages = self.get("messages")
+        return messages if isinstance(messages, list) else []
+
+    @property
+    def prompt_chars(self):
+        if self._prompt_chars is None:
+            self._prompt_chars = sum(len(_message_text(msg)) for msg in self.messages)
+        return self._prompt_chars
+
+    def summary(self, kind="infer"):
+        """日志摘要字段，不抛异常。kind: 'infer' | 'embed'"""
+        summary = {}
+        data = self.data
+        if self._parse_error:
+            summary["parse_error"] = True
+        if data is None:
+            return summary
+        if data.get("model") is not None:
+            summary["model"] = data["model"]
+        if kind == "infer":
+            summary["stream"] = data.get("stream", False)
+            messages = data.get("messages")
+            if isinstance(messages, list):
+                summary["n_messages"] = len(messages)
+            if "max_tokens" in data:
+                summary["max_tokens"] = data["max_tokens"]
+            if "temperature" in data:
+                summary["temperature"] = data["temperature"]
+        else:
+            inp = data.get("input")
+            if isinstance(inp, list):
+                summary["input_count"] = len(inp)
+            elif isinstance(inp, str):
+                summary["input_len"] = len(inp)
         return summary
+
+    def replace_model(self, model):
+        """Point the body at another model id without re-serialising the whole body.
+
+        When the literal ``"model"`` key occurs exactly once (it cannot occur
+        inside a JSON string, so that is the top-level key unless a nested
+        object holds the only one) its string value is patched in place;
+        otherwise the body is dumped once.
+        """
+        data = self.data
+        if data is None or data.get("model") == model:
+            return self.body
+        current = data.get("model")
+        body = None
+        if isinstance(current, str) and self.body.count(b'"model"') == 1:
+            m = _MODEL_VALUE_RE.search(self.body)
+            if m and json.loads(m.group(1)) == current:
+                value = json.dumps(model, ensure_ascii=False).encode("utf-8")
+                body = self.body[:m.start(1)] + value + self.body[m.end(1):]
+        data["model"] = model
+        if body is None:
+            body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.body = body
+        return body
+
+
+_MODEL_VALUE_RE = re.compile(rb'"model"\s*:\s*("(?:[^"\\]|\\.)*")')
+
+_MONOTONIC_EPOCH = time.time() - time.monotonic()
+_trace_ids = itertools.count(1)
+
+# (Server-Timing 名称, 起点, 终点)；起点/终点取 RequestTrace 中最先存在的标记
+_TRACE_PHASES = (
+    ("parse", ("received",), ("parsed",)),
+    ("model-queue", ("gate_wait",), ("model_gate",)),
+    ("global-queue", ("model_gate", "gate_wait"), ("global_gate",)),
+    ("connect", ("global_gate",), ("upstream_sent",)),
+    ("upstream", ("upstream_sent",), ("upstream_headers",)),
+    ("ttfb", ("received",), ("first_byte",)),
+    ("decode", ("first_byte",), ("last_byte",)),
+    ("total", ("received",), ("last_byte",)),
+)
+
+
+class RequestTrace:
+    """Phase timestamps of one proxied inference request (time.monotonic()).
+
+    Marks: received, parsed, gate_wait, model_gate, global_gate,
+    upstream_sent (connection ready and request written), upstream_headers,
+    first_byte, last_byte.  The first mark of a name wins.  Phases derived
+    from them go out as ``Server-Timing`` / ``X-Queue-Time`` headers on
+    non-streaming responses, as a final ``: server-timing`` SSE comment on
+    streams, and (SERVE_UI_TRACE_FILE) as Trace Event Format spans.
+    """
+
+    __slots__ = ("marks",)
+
+    def __init__(self, received_at):
+        self.marks = {"received": received_at}
+
+    def mark(self, name, at=None):
+        if name not in self.marks:
+            self.marks[name] = time.monotonic() if at is None else at
+
+    def finish(self, tap):
+        """响应转发结束：补上首字节（取自 UsageTap）与末字节标记。"""
+        if tap is not None and tap.first_at is not None:
+            self.mark("first_byte", tap.first_at)
+        self.mark("last_byte")
+
+    def _first(self, names):
+        for name in names:
+            at = self.marks.get(name)
+            if at is not None:
+                return at
+        return None
+
+    def phases(self):
+        """[(name, start, end)]，只含两端都已标记的阶段。"""
+        out = []
+        for name, starts, ends in _TRACE_PHASES:
+            start, end = self._first(starts), self._first(ends)
+            if start is not None and end is not None and end >= start:
+                out.append((name, start, end))
+        return out
+
+    def queue_ms(self):
+        admitted = self.marks.get("global_gate")
+        start = self.marks.get("gate_wait")
+        if admitted is None or start is None:
+            return None
+        return (admitted - start) * 1000
+
+    def server_timing(self):
+        return ", ".join(f"{name};dur={(end - start) * 1000:.1f}" for name, start, end in self.phases())
+
+    def headers(self):
+        """非流式响应附带的头。"""
+        headers = [("Server-Timing", self.server_timing())]
+        queue_ms = self.queue_ms()
+        if queue_ms is not None:
+            headers.append(("X-Queue-Time", f"{queue_ms:.1f}"))
+        return headers
+
+    def sse_comment(self):
+        """流式响应结束前写出的 SSE 注释（客户端按规范忽略）。"""
+        return f": server-timing {self.server_timing()}\n\n".encode()
+
+    def events(self, path, model_name, status):
+        """Trace Event Format 的完整事件（ph=X），每个请求一条独立的 tid 轨道。"""
+        tid = next(_trace_ids)
+        pid = os.getpid()
+        args = {"path": path, "model": model_name, "status": status}
+        events = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                   "args": {"name": f"{model_name} #{tid}"}}]
+        for name, start, end in self.phases():
+            events.append({
+                "name": name, "cat": model_name, "ph": "X", "pid": pid, "tid": tid,
+                "ts": round((start + _MONOTONIC_EPOCH) * 1e6), "dur": round((end - start) * 1e6),
+                "args": args,
+            })
+        return events
+
+
+class UploadStream:
+    """A large request body relayed to the backend while it is read from the client.
+
+    ``source`` is the client rfile (threading engine) or StreamReader (asyncio
+    engine); at most one relay block of the body is in memory at a time.
+    peek()/apeek() read a bounded prefix for routing, which is sent first.
+    len() is the client Content-Length, forwarded unchanged.
+    """
+
+    __slots__ = ("source", "length", "prefix", "_sent", "_remaining")
+
+    def __init__(self, source, length):
+        self.source = source
+        self.length = length
+        self.prefix = b""
+        self._sent = 0
+        self._remaining = length
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def consumed(self):
+        """请求体已从客户端连接读完（否则连接上还留有未读数据，不能复用）。"""
+        return self._remaining == 0
+
+    def _take(self, data):
+        if not data:
+            raise ConnectionAbortedError("客户端上传中断")
+        self._remaining -= len(data)
+        return data
+
+    def _from_prefix(self, size):
+        if self._sent >= len(self.prefix):
+            return None
+        end = len(self.prefix) if size < 0 else self._sent + size
+        data = self.prefix[self._sent:end]
+        self._sent += len(data)
+        return data
+
+    def peek(self, size):
+        want = min(size, self.length) - len(self.prefix)
+        if want > 0:
+            self.prefix += self._take(self.source.read(want))
+        return self.prefix
+
+    async def apeek(self, size):
+        want = min(size, self.length) - len(self.prefix)
+        if want > 0:
+            try:
+                self.prefix += self._take(await self.source.readexactly(want))
+            except asyncio.IncompleteReadError as e:
+                raise ConnectionAbortedError("客户端上传中断") from e
+        return self.prefix
+
+    def read(self, size=-1):
+        """http.client 发送文件型 body 时按 blocksize 调用。"""
+        data = self._from_prefix(size)
+        if data is not None:
+            return data
+        if not self._remaining:
+            return b""
+        return self._take(self.source.read(self._remaining if size < 0 else min(size, self._remaining)))
+
+    async def aread(self, size):
+        data = self._from_prefix(size)
+        if data is not None:
+            return data
+        if not self._remaining:
+            return b""
+        return self._take(await self.source.read(min(size, self._remaining)))
+
+    def read_all(self):
+        """路由需要完整请求体时退回缓冲读取。"""
+        parts = [self._from_prefix(-1) or b""]
+        if self._remaining:
+            parts.append(self._take(self.source.read(self._remaining)))
+        return b"".join(parts)
+
+    async def aread_all(self):
+        parts = [self._from_prefix(-1) or b""]
+        while self._remaining:
+            parts.append(await self.aread(self._remaining))
+        return b"".join(parts)
+
+    def rewind(self):
+        """复用的后端连接失效需要重发时回到开头；前缀之外的数据已读走则无法重发。"""
+        if self.length - self._remaining != len(self.prefix):
+            return False
+        self._sent = 0
+        return True
+
+
+def _model_hint(path, headers):
+    """不读请求体的路由依据：请求头 X-Model 或查询参数 model。"""
+    hint = headers.get("X-Model", "").strip()
+    if hint:
+        return hint
+    query = urllib.parse.urlsplit(path).query
+    if query:
+        values = urllib.parse.parse_qs(query).get("model")
+        if values and values[0]:
+            return values[0]
+    return None
+
+
+def _model_from_prefix(prefix, content_type):
+    """在请求体前缀中找 model 字段（JSON 或 multipart 文本字段），找不到返回 None。"""
+    if content_type.lower().startswith("multipart/form-data"):
+        return _extract_multipart_field(prefix, content_type, "model")
+    m = _MODEL_VALUE_RE.search(prefix)
+    if m is None:
+        return None
     try:
-        data = json.loads(body.decode("utf-8", errors="replace"))
-    except (json.JSONDecodeError, UnicodeDecodeError, TypeError):
-        summary["parse_error"] = True
-        return summary
-    if not isinstance(data, dict):
-        return summary
-    if data.get("model") is not None:
-        summary["model"] = data["model"]
-    if kind == "infer":
-        summary["stream"] = data.get("stream", False)
-        messages = data.get("messages")
-        if isinstance(messages, list):
-            summary["n_messages"] = len(messages)
-        if "max_tokens" in data:
-            summary["max_tokens"] = data["max_tokens"]
-        if "temperature" in data:
-            summary["temperature"] = data["temperature"]
-    else:
-        inp = data.get("input")
-        if isinstance(inp, list):
-            summary["input_count"] = len(inp)
-        elif isinstance(inp, str):
-            summary["input_len"] = len(inp)
-    return summary
+        value = json.loads(m.group(1))
+    except ValueError:
+        return None
+    return value if isinstance(value, str) and value else None
+
+
+def _request_deadline(headers):
+    """X-Request-Deadline（unix 时间戳，秒）→ time.monotonic() 基准的截止时间；缺省或无效返回 None。"""
+    raw = headers.get("X-Request-Deadline")
+    if not raw:
+        return None
+    try:
+        ts = float(raw)
+    except ValueError:
+        return None
+    return time.monotonic() + (ts - time.time())
+
+
+def _queue_timeout(deadline, limit):
+    """排队等待上限：客户端截止时间与 limit 取较小者。"""
+    if deadline is None:
+        return limit
+    return max(0.0, min(limit, deadline - time.monotonic()))
 
 
 def _log_request_summary(kind, path, method, client_ip, model_name, body_summary, full_body=None):
@@ -158,7 +619,8 @@ def _log_request_and_response(
     kind, path, method, client_ip, model_name, body_summary,
     full_body=None, response_body=None,
 ):
-    """仅在配置了 ACCESS_LOG_FILE 时写入一行 JSONL，含请求信息与 response_body。"""
+    """仅在配置了 ACCESS_LOG_FILE 时写入一行 JSONL，含请求信息与响应摘要（response_summary）；
+    开启 SERVE_UI_LOG_RESPONSE 时另含完整的 response_body。"""
     if not ACCESS_LOG_FILE:
         return
     ts = time.time()
@@ -173,20 +635,383 @@ def _log_request_and_response(
     }
     if full_body is not None and LOG_BODY:
         record["body"] = full_body
+    if isinstance(response_body, (bytes, bytearray, str)):
+        capture = ResponseCapture()
+        capture.feed(response_body.encode("utf-8") if isinstance(response_body, str) else response_body)
+        response_body = capture
     if response_body is not None:
-        if isinstance(response_body, bytes):
-            record["response_body"] = response_body.decode("utf-8", errors="replace")
-        else:
-            record["response_body"] = response_body
-    else:
-        record["response_body"] = None
-    try:
-        line = json.dumps(record, ensure_ascii=False) + "\n"
-        with _access_log_lock:
-            with open(ACCESS_LOG_FILE, "a", encoding="utf-8") as f:
-                f.write(line)
-    except OSError as e:
-        _log(f"access_log write failed: {e}")
+        record["response_summary"] = response_body.summary()
+    # 完整响应体（若保留）的解码与 JSON 序列化在 access_log 写线程中完成
+    record["response_body"] = response_body.body() if response_body is not None else None
+    access_log.submit(record)
+
+
+class ResponseCapture:
+    """Bounded-memory summary of a relayed response for the access log.
+
+    Fed every relayed chunk like UsageTap.  SSE streams are parsed event by
+    event as they pass, keeping only the last usage / timings / finish_reason
+    and the first and last LOG_CONTENT_CHARS characters of generated content,
+    so memory does not grow with the length of the stream.  A JSON body is
+    parsed at the end if it is at most LOG_JSON_PARSE_LIMIT bytes.
+
+    The full body is kept only with SERVE_UI_LOG_RESPONSE=1, in a temporary
+    file once it exceeds SERVE_UI_LOG_SPILL_KB; the access-log writer
+    streams it from there.
+    """
+
+    def __init__(self, keep_full=None):
+        self.size = 0
+        self._mode = None  # "sse" / "json"，由首个非空字节判断
+        self._line = bytearray()
+        self._json = bytearray()
+        self._json_overflow = False
+        self._full = None
+        if LOG_RESPONSE if keep_full is None else keep_full:
+            self._full = tempfile.SpooledTemporaryFile(max_size=LOG_SPILL_KB * 1024)
+        self.events = 0
+        self.done = False
+        self.fields = {}
+        self.content_chars = 0
+        self.reasoning_chars = 0
+        self._head = ""
+        self._tail = ""
+
+    def feed(self, chunk):
+        if not chunk:
+            return
+        self.size += len(chunk)
+        if self._full is not None:
+            self._full.write(chunk)
+        if self._mode is None:
+            stripped = bytes(chunk).lstrip()
+            if not stripped:
+                return
+            self._mode = "sse" if stripped[:1] in (b"d", b":", b"e", b"i") else "json"
+        if self._mode == "json":
+            if not self._json_overflow:
+                self._json += chunk
+                if len(self._json) > LOG_JSON_PARSE_LIMIT:
+                    self._json_overflow = True
+                    self._json = bytearray()
+            return
+        line = self._line
+        line += chunk
+        start = 0
+        while True:
+            end = line.find(b"\n", start)
+            if end < 0:
+                break
+            self._sse_line(bytes(line[start:end]))
+            start = end + 1
+        del line[:start]
+        if len(line) > LOG_SSE_LINE_LIMIT:
+            line.clear()  # 超长单行事件不解析
+
+    def _sse_line(self, line):
+        if not line.startswith(b"data:"):
+            return
+        payload = line[5:].strip()
+        if payload == b"[DONE]":
+            self.done = True
+            return
+        self.events += 1
+        try:
+            obj = json.loads(payload)
+        except (ValueError, UnicodeDecodeError):
+            return
+        if isinstance(obj, dict):
+            self._absorb(obj, "delta")
+
+    def _absorb(self, obj, part_key):
+        for key in ("model", "usage", "timings", "error"):
+            if obj.get(key):
+                self.fields[key] = obj[key]
+        choices = obj.get("choices")
+        if isinstance(choices, list) and choices and isinstance(choices[0], dict):
+            choice = choices[0]
+            if choice.get("finish_reason"):
+                self.fields["finish_reason"] = choice["finish_reason"]
+            part = choice.get(part_key)
+            if isinstance(part, dict):
+                self._add_content(part.get("content"))
+                reasoning = part.get("reasoning_content")
+                if isinstance(reasoning, str):
+                    self.reasoning_chars += len(reasoning)
+            else:
+                self._add_content(choice.get("text"))
+        elif isinstance(obj.get("data"), list):
+            self.fields["items"] = len(obj["data"])  # embeddings
+
+    def _add_content(self, text):
+        if not isinstance(text, str) or not text:
+            return
+        self.content_chars += len(text)
+        if len(self._head) < LOG_CONTENT_CHARS:
+            self._head += text[:LOG_CONTENT_CHARS - len(self._head)]
+        self._tail = (self._tail + text)[-LOG_CONTENT_CHARS:]
+
+    def summary(self):
+        if self._mode == "json" and not self._json_overflow and self._json:
+            try:
+                obj = json.loads(bytes(self._json))
+            except (ValueError, UnicodeDecodeError):
+                obj = None
+            self._json = bytearray()
+            if isinstance(obj, dict):
+                self._absorb(obj, "message")
+        out = {"bytes": self.size}
+        if self._mode == "sse":
+            out["events"] = self.events
+            out["done"] = self.done
+        elif self._json_overflow:
+            out["parsed"] = False
+        out.update(self.fields)
+        if self.content_chars:
+            out["content_chars"] = self.content_chars
+            out["content_head"] = self._head
+            if self.content_chars > len(self._head):
+                out["content_tail"] = self._tail
+        if self.reasoning_chars:
+            out["reasoning_chars"] = self.reasoning_chars
+        return out
+
+    def body(self):
+        """Full body (file object positioned at 0) when kept, else None."""
+        if self._full is None:
+            return None
+        self._full.seek(0)
+        return self._full
+
+
+class AccessLogWriter:
+    """Background writer for the JSONL access log (SERVE_UI_ACCESS_LOG).
+
+    Request threads only put the record on a bounded queue
+    (SERVE_UI_ACCESS_LOG_QUEUE); a daemon thread serialises records and
+    appends them in batches to a file it keeps open.  When the queue is full
+    the policy decides: ``drop`` (default) discards the record and counts
+    it, ``block`` makes the request wait for the writer.
+
+    The file is rotated when it exceeds SERVE_UI_ACCESS_LOG_MAX_MB or has
+    been open for SERVE_UI_ACCESS_LOG_ROTATE_SEC (0 disables either); the
+    rotated file is renamed with a timestamp suffix, gzipped in the
+    background, and only the newest SERVE_UI_ACCESS_LOG_KEEP are kept.
+    Both are off by default (no rotation, nothing deleted), as before
+    rotation existed; pruning applies only when KEEP is set.
+    """
+
+    _STOP = object()
+
+    def __init__(self, path, max_queue=ACCESS_LOG_QUEUE, policy=ACCESS_LOG_POLICY,
+                 max_bytes=ACCESS_LOG_MAX_MB * (1 << 20), rotate_sec=ACCESS_LOG_ROTATE_SEC, keep=ACCESS_LOG_KEEP):
+        self.path = path
+        self.policy = "block" if policy == "block" else "drop"
+        self.max_bytes = max_bytes
+        self.rotate_sec = rotate_sec
+        self.keep = keep
+        self._queue = queue.Queue(max(1, max_queue))
+        self._lock = threading.Lock()
+        self._thread = None
+        self._file = None
+        self._opened_at = 0.0
+        self.stats = collections.Counter()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True, name="access-log")
+                self._thread.start()
+
+    def submit(self, record):
+        if self._thread is None:
+            self.start()
+        if self.policy == "block":
+            self._queue.put(record)
+            return
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.stats["dropped"] += 1
+                dropped = self.stats["dropped"]
+            if dropped == 1 or dropped % 1000 == 0:
+                _log(f"[access_log] 写入队列已满，已丢弃 {dropped} 条记录")
+
+    def close(self, timeout=5.0):
+        """Flush queued records and stop the writer (atexit)."""
+        if self._thread is None:
+            return
+        try:
+            self._queue.put(self._STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            try:
+                first = self._queue.get(timeout=1.0 if self.rotate_sec > 0 else None)
+            except queue.Empty:
+                self._maybe_rotate()
+                continue
+            batch = [first]
+            while len(batch) < ACCESS_LOG_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = any(record is self._STOP for record in batch)
+            self._write([record for record in batch if record is not self._STOP])
+            if stop:
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                return
+
+    @staticmethod
+    def _write_record(f, record):
+        response_body = record.get("response_body")
+        if isinstance(response_body, (bytes, bytearray)):
+            record["response_body"] = bytes(response_body).decode("utf-8", errors="replace")
+        if not hasattr(response_body, "read"):
+            f.write((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+            return
+        # ResponseCapture 保留的完整响应体：分块转义写入，不整体读入内存
+        record.pop("response_body")
+        head = json.dumps(record, ensure_ascii=False)
+        f.write((head[:-1] + (", " if record else "") + '"response_body": "').encode("utf-8"))
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        try:
+            while True:
+                chunk = response_body.read(1 << 16)
+                text = decoder.decode(chunk, final=not chunk)
+                if text:
+                    f.write(json.dumps(text, ensure_ascii=False)[1:-1].encode("utf-8"))
+                if not chunk:
+                    break
+        finally:
+            response_body.close()
+        f.write(b'"}\n')
+
+    def _write(self, records):
+        if not records:
+            return
+        try:
+            if self._file is None:
+                self._file = open(self.path, "ab")
+                self._opened_at = time.time()
+            for record in records:
+                self._write_record(self._file, record)
+            self._file.flush()
+        except OSError as e:
+            with self._lock:
+                self.stats["errors"] += 1
+            _log(f"access_log write failed: {e}")
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            return
+        with self._lock:
+            self.stats["written"] += len(records)
+            self.stats["batches"] += 1
+        self._maybe_rotate()
+
+    def _maybe_rotate(self):
+        if self._file is None:
+            return
+        try:
+            size = self._file.tell()
+        except OSError:
+            return
+        too_big = self.max_bytes > 0 and size >= self.max_bytes
+        too_old = self.rotate_sec > 0 and time.time() - self._opened_at >= self.rotate_sec
+        if not (too_big or too_old) or size == 0:
+            return
+        self._file.close()
+        self._file = None
+        rotated = f"{self.path}.{time.strftime('%Y%m%d-%H%M%S')}"
+        n = 1
+        while os.path.exists(rotated) or os.path.exists(rotated + ".gz"):
+            rotated = f"{self.path}.{time.strftime('%Y%m%d-%H%M%S')}-{n}"
+            n += 1
+        try:
+            os.replace(self.path, rotated)
+        except OSError as e:
+            _log(f"[access_log] 轮转 {self.path} 失败: {e}")
+            return
+        with self._lock:
+            self.stats["rotations"] += 1
+        threading.Thread(target=self._compress, args=(rotated,), daemon=True).start()
+
+    def _compress(self, rotated):
+        try:
+            with open(rotated, "rb") as src, gzip.open(rotated + ".gz.tmp", "wb") as dst:
+                while True:
+                    chunk = src.read(1 << 20)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+            os.replace(rotated + ".gz.tmp", rotated + ".gz")
+            os.remove(rotated)
+        except OSError as e:
+            _log(f"[access_log] 压缩 {rotated} 失败: {e}")
+        self._prune()
+
+    def _prune(self):
+        if self.keep <= 0:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        prefix = os.path.basename(self.path) + "."
+        try:
+            rotated = sorted(
+                name for name in os.listdir(directory)
+                if name.startswith(prefix) and name.endswith(".gz")
+            )
+        except OSError:
+            return
+        for name in rotated[:max(0, len(rotated) - self.keep)]:
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+    def snapshot(self):
+        if not self.path:
+            return None
+        with self._lock:
+            stats = {k: self.stats[k] for k in ("written", "dropped", "batches", "rotations", "errors")}
+        stats.update(path=self.path, policy=self.policy, queued=self._queue.qsize(), max_queue=self._queue.maxsize)
+        return stats
+
+
+access_log = AccessLogWriter(ACCESS_LOG_FILE)
+
+
+class TraceWriter(AccessLogWriter):
+    """Writes sampled RequestTrace spans to SERVE_UI_TRACE_FILE.
+
+    Trace Event Format, one event per line: the file opens with ``[`` and
+    every line ends with ``,`` -- the unterminated JSON array form that
+    Perfetto and chrome://tracing load directly.  Queueing, drop policy and
+    rotation are those of the access log.
+    """
+
+    def _write_record(self, f, events):
+        if f.tell() == 0:
+            f.write(b"[\n")
+        for event in events:
+            f.write((json.dumps(event, ensure_ascii=False) + ",\n").encode("utf-8"))
+
+
+trace_writer = TraceWriter(TRACE_FILE)
+
+
+def trace_export(trace, tap, path, model_name):
+    """请求结束时按 SERVE_UI_TRACE_SAMPLE 采样写入 trace 文件。"""
+    trace.finish(tap)
+    if TRACE_FILE and random.random() < TRACE_SAMPLE:
+        trace_writer.submit(trace.events(path, model_name, tap.status or 200))
 
 
 def load_api_key():
@@ -196,6 +1021,63 @@ def load_api_key():
     return None
 
 
+def load_api_key_lanes():
+    """.api-key-lanes：每行 `<key> <lane>`（# 开头为注释）→ {key: lane}，按 mtime 缓存。
+    其中每个 key 都是额外的 /v1/* 凭据（与 .api-key 同等有效），请求按其 lane 排队。"""
+    try:
+        mtime = os.stat(API_KEY_LANES_FILE).st_mtime_ns
+    except OSError:
+        return {}
+    cache = getattr(load_api_key_lanes, "_cache", None)
+    if cache and cache[0] == mtime:
+        return cache[1]
+    lanes = {}
+    try:
+        with open(API_KEY_LANES_FILE, "r") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and not parts[0].startswith("#") and parts[1] in LANE_RANK:
+                    lanes[parts[0]] = parts[1]
+    except OSError:
+        return {}
+    load_api_key_lanes._cache = (mtime, lanes)
+    return lanes
+
+
+def _bearer_token(headers):
+    auth = headers.get("Authorization", "")
+    return auth[7:].strip() if auth.startswith("Bearer ") else None
+
+
+def _auth_ok(headers):
+    """/v1/* 认证：未配置 .api-key 时放行；否则接受 .api-key 或 .api-key-lanes 中的 key。
+
+    .api-key-lanes 中的 key 是有意的额外凭据：为每个客户端单独分发 key 才能按 key 指定 lane。"""
+    expected = load_api_key()
+    if not expected:
+        return True
+    token = _bearer_token(headers)
+    return token is not None and (token == expected or token in load_api_key_lanes())
+
+
+def _request_lane(headers):
+    """优先级 lane：X-Priority 请求头（interactive / default / batch）。
+
+    请求头只对携带有效凭据的请求生效：用 .api-key 认证时可指定任意 lane；
+    用 .api-key-lanes 中的 key 时以该 key 的 lane 为上限，请求头只能降级；
+    其他请求（未认证、/api/<模型>/... 等不校验 key 的路由）以 default 为上限，
+    请求头同样只能降级，不能插队或挤出他人排队中的请求。"""
+    lane = (headers.get("X-Priority") or "").strip().lower()
+    token = _bearer_token(headers)
+    api_key = load_api_key()
+    if token is not None and api_key and token == api_key:
+        return lane if lane in LANE_RANK else "default"
+    key_lane = (load_api_key_lanes().get(token) if token else None) or "default"
+    if lane not in LANE_RANK or LANE_RANK[lane] < LANE_RANK[key_lane]:
+        lane = key_lane
+    return lane
+
+
 def _load_models_json():
     """Load models.json, cached per-process with 30s TTL."""
     now = time.monotonic()
@@ -212,84 +1094,1071 @@ def _load_models_json():
 
 
 def _get_model_params(model_name):
-    """Return params dict for a model from models.json, or empty dict."""
+    """Return params dict for a model from models.json, or empty dict.
+
+    A replica started under another run name uses the entry whose key or
+    ``alias`` matches the replica's alias.
+    """
     data = _load_models_json()
     model = data.get(model_name)
     if model and isinstance(model, dict):
         return model.get("params", {})
+    info = route_registry.table().models.get(model_name)
+    alias = info.get("model") if info else None
+    if alias and alias != model_name:
+        for key, cfg in data.items():
+            if isinstance(cfg, dict) and alias in (key, cfg.get("alias")):
+                return cfg.get("params", {})
     return {}
 
 
-def estimate_kv_tokens(body, model_name):
-    """Estimate KV token usage from request body.
+def _message_text(msg):
+    """Text of one chat message (string content or the text parts of a list)."""
+    content = msg.get("content") if isinstance(msg, dict) else None
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "".join(
+            part["text"] for part in content
+            if isinstance(part, dict) and isinstance(part.get("text"), str)
+        )
+    return ""
+
+
+def _chars_to_tokens(chars, model_name):
+    """Heuristic prompt size: characters / the model's learned chars-per-token
+    (KV_CHARS_PER_TOKEN until calibrated, see CharsPerTokenCalibrator)."""
+    if not chars:
+        return 0
+    return int(chars / (kv_calibrator.ratio(model_name) or KV_CHARS_PER_TOKEN))
+
+
+def estimate_kv_tokens(ctx, model_name):
+    """Estimate KV token usage from the request (a RequestContext).
 
     Returns (estimated_kv, max_tokens_used) where estimated_kv is
     prompt_estimate + max_tokens and max_tokens_used is the generation
-    cap taken from the request or model config fallback.
+    cap taken from the request or model config fallback.  With exact
+    counting enabled for the model the prompt part comes from the
+    backend tokenizer (see TokenCounter).
     """
-    prompt_chars = 0
-    max_tokens = 0
-    if body:
-        try:
-            data = json.loads(body)
-        except (json.JSONDecodeError, UnicodeDecodeError, TypeError):
-            data = {}
-        if isinstance(data, dict):
-            max_tokens = data.get("max_tokens") or 0
-            messages = data.get("messages")
-            if isinstance(messages, list):
-                for msg in messages:
-                    content = msg.get("content") if isinstance(msg, dict) else None
-                    if isinstance(content, str):
-                        prompt_chars += len(content)
-                    elif isinstance(content, list):
-                        for part in content:
-                            if isinstance(part, dict) and isinstance(part.get("text"), str):
-                                prompt_chars += len(part["text"])
+    messages = ctx.messages
+    max_tokens = ctx.max_tokens
     if not max_tokens:
         params = _get_model_params(model_name)
         max_tokens = params.get("n_predict", 32768)
-    prompt_tokens_est = int(prompt_chars / KV_CHARS_PER_TOKEN) if prompt_chars else 0
-    return prompt_tokens_est + max_tokens, max_tokens
+    prompt_tokens = None
+    mode = exact_token_mode(model_name)
+    if messages and mode:
+        prompt_tokens = token_counter.count(model_name, messages, mode)
+    if prompt_tokens is None:
+        prompt_tokens = _chars_to_tokens(ctx.prompt_chars, model_name)
+    return prompt_tokens + max_tokens, max_tokens
+
+
+# ── 精确 prompt token 计数（可选） ─────────────────────────────
+
+
+def exact_token_mode(model_name):
+    """models.json params.exact_token_count 优先，其次 KV_EXACT_TOKENS。
+    返回 None（关闭）| "messages" | "template"。"""
+    value = _get_model_params(model_name).get("exact_token_count", KV_EXACT_TOKENS)
+    if value is True:
+        return "messages"
+    value = str(value or "").strip().lower()
+    if value in ("", "0", "false", "no", "off"):
+        return None
+    return "template" if value == "template" else "messages"
 
 
-# ── 系统资源采集（macOS 原生命令） ─────────────────────────────
+class TokenCounter:
+    """Exact prompt token counts from the backend tokenizer, with an LRU cache.
 
-_system_cache = {"data": None, "ts": 0.0}
-_system_cache_lock = threading.Lock()
+    ``messages`` mode tokenizes each message's text separately through
+    llama-server ``/tokenize`` (cached by a hash of backend + role + text) and
+    adds KV_TEMPLATE_TOKENS_PER_MSG per message for the chat-template
+    wrapping, so a repeated system prompt or the earlier turns of a
+    conversation are only tokenized once.  ``template`` mode renders the
+    prompt with ``/apply-template`` and tokenizes it whole (exact, but cached
+    per conversation).
 
+    Uncached text falls back to the chars-per-token heuristic when the
+    backend already has TOKENIZE_MAX_INFLIGHT tokenize calls pending, when
+    a call exceeds TOKENIZE_TIMEOUT, or when the backend has no tokenize
+    endpoint; slow or unsupported backends are skipped for a back-off period.
+    Ollama backends always use the heuristic.
+    """
 
-def _collect_system_info():
-    """Collect CPU, memory, load average and per-process stats via macOS commands."""
-    result = {
-        "cpu": {"user": 0, "sys": 0, "idle": 100},
-        "load_avg": [0, 0, 0],
-        "memory": {"total_gb": 0, "used_gb": 0, "free_gb": 0, "wired_gb": 0},
-        "processes": {"llama_server": [], "ollama": []},
-        "cached_at": time.time(),
-    }
+    def __init__(self, max_entries=TOKENIZE_CACHE_SIZE, timeout=TOKENIZE_TIMEOUT):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._cache = collections.OrderedDict()
+        self._backoff = {}   # base_url -> monotonic time until which tokenize is skipped
+        self._inflight = collections.Counter()
+        self.hits = 0
+        self.misses = 0
+        self.fallbacks = 0
+
+    @staticmethod
+    def _key(*parts):
+        h = hashlib.blake2b(digest_size=16)
+        for part in parts:
+            h.update(part.encode("utf-8", errors="replace"))
+            h.update(b"\0")
+        return h.digest()
+
+    def _get(self, key):
+        with self._lock:
+            n = self._cache.get(key)
+            if n is None:
+                self.misses += 1
+                return None
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return n
 
-    try:
-        top_out = subprocess.run(
-            ["top", "-l", "1", "-n", "0", "-s", "0"],
-            capture_output=True, text=True, timeout=10,
-        ).stdout
-        cpu_m = re.search(
-            r"CPU usage:\s*([\d.]+)%\s*user,\s*([\d.]+)%\s*sys,\s*([\d.]+)%\s*idle",
-            top_out,
-        )
-        if cpu_m:
-            result["cpu"] = {
-                "user": float(cpu_m.group(1)),
-                "sys": float(cpu_m.group(2)),
-                "idle": float(cpu_m.group(3)),
-            }
-        load_m = re.search(
-            r"Load Avg:\s*([\d.]+),\s*([\d.]+),\s*([\d.]+)", top_out
-        )
-        if load_m:
-            result["load_avg"] = [
-                float(load_m.group(1)),
+    def _put(self, key, n):
+        with self._lock:
+            self._cache[key] = n
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def _begin(self, base_url):
+        with self._lock:
+            if self._backoff.get(base_url, 0) > time.monotonic():
+                return False
+            if self._inflight[base_url] >= TOKENIZE_MAX_INFLIGHT:
+                return False
+            self._inflight[base_url] += 1
+            return True
+
+    def _end(self, base_url, backoff=0):
+        with self._lock:
+            self._inflight[base_url] -= 1
+            if backoff:
+                self._backoff[base_url] = time.monotonic() + backoff
+
+    def _call(self, base_url, path, payload, timeout):
+        """POST JSON to the backend; returns the decoded reply or None (after setting back-off)."""
+        if timeout <= 0 or not self._begin(base_url):
+            return None
+        backoff = 0
+        try:
+            status, raw = backend_fetch(base_url + path, "POST", payload, timeout)
+            if status in (404, 405, 501):
+                backoff = TOKENIZE_UNSUPPORTED_BACKOFF
+                _log(f"[tokenize] {base_url} 不支持 {path}，{backoff:.0f}s 内改用估算")
+                return None
+            if status != 200:
+                return None
+            return json.loads(raw)
+        except BackendError as e:
+            backoff = TOKENIZE_BACKOFF_SEC
+            _log(f"[tokenize] {base_url}{path} 失败（{e}），{backoff:.0f}s 内改用估算")
+            return None
+        except (OSError, http.client.HTTPException, ValueError):
+            backoff = TOKENIZE_BACKOFF_SEC
+            return None
+        finally:
+            self._end(base_url, backoff)
+
+    def _tokenize(self, base_url, text, timeout):
+        reply = self._call(base_url, "/tokenize", {"content": text, "add_special": False}, timeout)
+        tokens = reply.get("tokens") if isinstance(reply, dict) else None
+        return len(tokens) if isinstance(tokens, list) else None
+
+    def count(self, model_name, messages, mode="messages"):
+        info = get_running_models().get(model_name)
+        if not info or info.get("ollama"):
+            return None
+        base_url = _backend_base_url(info)
+        deadline = time.monotonic() + self.timeout
+        if mode == "template":
+            return self._count_template(base_url, model_name, messages, deadline)
+
+        total = 0
+        fallback = False
+        for msg in messages:
+            text = _message_text(msg)
+            total += KV_TEMPLATE_TOKENS_PER_MSG
+            if not text:
+                continue
+            role = msg.get("role") if isinstance(msg, dict) else None
+            key = self._key(base_url, str(role or ""), text)
+            n = self._get(key)
+            if n is None and not fallback:
+                n = self._tokenize(base_url, text, deadline - time.monotonic())
+                if n is None:
+                    fallback = True
+                else:
+                    self._put(key, n)
+            if n is None:
+                n = _chars_to_tokens(len(text), model_name)
+            total += n
+        if fallback:
+            with self._lock:
+                self.fallbacks += 1
+        return total
+
+    def _count_template(self, base_url, model_name, messages, deadline):
+        texts = [(str(m.get("role") or "") if isinstance(m, dict) else "", _message_text(m)) for m in messages]
+        key = self._key(base_url, "template", *(part for pair in texts for part in pair))
+        n = self._get(key)
+        if n is not None:
+            return n
+        reply = self._call(base_url, "/apply-template", {"messages": messages},
+                           deadline - time.monotonic())
+        prompt = reply.get("prompt") if isinstance(reply, dict) else None
+        if isinstance(prompt, str):
+            n = self._tokenize(base_url, prompt, deadline - time.monotonic())
+        if n is None:
+            with self._lock:
+                self.fallbacks += 1
+            return None
+        self._put(key, n)
+        return n
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "entries": len(self._cache),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "fallbacks": self.fallbacks,
+            }
+
+
+token_counter = TokenCounter()
+
+
+# ── chars-per-token 在线校准 ─────────────────────────────────
+
+
+_USAGE_PATTERNS = (
+    re.compile(rb'"prompt_tokens"\s*:\s*(\d+)'),        # OpenAI usage
+    re.compile(rb'"prompt_eval_count"\s*:\s*(\d+)'),    # Ollama
+)
+_PROMPT_N_RE = re.compile(rb'"prompt_n"\s*:\s*(\d+)')  # llama-server timings（不含缓存命中部分）
+_CACHE_N_RE = re.compile(rb'"cache_n"\s*:\s*(\d+)')
+_COMPLETION_PATTERNS = (
+    re.compile(rb'"completion_tokens"\s*:\s*(\d+)'),    # OpenAI usage
+    re.compile(rb'"eval_count"\s*:\s*(\d+)'),           # Ollama
+    re.compile(rb'"predicted_n"\s*:\s*(\d+)'),          # llama-server timings
+)
+
+
+class UsageTap:
+    """Keeps the tail of a relayed inference response to read the backend's prompt token count.
+
+    Works for both a JSON body and an SSE stream: usage / timings sit in the
+    last object (the final chunk when streaming), so only the last
+    ``TAIL_BYTES`` are kept and scanned with a regex after the relay.
+    ``first_at`` (first relayed chunk) and ``status`` (set by the forward
+    helpers when the relay failed: 502, 504 or the backend's error status)
+    feed the /metrics histograms and outcome counters.
+    """
+
+    TAIL_BYTES = 16384
+
+    def __init__(self):
+        self._tail = bytearray()
+        self.first_at = None
+        self.status = None
+
+    def feed(self, chunk):
+        if self.first_at is None:
+            self.first_at = time.monotonic()
+        tail = self._tail
+        tail += chunk
+        if len(tail) > 2 * self.TAIL_BYTES:
+            del tail[:-self.TAIL_BYTES]
+
+    def prompt_tokens(self):
+        tail = bytes(self._tail)
+        for pattern in _USAGE_PATTERNS:
+            matches = pattern.findall(tail)
+            if matches:
+                return int(matches[-1])
+        prompt_n = _PROMPT_N_RE.findall(tail)
+        if prompt_n:
+            cache_n = _CACHE_N_RE.findall(tail)
+            return int(prompt_n[-1]) + (int(cache_n[-1]) if cache_n else 0)
+        return None
+
+    def completion_tokens(self):
+        tail = bytes(self._tail)
+        for pattern in _COMPLETION_PATTERNS:
+            matches = pattern.findall(tail)
+            if matches:
+                return int(matches[-1])
+        return None
+
+
+class CharsPerTokenCalibrator:
+    """Per-model chars-per-token ratio learned from backend usage.
+
+    After each inference the prompt's character count is paired with the
+    prompt token count the backend reported (see UsageTap) and folded into
+    an exponentially-weighted average (KV_CALIBRATION_ALPHA).  Once a model
+    has KV_CALIBRATION_MIN_SAMPLES samples the ratio replaces
+    KV_CHARS_PER_TOKEN in its KV estimates.  Ratios are persisted to
+    KV_CALIBRATION_FILE (at most every KV_CALIBRATION_SAVE_SEC and at exit)
+    so admission is calibrated right after a restart.  Once ``start()`` has
+    run, saving happens on a background thread and ``observe`` only marks
+    the ratios dirty, so it never touches the disk (safe on the event loop).
+    """
+
+    def __init__(self, path=KV_CALIBRATION_FILE, alpha=KV_CALIBRATION_ALPHA):
+        self.path = path
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        self._models = {}  # model_name -> {"ratio": float, "samples": int}
+        self._dirty = False
+        self._saved_at = time.monotonic()
+        self._thread = None
+        self._load()
+
+    def start(self):
+        if self._thread is not None or not self.path:
+            return
+        self._thread = threading.Thread(target=self._run, name="kv-calibrator", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(KV_CALIBRATION_SAVE_SEC)
+            self.save()
+
+    def _load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        for name, entry in (data if isinstance(data, dict) else {}).items():
+            try:
+                self._models[name] = {"ratio": float(entry["ratio"]), "samples": int(entry["samples"])}
+            except (TypeError, KeyError, ValueError):
+                continue
+
+    def ratio(self, model_name):
+        entry = self._models.get(model_name)
+        if entry and entry["samples"] >= KV_CALIBRATION_MIN_SAMPLES:
+            return entry["ratio"]
+        return None
+
+    def observe(self, model_name, prompt_chars, prompt_tokens):
+        if prompt_chars < KV_CALIBRATION_MIN_CHARS or not prompt_tokens or prompt_tokens <= 0:
+            return
+        sample = min(8.0, max(0.5, prompt_chars / prompt_tokens))
+        with self._lock:
+            entry = self._models.get(model_name)
+            if entry is None:
+                self._models[model_name] = {"ratio": sample, "samples": 1}
+            else:
+                entry["ratio"] += self.alpha * (sample - entry["ratio"])
+                entry["samples"] += 1
+            self._dirty = True
+            due = time.monotonic() - self._saved_at >= KV_CALIBRATION_SAVE_SEC
+        if due and self._thread is None:
+            # 未启动保存线程（如被脚本直接 import）时按需保存
+            self.save()
+
+    def observe_tap(self, model_name, ctx, tap):
+        """Record one finished inference: ctx is its RequestContext, tap its UsageTap."""
+        if tap is not None and ctx.messages:
+            self.observe(model_name, ctx.prompt_chars, tap.prompt_tokens())
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            data = {name: dict(entry) for name, entry in self._models.items()}
+            self._dirty = False
+            self._saved_at = time.monotonic()
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(data, f, indent=2, sort_keys=True)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            _log(f"[calibrate] 保存 {self.path} 失败: {e}")
+
+    def snapshot(self, model_name):
+        entry = self._models.get(model_name) or {}
+        return {
+            "chars_per_token": round(self.ratio(model_name) or KV_CHARS_PER_TOKEN, 3),
+            "learned": round(entry["ratio"], 3) if entry else None,
+            "samples": entry.get("samples", 0),
+        }
+
+
+kv_calibrator = CharsPerTokenCalibrator()
+
+
+# ── 确定性补全缓存（可选） ─────────────────────────────────────
+
+
+class RecordingTap(UsageTap):
+    """UsageTap that also keeps the whole response (up to COMPLETION_CACHE_MAX_ENTRY) for the completion cache."""
+
+    def __init__(self):
+        super().__init__()
+        self._parts = []
+        self._size = 0
+
+    def feed(self, chunk):
+        super().feed(chunk)
+        if self._parts is None:
+            return
+        self._size += len(chunk)
+        if self._size > COMPLETION_CACHE_MAX_ENTRY:
+            self._parts = None
+        else:
+            self._parts.append(bytes(chunk))
+
+    def body(self):
+        return b"".join(self._parts) if self._parts is not None else None
+
+
+def _complete_response(body, stream):
+    """只缓存完整且成功的响应：SSE 以 [DONE] 结束；JSON 为不含 error 的对象。"""
+    if not body:
+        return False
+    if stream:
+        return body.rstrip().endswith(b"data: [DONE]")
+    try:
+        data = json.loads(body)
+    except (ValueError, UnicodeDecodeError):
+        return False
+    return isinstance(data, dict) and "error" not in data
+
+
+class _Flight:
+    """One upstream call that identical concurrent requests wait on."""
+
+    __slots__ = ("event", "_callbacks", "_lock")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def add_callback(self, callback):
+        with self._lock:
+            if not self.event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def _finish(self):
+        with self._lock:
+            self.event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+class CompletionCache:
+    """Replays responses to byte-identical deterministic completion requests.
+
+    Opt-in (COMPLETION_CACHE=1).  A request is cacheable when it sets
+    ``temperature: 0``, asks for a single choice and does not send
+    ``Cache-Control: no-cache`` / ``no-store``.  The key hashes the request
+    path, the routed model alias and the canonical JSON of the body (sorted
+    keys, so field order does not matter); streaming and non-streaming
+    requests are cached separately and streams are stored as the raw SSE
+    bytes, so a hit is replayed exactly as the backend sent it.
+
+    Entries live in an LRU memory tier (COMPLETION_CACHE_MAX_MB,
+    COMPLETION_CACHE_TTL) and, with COMPLETION_CACHE_DIR set, in a disk tier
+    (COMPLETION_CACHE_DISK_MAX_MB, COMPLETION_CACHE_DISK_TTL; disk hits are
+    promoted to memory).  Only complete, successful responses are stored.
+
+    Single flight: while one request for a key is upstream, identical
+    requests wait on its ``_Flight`` and replay its stored response; if it
+    could not be stored they go upstream themselves.
+    """
+
+    def __init__(self, enabled=COMPLETION_CACHE, max_bytes=COMPLETION_CACHE_MAX_MB * (1 << 20),
+                 ttl=COMPLETION_CACHE_TTL, disk_dir=COMPLETION_CACHE_DIR,
+                 disk_max_bytes=COMPLETION_CACHE_DISK_MAX_MB * (1 << 20), disk_ttl=COMPLETION_CACHE_DISK_TTL):
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.disk_ttl = disk_ttl
+        self._lock = threading.Lock()
+        self._mem = collections.OrderedDict()  # key -> (stored_at, stream, body)
+        self._mem_bytes = 0
+        self._disk = None  # key -> (mtime, size)，首次使用时扫描目录
+        self._disk_bytes = 0
+        self._flights = {}
+        self.stats = collections.Counter()
+
+    def key_for(self, ctx, model_name, path, headers):
+        """Cache key of a request, or None when it is not cacheable."""
+        if not self.enabled:
+            return None
+        cache_control = (headers.get("Cache-Control") or "").lower()
+        if "no-cache" in cache_control or "no-store" in cache_control:
+            return None
+        data = ctx.data
+        if data is None or data.get("temperature") not in (0, 0.0) or data.get("n", 1) != 1:
+            return None
+        info = get_running_models().get(model_name) or {}
+        h = hashlib.blake2b(digest_size=20)
+        h.update(path.split("?", 1)[0].strip("/").encode("utf-8"))
+        h.update(b"\0")
+        h.update(str(info.get("model") or model_name).encode("utf-8"))
+        h.update(b"\0")
+        h.update(json.dumps(data, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode("utf-8"))
+        return h.hexdigest()
+
+    # memory tier（调用方持有锁）
+
+    def _mem_put(self, key, stored_at, stream, body):
+        old = self._mem.pop(key, None)
+        if old is not None:
+            self._mem_bytes -= len(old[2])
+        self._mem[key] = (stored_at, stream, body)
+        self._mem_bytes += len(body)
+        while self._mem and self._mem_bytes > self.max_bytes:
+            _, (_, _, evicted) = self._mem.popitem(last=False)
+            self._mem_bytes -= len(evicted)
+
+    # disk tier：每条一个文件，首行为 JSON 元数据，其后为响应原文
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key + ".bin")
+
+    def _disk_index(self):
+        if self._disk is None:
+            self._disk = {}
+            try:
+                os.makedirs(self.disk_dir, exist_ok=True)
+                for entry in os.scandir(self.disk_dir):
+                    if entry.name.endswith(".bin"):
+                        st = entry.stat()
+                        self._disk[entry.name[:-4]] = (st.st_mtime, st.st_size)
+            except OSError as e:
+                _log(f"[cache] 读取缓存目录 {self.disk_dir} 失败: {e}")
+            self._disk_bytes = sum(size for _, size in self._disk.values())
+        return self._disk
+
+    def _disk_remove(self, key):
+        _, size = self._disk.pop(key, (0, 0))
+        self._disk_bytes -= size
+        try:
+            os.remove(self._disk_path(key))
+        except OSError:
+            pass
+
+    def _disk_get(self, key):
+        with self._lock:
+            meta = self._disk_index().get(key)
+            if meta is None:
+                return None
+            if time.time() - meta[0] > self.disk_ttl:
+                self._disk_remove(key)
+                return None
+        try:
+            with open(self._disk_path(key), "rb") as f:
+                header = json.loads(f.readline())
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        return bool(header.get("stream")), body
+
+    def _disk_put(self, key, stream, body):
+        header = json.dumps({"stream": stream, "stored_at": time.time()}).encode("utf-8") + b"\n"
+        path = self._disk_path(key)
+        try:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            tmp = path + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(header)
+                f.write(body)
+            os.replace(tmp, path)
+        except OSError as e:
+            _log(f"[cache] 写入 {path} 失败: {e}")
+            return
+        with self._lock:
+            index = self._disk_index()
+            _, old_size = index.get(key, (0, 0))
+            index[key] = (time.time(), len(header) + len(body))
+            self._disk_bytes += len(header) + len(body) - old_size
+            if self._disk_bytes > self.disk_max_bytes:
+                for old_key, _ in sorted(index.items(), key=lambda item: item[1][0]):
+                    if self._disk_bytes <= self.disk_max_bytes:
+                        break
+                    self._disk_remove(old_key)
+
+    def get(self, key):
+        """(stream, body) of a cached response, or None."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._mem.get(key)
+            if entry is not None:
+                if now - entry[0] <= self.ttl:
+                    self._mem.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return entry[1], entry[2]
+                self._mem.pop(key)
+                self._mem_bytes -= len(entry[2])
+        if self.disk_dir:
+            found = self._disk_get(key)
+            if found is not None:
+                with self._lock:
+                    self._mem_put(key, now, found[0], found[1])
+                    self.stats["disk_hits"] += 1
+                return found
+        with self._lock:
+            self.stats["misses"] += 1
+        return None
+
+    def put(self, key, stream, body):
+        if not _complete_response(body, stream):
+            return False
+        with self._lock:
+            self._mem_put(key, time.monotonic(), stream, body)
+            self.stats["stores"] += 1
+        if self.disk_dir:
+            self._disk_put(key, stream, body)
+        return True
+
+    def join(self, key):
+        """Single flight: (flight, True) for the request that goes upstream, (flight, False) for followers."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.stats["collapsed"] += 1
+                return flight, False
+            flight = self._flights[key] = _Flight()
+            return flight, True
+
+    def finish(self, key, flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight._finish()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._mem),
+                "bytes": self._mem_bytes,
+                "disk_entries": len(self._disk) if self._disk is not None else None,
+                "disk_bytes": self._disk_bytes if self._disk is not None else None,
+                "in_flight": len(self._flights),
+                **{k: self.stats[k] for k in ("hits", "disk_hits", "misses", "stores", "collapsed")},
+            }
+
+
+completion_cache = CompletionCache()
+
+
+# ── 嵌入请求合批 ─────────────────────────────────────────────
+
+
+def embed_batch_settings(model_name):
+    """(合批等待秒数, 单批最多条数)；等待为 0 表示不合批。models.json params 优先于环境变量。"""
+    params = _get_model_params(model_name)
+    wait_ms = params.get("embed_batch_wait_ms", EMBED_BATCH_WAIT_MS)
+    max_inputs = params.get("embed_batch_max", EMBED_BATCH_MAX)
+    return max(0.0, float(wait_ms)) / 1000.0, max(1, int(max_inputs))
+
+
+class _EmbedCall(_Flight):
+    """One caller's share of a batched embeddings request; finished with its own status and body."""
+
+    __slots__ = ("texts", "status", "body")
+
+    def __init__(self, texts):
+        super().__init__()
+        self.texts = texts
+        self.status = 502
+        self.body = b""
+
+
+class _EmbedBatch:
+    __slots__ = ("url", "base", "calls", "size")
+
+    def __init__(self, url, base):
+        self.url = url
+        self.base = base
+        self.calls = []
+        self.size = 0
+
+
+class EmbeddingBatcher:
+    """Coalesces concurrent small /v1/embeddings requests into one upstream call.
+
+    Requests for the same backend whose bodies are identical apart from
+    ``input`` (same model, task, dimensions, prompt_name, ...) are collected
+    for up to ``embed_batch_wait_ms`` or until ``embed_batch_max`` inputs,
+    sent as a single request, and the ``data`` array is split back to each
+    caller with indexes renumbered from 0.  The backend reports one token
+    count for the whole batch, so ``usage`` is apportioned by input length.
+    Requests that are already large, or whose ``input`` is not text, are
+    forwarded unchanged.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._open = {}  # (url, 去掉 input 的请求体) -> 正在收集的 _EmbedBatch
+        self.stats = collections.Counter()
+
+    @staticmethod
+    def _batch_key(ctx):
+        data = ctx.data
+        if data is None:
+            return None, None
+        texts = data.get("input")
+        if isinstance(texts, str):
+            texts = [texts]
+        if not isinstance(texts, list) or not texts or not all(isinstance(t, str) for t in texts):
+            return None, None
+        rest = {k: v for k, v in data.items() if k != "input"}
+        return json.dumps(rest, sort_keys=True, separators=(",", ":"), ensure_ascii=False), texts
+
+    def submit(self, url, model_name, ctx):
+        """Queue a request for batching: an _EmbedCall to wait on, or None to forward it as is."""
+        wait, max_inputs = embed_batch_settings(model_name)
+        if wait <= 0:
+            return None
+        key, texts = self._batch_key(ctx)
+        if key is None or len(texts) >= max_inputs:
+            return None
+        call = _EmbedCall(texts)
+        ready = []
+        with self._lock:
+            batch = self._open.get((url, key))
+            if batch is not None and batch.size + len(texts) > max_inputs:
+                ready.append(self._open.pop((url, key)))
+                batch = None
+            if batch is None:
+                batch = self._open[(url, key)] = _EmbedBatch(url, ctx.data)
+                timer = threading.Timer(wait, self._flush, ((url, key), batch))
+                timer.daemon = True
+                timer.start()
+            batch.calls.append(call)
+            batch.size += len(texts)
+            if batch.size >= max_inputs:
+                ready.append(self._open.pop((url, key)))
+        for full in ready:
+            threading.Thread(target=self._send, args=(full,), daemon=True).start()
+        return call
+
+    def _flush(self, key, batch):
+        with self._lock:
+            if self._open.get(key) is not batch:
+                return  # 已因凑满而发出
+            del self._open[key]
+        self._send(batch)
+
+    def _send(self, batch):
+        texts = [t for call in batch.calls for t in call.texts]
+        body = json.dumps({**batch.base, "input": texts}, ensure_ascii=False).encode("utf-8")
+        parts = None
+        try:
+            try:
+                pool, conn, resp = backend_request(
+                    batch.url, "POST", body, _backend_headers({}, "POST", body), API_PROXY_TIMEOUT,
+                )
+                try:
+                    status, raw = resp.status, resp.read()
+                finally:
+                    release_backend_conn(pool, conn, resp)
+            except (BackendError, OSError, http.client.HTTPException) as e:
+                status = 502
+                raw = json.dumps({"error": {"message": str(e), "type": "server_error"}}).encode("utf-8")
+            if status < 400:
+                parts = self._split(raw, batch.calls)
+                if parts is None:
+                    status = 502
+                    raw = b'{"error":{"message":"Invalid embeddings response from backend","type":"server_error"}}'
+            with self._lock:
+                self.stats["batches"] += 1
+                self.stats["requests"] += len(batch.calls)
+                self.stats["inputs"] += len(texts)
+            if len(batch.calls) > 1:
+                _log(f"[embed] 合批 {len(batch.calls)} 个请求 / {len(texts)} 条输入 → {status}")
+        finally:
+            for i, call in enumerate(batch.calls):
+                call.status = status
+                call.body = parts[i] if parts is not None else raw
+                call._finish()
+
+    @staticmethod
+    def _split(raw, calls):
+        """按调用方切分合批响应；格式不符时返回 None。"""
+        try:
+            data = json.loads(raw)
+            items = sorted(data["data"], key=lambda item: item["index"])
+        except (ValueError, UnicodeDecodeError, TypeError, KeyError):
+            return None
+        if len(items) != sum(len(call.texts) for call in calls):
+            return None
+        usage = data.get("usage") if isinstance(data.get("usage"), dict) else None
+        tokens = usage.get("prompt_tokens") if usage else None
+        chars = [sum(len(t) for t in call.texts) for call in calls]
+        total_chars = sum(chars) or 1
+        parts = []
+        offset = 0
+        tokens_left = tokens if isinstance(tokens, int) else 0
+        for i, call in enumerate(calls):
+            n = len(call.texts)
+            out = dict(data)
+            out["data"] = [dict(item, index=j) for j, item in enumerate(items[offset:offset + n])]
+            offset += n
+            if usage is not None and isinstance(tokens, int):
+                share = tokens_left if i == len(calls) - 1 else round(tokens * chars[i] / total_chars)
+                share = min(share, tokens_left)
+                tokens_left -= share
+                out["usage"] = {**usage, "prompt_tokens": share, "total_tokens": share}
+            parts.append(json.dumps(out, ensure_ascii=False).encode("utf-8"))
+        return parts
+
+    def snapshot(self):
+        with self._lock:
+            stats = {k: self.stats[k] for k in ("batches", "requests", "inputs")}
+            stats["open"] = len(self._open)
+        stats["avg_requests_per_batch"] = round(stats["requests"] / stats["batches"], 2) if stats["batches"] else None
+        return stats
+
+
+embedding_batcher = EmbeddingBatcher()
+
+
+# ── 系统资源采集（macOS 原生命令 / Linux /proc） ──────────────
+
+_system_cache = {"data": None, "ts": 0.0}
+_system_cache_lock = threading.Lock()
+
+
+def _empty_system_info():
+    return {
+        "cpu": {"user": 0, "sys": 0, "idle": 100},
+        "load_avg": [0, 0, 0],
+        "memory": {"total_gb": 0, "used_gb": 0, "free_gb": 0, "wired_gb": 0},
+        "processes": {"llama_server": [], "ollama": [], "model_servers": []},
+        "cached_at": time.time(),
+    }
+
+
+def _process_entry(result, pid, comm, rss_gb, cpu_pct, running_pids, running_ports):
+    """按进程名 / run/*.pid 归类：llama-server、Ollama、其余 run/*.pid 模型服务（Python 等）。"""
+    entry = {"pid": pid, "rss_gb": rss_gb, "cpu_pct": cpu_pct}
+    name = running_pids.get(pid)
+    if name is not None:
+        entry["port"] = running_ports.get(name)
+        entry["model"] = name
+    if "llama-server" in comm or "llama_server" in comm:
+        result["processes"]["llama_server"].append(entry)
+    elif "ollama" in comm.lower():
+        entry["comm"] = os.path.basename(comm)
+        result["processes"]["ollama"].append(entry)
+    elif name is not None:
+        entry["comm"] = os.path.basename(comm)
+        result["processes"]["model_servers"].append(entry)
+
+
+def _running_pid_maps():
+    running = get_running_models()
+    running_pids = {info["pid"]: name for name, info in running.items() if info.get("pid")}
+    running_ports = {name: info["port"] for name, info in running.items()}
+    return running_pids, running_ports
+
+
+class ProcSystemCollector:
+    """Linux system stats read straight from /proc, without subprocesses.
+
+    CPU shares (/proc/stat) and per-process CPU% (/proc/<pid>/stat) are
+    deltas against the previous collect(); a process seen for the first
+    time reports its average since start, like ``ps``.  Per-process CPU%
+    is relative to one core, as in top/ps.
+    """
+
+    def __init__(self, root="/proc"):
+        self.root = root
+        self.clk_tck = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+        self._lock = threading.Lock()
+        self._cpu = None        # 上次 /proc/stat 的 (user, sys, idle, total) 滴答数
+        self._procs = {}        # pid → (starttime, utime + stime)
+        self._at = None
+        try:
+            self._cpu = self._cpu_times()  # 首次 collect() 即为启动以来的占用，而非开机以来
+        except (OSError, ValueError):
+            pass
+
+    @staticmethod
+    def available():
+        return sys.platform.startswith("linux") and os.path.exists("/proc/stat")
+
+    def _read(self, *parts):
+        with open(os.path.join(self.root, *parts), "rb") as f:
+            return f.read()
+
+    def _cpu_times(self):
+        fields = self._read("stat").split(b"\n", 1)[0].split()[1:]
+        ticks = [int(v) for v in fields[:8]] + [0] * (8 - min(len(fields), 8))
+        user, nice, system, idle, iowait, irq, softirq, steal = ticks
+        return user + nice, system + irq + softirq + steal, idle + iowait, sum(ticks)
+
+    def _memory(self):
+        info = {}
+        for line in self._read("meminfo").splitlines():
+            key, _, rest = line.partition(b":")
+            values = rest.split()
+            if values:
+                info[key.decode()] = int(values[0])  # kB
+        kb_per_gb = 1024 * 1024
+        total = info.get("MemTotal", 0)
+        available = info.get("MemAvailable", info.get("MemFree", 0))
+        return {
+            "total_gb": round(total / kb_per_gb, 1),
+            "used_gb": round((total - available) / kb_per_gb, 1),
+            "free_gb": round(available / kb_per_gb, 1),
+            # Linux 没有 wired 内存，以不可换出的 Unevictable（含 mlock 的模型权重）近似
+            "wired_gb": round(info.get("Unevictable", 0) / kb_per_gb, 1),
+        }
+
+    def _proc_stat(self, pid):
+        """(comm, starttime, utime + stime)；进程已退出返回 None。"""
+        try:
+            raw = self._read(str(pid), "stat")
+        except OSError:
+            return None
+        # comm 在括号内且可能含空格，从最后一个 ')' 之后按空格切分
+        open_at, close_at = raw.find(b"("), raw.rfind(b")")
+        comm = raw[open_at + 1:close_at].decode("utf-8", errors="replace")
+        fields = raw[close_at + 2:].split()
+        try:
+            return comm, int(fields[19]), int(fields[11]) + int(fields[12])
+        except (IndexError, ValueError):
+            return None
+
+    def _rss_gb(self, pid):
+        try:
+            for line in self._read(str(pid), "status").splitlines():
+                if line.startswith(b"VmRSS:"):
+                    return round(int(line.split()[1]) / (1024 * 1024), 2)
+        except (OSError, ValueError, IndexError):
+            pass
+        return 0.0
+
+    def _cmdline_name(self, pid):
+        """comm 截断到 15 字节，且 Python 服务都叫 python3：用 argv[0] / 脚本名辅助识别。"""
+        try:
+            argv = self._read(str(pid), "cmdline").split(b"\0")
+        except OSError:
+            return ""
+        return " ".join(os.path.basename(a.decode("utf-8", errors="replace")) for a in argv[:2] if a)
+
+    def collect(self):
+        result = _empty_system_info()
+        now = time.monotonic()
+        try:
+            uptime = float(self._read("uptime").split()[0])
+        except (OSError, ValueError, IndexError):
+            uptime = None
+        with self._lock:
+            try:
+                cpu = self._cpu_times()
+                prev = self._cpu or (0, 0, 0, 0)
+                total = cpu[3] - prev[3]
+                if total > 0:
+                    result["cpu"] = {
+                        "user": round((cpu[0] - prev[0]) * 100 / total, 1),
+                        "sys": round((cpu[1] - prev[1]) * 100 / total, 1),
+                        "idle": round((cpu[2] - prev[2]) * 100 / total, 1),
+                    }
+                self._cpu = cpu
+            except (OSError, ValueError) as e:
+                _log(f"[system] /proc/stat 读取失败: {e}")
+            try:
+                result["load_avg"] = [float(v) for v in self._read("loadavg").split()[:3]]
+                result["memory"] = self._memory()
+            except (OSError, ValueError) as e:
+                _log(f"[system] /proc 读取失败: {e}")
+
+            running_pids, running_ports = _running_pid_maps()
+            elapsed = now - self._at if self._at is not None else None
+            procs = {}
+            try:
+                pids = [int(d) for d in os.listdir(self.root) if d.isdigit()]
+            except OSError:
+                pids = []
+            for pid in pids:
+                stat = self._proc_stat(pid)
+                if stat is None:
+                    continue
+                comm, starttime, ticks = stat
+                if pid in running_pids and "llama" not in comm and "ollama" not in comm.lower():
+                    comm = self._cmdline_name(pid) or comm
+                elif "llama-server" not in comm and "llama_server" not in comm and "ollama" not in comm.lower():
+                    continue
+                procs[pid] = (starttime, ticks)
+                seen = self._procs.get(pid)
+                if seen is not None and seen[0] == starttime and elapsed:
+                    cpu_pct = (ticks - seen[1]) / self.clk_tck / elapsed * 100
+                elif uptime is not None and uptime > starttime / self.clk_tck:
+                    cpu_pct = ticks / self.clk_tck / (uptime - starttime / self.clk_tck) * 100
+                else:
+                    cpu_pct = 0.0
+                _process_entry(result, pid, comm, self._rss_gb(pid), round(cpu_pct, 1),
+                               running_pids, running_ports)
+            self._procs = procs
+            self._at = now
+        return result
+
+
+proc_collector = ProcSystemCollector() if ProcSystemCollector.available() else None
+
+
+def _collect_system_info():
+    """Collect CPU, memory, load average and per-process stats (/proc on Linux, macOS commands otherwise)."""
+    if proc_collector is not None:
+        return proc_collector.collect()
+    return _collect_system_info_macos()
+
+
+def _collect_system_info_macos():
+    """Collect CPU, memory, load average and per-process stats via macOS commands."""
+    result = _empty_system_info()
+
+    try:
+        top_out = subprocess.run(
+            ["top", "-l", "1", "-n", "0", "-s", "0"],
+            capture_output=True, text=True, timeout=10,
+        ).stdout
+        cpu_m = re.search(
+            r"CPU usage:\s*([\d.]+)%\s*user,\s*([\d.]+)%\s*sys,\s*([\d.]+)%\s*idle",
+            top_out,
+        )
+        if cpu_m:
+            result["cpu"] = {
+                "user": float(cpu_m.group(1)),
+                "sys": float(cpu_m.group(2)),
+                "idle": float(cpu_m.group(3)),
+            }
+        load_m = re.search(
+            r"Load Avg:\s*([\d.]+),\s*([\d.]+),\s*([\d.]+)", top_out
+        )
+        if load_m:
+            result["load_avg"] = [
+                float(load_m.group(1)),
                 float(load_m.group(2)),
                 float(load_m.group(3)),
             ]
@@ -318,9 +2187,7 @@ def _collect_system_info():
     except Exception as e:
         _log(f"[system] top parse error: {e}")
 
-    running = get_running_models()
-    running_pids = {info["pid"]: name for name, info in running.items()}
-    running_ports = {name: info["port"] for name, info in running.items()}
+    running_pids, running_ports = _running_pid_maps()
 
     try:
         ps_out = subprocess.run(
@@ -339,17 +2206,7 @@ def _collect_system_info():
                 continue
             comm = " ".join(parts[3:])
             rss_gb = round(rss_kb / (1024 * 1024), 2)
-            if "llama-server" in comm or "llama_server" in comm:
-                entry = {"pid": pid, "rss_gb": rss_gb, "cpu_pct": cpu_pct}
-                if pid in running_pids:
-                    name = running_pids[pid]
-                    entry["port"] = running_ports.get(name)
-                    entry["model"] = name
-                result["processes"]["llama_server"].append(entry)
-            elif "ollama" in comm.lower():
-                result["processes"]["ollama"].append(
-                    {"pid": pid, "rss_gb": rss_gb, "cpu_pct": cpu_pct, "comm": os.path.basename(comm)}
-                )
+            _process_entry(result, pid, comm, rss_gb, cpu_pct, running_pids, running_ports)
     except Exception as e:
         _log(f"[system] ps parse error: {e}")
 
@@ -357,7 +2214,11 @@ def _collect_system_info():
 
 
 def get_system_info():
-    """Return cached system info, refreshing if older than SYSTEM_CACHE_TTL."""
+    """Return the latest system_sampler snapshot; without the sampler, cached
+    system info refreshed when older than SYSTEM_CACHE_TTL."""
+    latest = system_sampler.latest()
+    if latest is not None:
+        return latest
     now = time.monotonic()
     with _system_cache_lock:
         if _system_cache["data"] and now - _system_cache["ts"] < SYSTEM_CACHE_TTL:
@@ -369,79 +2230,245 @@ def get_system_info():
     return data
 
 
-# ── Ollama 状态采集 ────────────────────────────────────────────
+class SystemSampler:
+    """Background thread sampling system, process and gate state into a ring buffer.
 
-_ollama_cache = {"data": None, "ts": 0.0}
-_ollama_cache_lock = threading.Lock()
+    Every SERVE_UI_SAMPLE_SEC the full system info is collected once (the
+    latest snapshot is what /api/system returns, so no request ever waits
+    on top/ps or /proc) and a compact record is appended to a deque of
+    SERVE_UI_SAMPLE_HISTORY entries::
 
+        {"ts", "cpu": [user, sys, idle], "load": [1m, 5m, 15m],
+         "mem": [used_gb, free_gb, wired_gb],
+         "procs": {model or kind:pid: [rss_gb, cpu_pct]},
+         "gates": {model: [active_slots, waiting, used_kv]},
+         "global": [active, waiting]}
 
-def _fetch_ollama_status():
-    """Fetch Ollama status from its HTTP API. Returns dict or None on failure."""
-    result = {
-        "status": "offline",
-        "host": OLLAMA_HOST.replace("http://", ""),
-    }
+    ``/api/system?since=<ts>`` returns the records newer than ts.
+    """
+
+    def __init__(self, interval=SYSTEM_SAMPLE_SEC, size=SYSTEM_SAMPLE_HISTORY):
+        self.interval = interval
+        self._history = collections.deque(maxlen=max(size, 1))
+        self._latest = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None or self.interval <= 0:
+            return
+        self._thread = threading.Thread(target=self._run, name="system-sampler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            started = time.monotonic()
+            try:
+                self.sample()
+            except Exception as e:
+                _log(f"[system] 采样失败: {e}")
+            time.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def sample(self):
+        data = _collect_system_info()
+        record = self._compact(data)
+        with self._lock:
+            self._latest = data
+            self._history.append(record)
+        return record
+
+    @staticmethod
+    def _compact(data):
+        cpu, mem = data["cpu"], data["memory"]
+        procs = {}
+        for kind, entries in data["processes"].items():
+            for p in entries:
+                procs[p.get("model") or f"{kind}:{p['pid']}"] = [p["rss_gb"], p["cpu_pct"]]
+        gates = {}
+        for name, gate in list(_inference_gates.items()):
+            snap = gate.budget_snapshot()
+            gates[name] = [snap["active_slots"], snap["waiting"], snap["used"]]
+        g = get_global_gate().snapshot()
+        return {
+            "ts": round(data["cached_at"], 3),
+            "cpu": [cpu["user"], cpu["sys"], cpu["idle"]],
+            "load": data["load_avg"],
+            "mem": [mem["used_gb"], mem["free_gb"], mem["wired_gb"]],
+            "procs": procs,
+            "gates": gates,
+            "global": [g["active"], g["waiting"]],
+        }
+
+    def latest(self):
+        with self._lock:
+            return self._latest
+
+    def history(self, since):
+        """ts 严格大于 since 的记录（按时间顺序）。"""
+        with self._lock:
+            records = list(self._history)
+        start = len(records)
+        while start > 0 and records[start - 1]["ts"] > since:
+            start -= 1
+        return records[start:]
+
+
+system_sampler = SystemSampler()
+
+
+def build_system_payload(path):
+    """/api/system 响应：最新快照；带 ?since=<ts> 时附上此后的采样记录 history。"""
+    data = get_system_info()
+    query = urllib.parse.urlsplit(path).query
+    since = urllib.parse.parse_qs(query).get("since") if query else None
+    if not since:
+        return data
     try:
-        req = urllib.request.Request(OLLAMA_HOST + "/api/version", method="GET")
-        with urllib.request.urlopen(req, timeout=3) as resp:
-            ver = json.loads(resp.read())
-            result["version"] = ver.get("version", "unknown")
-            result["status"] = "running"
-    except Exception:
+        since_ts = float(since[0])
+    except ValueError:
+        since_ts = 0.0
+    return dict(data, history=system_sampler.history(since_ts), interval=system_sampler.interval)
+
+
+# ── Ollama 状态采集 ────────────────────────────────────────────
+
+def _ollama_get(path):
+    req = urllib.request.Request(OLLAMA_HOST + path, method="GET")
+    with urllib.request.urlopen(req, timeout=3) as resp:
+        return json.loads(resp.read())
+
+
+def _fetch_ollama_status():
+    """Fetch Ollama status from its HTTP API (/api/version, /api/tags and /api/ps
+    requested concurrently, so a slow daemon costs one timeout, not three)."""
+    result = {
+        "status": "offline",
+        "host": OLLAMA_HOST.replace("http://", ""),
+    }
+    replies = {}
+
+    def probe(path):
+        try:
+            replies[path] = _ollama_get(path)
+        except Exception:
+            pass
+
+    threads = [
+        threading.Thread(target=probe, args=(path,), name="ollama-probe", daemon=True)
+        for path in ("/api/version", "/api/tags", "/api/ps")
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    ver = replies.get("/api/version")
+    if not isinstance(ver, dict):
         return result
+    result["version"] = ver.get("version", "unknown")
+    result["status"] = "running"
+
+    available = []
+    tags = replies.get("/api/tags")
+    for m in (tags.get("models") or []) if isinstance(tags, dict) else []:
+        available.append({
+            "name": m.get("name", ""),
+            "size_gb": round(m.get("size", 0) / (1024**3), 1),
+            "quantization": (m.get("details") or {}).get("quantization_level", ""),
+            "family": (m.get("details") or {}).get("family", ""),
+            "parameter_size": (m.get("details") or {}).get("parameter_size", ""),
+        })
+    result["available"] = available
+
+    loaded = []
+    ps = replies.get("/api/ps")
+    for m in (ps.get("models") or []) if isinstance(ps, dict) else []:
+        entry = {
+            "name": m.get("name", ""),
+            "size_gb": round(m.get("size", 0) / (1024**3), 1),
+            "vram_gb": round(m.get("size_vram", 0) / (1024**3), 1),
+        }
+        if m.get("expires_at"):
+            entry["expires_at"] = m["expires_at"]
+        if m.get("details"):
+            entry["quantization"] = m["details"].get("quantization_level", "")
+            entry["family"] = m["details"].get("family", "")
+        loaded.append(entry)
+    result["loaded"] = loaded
 
-    try:
-        req = urllib.request.Request(OLLAMA_HOST + "/api/tags", method="GET")
-        with urllib.request.urlopen(req, timeout=3) as resp:
-            tags = json.loads(resp.read())
-        available = []
-        for m in tags.get("models", []):
-            available.append({
-                "name": m.get("name", ""),
-                "size_gb": round(m.get("size", 0) / (1024**3), 1),
-                "quantization": (m.get("details") or {}).get("quantization_level", ""),
-                "family": (m.get("details") or {}).get("family", ""),
-                "parameter_size": (m.get("details") or {}).get("parameter_size", ""),
-            })
-        result["available"] = available
-    except Exception:
-        result["available"] = []
+    return result
 
-    try:
-        req = urllib.request.Request(OLLAMA_HOST + "/api/ps", method="GET")
-        with urllib.request.urlopen(req, timeout=3) as resp:
-            ps = json.loads(resp.read())
-        loaded = []
-        for m in ps.get("models", []):
-            entry = {
-                "name": m.get("name", ""),
-                "size_gb": round(m.get("size", 0) / (1024**3), 1),
-                "vram_gb": round(m.get("size_vram", 0) / (1024**3), 1),
+
+class OllamaStatusRefresher:
+    """Background thread keeping the Ollama status fresh (stale-while-revalidate).
+
+    Every OLLAMA_CACHE_TTL seconds the daemon is probed off the request
+    path; ``latest()`` never blocks and returns the last known status with
+    ``checked_at`` (wall time of the probe it comes from) and ``age_sec``.
+    Until the first probe finishes the status is ``unknown``, which routes
+    no Ollama models; main() therefore runs one bounded ``refresh()`` (the
+    three parallel calls, 3 s timeout) before building the route table.
+    The thread starts on first use when main() has not started it.
+    """
+
+    def __init__(self, interval=OLLAMA_CACHE_TTL):
+        self.interval = interval
+        self._data = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="ollama-status", daemon=True)
+        self._thread.start()
+
+    def refresh(self):
+        """探测一次并更新状态（阻塞，最多一次请求超时）。"""
+        data = _fetch_ollama_status()
+        with self._lock:
+            self._data = data
+            self._checked_at = time.time()
+
+    def _run(self):
+        if self._checked_at is not None:
+            # main() 启动前已同步探测过一次
+            time.sleep(max(0.0, self.interval - (time.time() - self._checked_at)))
+        while True:
+            started = time.monotonic()
+            try:
+                self.refresh()
+            except Exception as e:
+                _log(f"[ollama] 状态刷新失败: {e}")
+            time.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+
+    @property
+    def checked_at(self):
+        return self._checked_at
+
+    def latest(self):
+        if self._thread is None:
+            self.start()
+        with self._lock:
+            data, checked_at = self._data, self._checked_at
+        if data is None:
+            return {
+                "status": "unknown",
+                "host": OLLAMA_HOST.replace("http://", ""),
+                "checked_at": None,
+                "age_sec": None,
             }
-            if m.get("expires_at"):
-                entry["expires_at"] = m["expires_at"]
-            if m.get("details"):
-                entry["quantization"] = m["details"].get("quantization_level", "")
-                entry["family"] = m["details"].get("family", "")
-            loaded.append(entry)
-        result["loaded"] = loaded
-    except Exception:
-        result["loaded"] = []
+        return dict(data, checked_at=round(checked_at, 3), age_sec=round(time.time() - checked_at, 1))
 
-    return result
+
+ollama_status = OllamaStatusRefresher()
 
 
 def get_ollama_status():
-    """Return cached Ollama status, refreshing if older than OLLAMA_CACHE_TTL."""
-    now = time.monotonic()
-    with _ollama_cache_lock:
-        if _ollama_cache["data"] and now - _ollama_cache["ts"] < OLLAMA_CACHE_TTL:
-            return _ollama_cache["data"]
-    data = _fetch_ollama_status()
-    with _ollama_cache_lock:
-        _ollama_cache["data"] = data
-        _ollama_cache["ts"] = now
-    return data
+    """Return the last known Ollama status immediately (refreshed in the background)."""
+    return ollama_status.latest()
 
 
 def _tcp_connect_ok(host, port, timeout=0.2):
@@ -486,14 +2513,16 @@ def _ollama_model_entry(route_name, ollama_model, cfg=None):
 
 
 def _probe_ollama_models():
-    """Register Ollama models for OpenAI-compatible routing when the daemon is online."""
-    now = time.monotonic()
+    """Register Ollama models for OpenAI-compatible routing when the daemon is online.
+
+    Recomputed only when ollama_status has a new probe result."""
+    status = get_ollama_status()
+    now = status["checked_at"]
     cache = getattr(_probe_ollama_models, "_cache", None)
-    if cache and now - cache[0] < OLLAMA_CACHE_TTL:
+    if cache and now is not None and cache[0] == now:
         return cache[1]
 
     found = {}
-    status = get_ollama_status()
     if not status or status.get("status") != "running":
         _probe_ollama_models._cache = (now, found)
         return found
@@ -541,25 +2570,245 @@ def _backend_base_url(info):
     return f"http://{host}:{info['port']}"
 
 
-def _prepare_inference_body(body, model_name):
+# ── 后端连接池（HTTP/1.1 keep-alive） ─────────────────────────
+
+
+class BackendError(Exception):
+    """连接、发送或读取后端响应头失败（区别于客户端断开）。"""
+
+    def __init__(self, exc):
+        super().__init__(str(exc))
+        self.exc = exc
+
+    @property
+    def timed_out(self):
+        return isinstance(self.exc, (socket.timeout, TimeoutError))
+
+
+class BackendConnectionPool:
+    """Idle keep-alive connections to one backend base URL.
+
+    Connections are handed out LIFO so the warmest socket is reused first.
+    Before reuse an idle socket is checked with a zero-timeout ``select``:
+    a readable idle socket means the peer closed it (or sent stray bytes),
+    so it is discarded instead of failing the next request.
+    """
+
+    def __init__(self, base_url, max_idle=BACKEND_POOL_MAX_IDLE,
+                 idle_ttl=BACKEND_POOL_IDLE_TTL):
+        parsed = urllib.parse.urlsplit(base_url)
+        self.base_url = base_url
+        self.scheme = parsed.scheme or "http"
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or (443 if self.scheme == "https" else 80)
+        self.max_idle = max(0, max_idle)
+        self.idle_ttl = idle_ttl
+        self._lock = threading.Lock()
+        self._idle = []
+        self._closed = False
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+
+    def _new_connection(self, timeout):
+        # blocksize：UploadStream 请求体每次读取并发送的大小
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.host, self.port, timeout=timeout, blocksize=RELAY_CHUNK_SIZE)
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout, blocksize=RELAY_CHUNK_SIZE)
+
+    def _is_reusable(self, conn, idle_since, now):
+        sock = conn.sock
+        if sock is None:
+            return False
+        if self.idle_ttl and now - idle_since > self.idle_ttl:
+            return False
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def get(self, timeout):
+        """Return ``(conn, reused)``; a fresh unconnected one on miss."""
+        now = time.monotonic()
+        while True:
+            with self._lock:
+                if not self._idle:
+                    self.misses += 1
+                    break
+                conn, idle_since = self._idle.pop()
+            if self._is_reusable(conn, idle_since, now):
+                conn.timeout = timeout
+                try:
+                    conn.sock.settimeout(timeout)
+                except OSError:
+                    conn.close()
+                    with self._lock:
+                        self.discarded += 1
+                    continue
+                with self._lock:
+                    self.hits += 1
+                return conn, True
+            conn.close()
+            with self._lock:
+                self.discarded += 1
+        return self._new_connection(timeout), False
+
+    def put(self, conn):
+        """Return a connection whose response has been fully read."""
+        if conn.sock is None:
+            return
+        with self._lock:
+            if not self._closed and len(self._idle) < self.max_idle:
+                self._idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            conn.close()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "idle": len(self._idle),
+                "max_idle": self.max_idle,
+                "hits": self.hits,
+                "misses": self.misses,
+                "discarded": self.discarded,
+            }
+
+
+_pools_lock = threading.Lock()
+_backend_pools: dict = {}
+_async_backend_pools: dict = {}  # asyncio 模式：仅事件循环线程写入
+
+
+def get_backend_pool(base_url):
+    with _pools_lock:
+        pool = _backend_pools.get(base_url)
+        if pool is None:
+            pool = BackendConnectionPool(base_url)
+            _backend_pools[base_url] = pool
+        return pool
+
+
+def _evict_backend_pools(live_base_urls):
+    """Close pools of backends that are no longer in the running list."""
+    keep = set(live_base_urls)
+    keep.add(OLLAMA_HOST)
+    keep.add(f"http://127.0.0.1:{int(os.environ.get('LLAMA_PORT', '8001'))}")
+    with _pools_lock:
+        stale = [url for url in _backend_pools if url not in keep]
+        pools = [_backend_pools.pop(url) for url in stale]
+    for pool in pools:
+        pool.close()
+        _log(f"[pool] 后端已下线，回收连接池 {pool.base_url}")
+    # asyncio 模式的连接池表只在事件循环线程读写：移除与关闭一起交给事件循环执行，
+    # 避免 _get_async_backend_pool 在两者之间取到即将关闭的连接池
+    for url, pool in list(_async_backend_pools.items()):
+        if url not in keep:
+            try:
+                pool.loop.call_soon_threadsafe(_evict_async_backend_pool, url, pool)
+            except RuntimeError:
+                pass
+
+
+def _evict_async_backend_pool(url, pool):
+    """（事件循环线程）移除并关闭已下线后端的 asyncio 连接池。"""
+    if _async_backend_pools.get(url) is not pool:
+        return
+    del _async_backend_pools[url]
+    pool.close()
+    _log(f"[pool] 后端已下线，回收连接池 {pool.base_url}")
+
+
+def pool_snapshots():
+    with _pools_lock:
+        pools = list(_backend_pools.values())
+    pools.extend(list(_async_backend_pools.values()))
+    return {pool.base_url: pool.snapshot() for pool in pools}
+
+
+def backend_request(url, method, body, headers, timeout, trace=None):
+    """Send a request over a pooled connection.
+
+    Returns ``(pool, conn, resp)``; pass them to ``release_backend_conn``
+    once the response is consumed.  A reused connection that the backend
+    closed while idle is retried once on a fresh connection (an UploadStream
+    body only if it can still be rewound).  Failures before the response
+    headers arrive raise ``BackendError``.
+    """
+    parts = urllib.parse.urlsplit(url)
+    base_url = f"{parts.scheme}://{parts.netloc}"
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+    pool = get_backend_pool(base_url)
+    while True:
+        conn, reused = pool.get(timeout)
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            if trace is not None:
+                trace.mark("upstream_sent")
+            resp = conn.getresponse()
+            if trace is not None:
+                trace.mark("upstream_headers")
+            return pool, conn, resp
+        except (http.client.RemoteDisconnected, BrokenPipeError,
+                ConnectionResetError) as e:
+            conn.close()
+            if reused and (not isinstance(body, UploadStream) or body.rewind()):
+                continue
+            raise BackendError(e) from e
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            raise BackendError(e) from e
+
+
+def release_backend_conn(pool, conn, resp):
+    """Return the connection to its pool if the response was fully consumed."""
+    if resp is not None and not resp.chunked and resp.length == 0:
+        # read1() 读完 Content-Length 后不会自动关闭响应对象
+        resp.close()
+    if resp is not None and resp.isclosed() and not resp.will_close:
+        pool.put(conn)
+    else:
+        conn.close()
+
+
+def backend_fetch(url, method="GET", payload=None, timeout=MONITOR_PROXY_TIMEOUT):
+    """Small proxy-internal call (tokenize, slots, ...) over the pool; returns (status, body)."""
+    headers = {}
+    api_key = load_api_key()
+    if api_key:
+        headers["Authorization"] = f"Bearer {api_key}"
+    body = None
+    if payload is not None:
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        headers["Content-Type"] = "application/json"
+    pool, conn, resp = backend_request(url, method, body, headers, timeout)
+    try:
+        return resp.status, resp.read()
+    finally:
+        release_backend_conn(pool, conn, resp)
+
+
+def _prepare_inference_body(ctx, model_name):
     """Rewrite request body for backend-specific model ids (e.g. Ollama tag names)."""
-    if not body:
-        return body
+    if not ctx.body:
+        return ctx.body
     models = get_running_models()
     info = models.get(model_name)
     if not info or not info.get("ollama"):
-        return body
+        return ctx.body
     ollama_model = info.get("ollama_model")
     if not ollama_model:
-        return body
-    try:
-        data = json.loads(body)
-    except (json.JSONDecodeError, UnicodeDecodeError, TypeError):
-        return body
-    if data.get("model") == ollama_model:
-        return body
-    data["model"] = ollama_model
-    return json.dumps(data, ensure_ascii=False).encode("utf-8")
+        return ctx.body
+    return ctx.replace_model(ollama_model)
 
 
 def _probe_external_json_models():
@@ -598,319 +2847,1629 @@ def _probe_external_json_models():
             "external": True,
         }
 
-    _probe_external_json_models._cache = (now, found)
-    return found
+    _probe_external_json_models._cache = (now, found)
+    return found
+
+
+class _RouteIndex:
+    """One kind's view of the route table with O(1) model-id lookups."""
+
+    __slots__ = ("models", "by_alias", "by_ollama_model", "order", "replicas")
+
+    def __init__(self, models):
+        self.models = models
+        self.by_alias = {}
+        self.by_ollama_model = {}
+        self.order = {}
+        self.replicas = {}  # alias -> 同 alias 的全部路由名（按路由表顺序）
+        for pos, (name, info) in enumerate(models.items()):
+            self.order[name] = pos
+            if info.get("model") is not None:
+                self.by_alias.setdefault(info["model"], name)
+                self.replicas.setdefault(info["model"], []).append(name)
+            if info.get("ollama_model"):
+                self.by_ollama_model.setdefault(info["ollama_model"], name)
+
+    def lookup(self, requested):
+        """Same precedence as the old linear scan: the earliest route whose
+        ollama_model or alias matches, then an exact route name."""
+        hits = [
+            name for name in (
+                self.by_ollama_model.get(requested), self.by_alias.get(requested)
+            ) if name is not None
+        ]
+        if hits:
+            return min(hits, key=self.order.__getitem__)
+        if requested in self.models:
+            return requested
+        return None
+
+
+class _RouteTable:
+    """Immutable snapshot published by RouteRegistry; replaced wholesale on change."""
+
+    __slots__ = ("models", "kinds", "built_at")
+
+    def __init__(self, models, types):
+        self.models = models
+        split = {"chat": {}, "embedding": {}, "asr": {}}
+        for name, info in models.items():
+            typ = types.get(name, "chat")
+            split[typ if typ in ("embedding", "asr") else "chat"][name] = info
+        self.kinds = {kind: _RouteIndex(m) for kind, m in split.items()}
+        self.built_at = time.monotonic()
+
+
+class RouteRegistry:
+    """In-memory route table kept fresh by a background watcher thread.
+
+    The watcher re-reads a run/*.pid file only when the directory or the file
+    mtime changes, re-checks process liveness with ``os.kill(pid, 0)`` on every
+    tick, merges the external/Ollama probe results and publishes a new
+    ``_RouteTable`` only when something changed.  Request handlers just read
+    the current table: no filesystem syscalls on the hot path.
+    """
+
+    def __init__(self, run_dir, interval=ROUTE_REFRESH_SEC):
+        self.run_dir = run_dir
+        self.interval = interval
+        self._refresh_lock = threading.Lock()
+        self._table = None
+        self._dir_mtime = None
+        self._pid_names = []
+        self._pid_cache = {}  # fname -> (mtime_ns, (pid, port, model) | None)
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self.refresh()
+        self._thread = threading.Thread(target=self._run, name="route-watcher", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                _log(f"[routes] 刷新失败: {e}")
+
+    def table(self):
+        table = self._table
+        if table is None or (
+            self._thread is None and time.monotonic() - table.built_at >= self.interval
+        ):
+            # 未启动 watcher（如被脚本直接 import）时退化为按需刷新
+            self.refresh()
+            table = self._table
+        return table
+
+    def _read_pid_file(self, fname):
+        fpath = os.path.join(self.run_dir, fname)
+        try:
+            mtime = os.stat(fpath).st_mtime_ns
+        except FileNotFoundError:
+            self._pid_cache.pop(fname, None)
+            return None
+        cached = self._pid_cache.get(fname)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        entry = None
+        try:
+            with open(fpath) as f:
+                lines = f.read().strip().split("\n")
+            pid = int(lines[0].strip())
+            port = int(lines[1].strip()) if len(lines) > 1 else 8001
+            name = fname[:-4]
+            model = lines[2].strip() if len(lines) > 2 else name
+            entry = (pid, port, model or name)
+        except (ValueError, IndexError, FileNotFoundError):
+            pass
+        self._pid_cache[fname] = (mtime, entry)
+        return entry
+
+    def _scan_pid_files(self):
+        models = {}
+        try:
+            dir_mtime = os.stat(self.run_dir).st_mtime_ns
+        except FileNotFoundError:
+            self._dir_mtime = None
+            self._pid_names = []
+            self._pid_cache.clear()
+            return models
+        if dir_mtime != self._dir_mtime:
+            self._dir_mtime = dir_mtime
+            self._pid_names = sorted(
+                f for f in os.listdir(self.run_dir) if f.endswith(".pid")
+            )
+            for stale in set(self._pid_cache) - set(self._pid_names):
+                del self._pid_cache[stale]
+        for fname in self._pid_names:
+            entry = self._read_pid_file(fname)
+            if entry is None:
+                continue
+            pid, port, model = entry
+            try:
+                os.kill(pid, 0)
+            except OSError:
+                try:
+                    os.remove(os.path.join(self.run_dir, fname))
+                except FileNotFoundError:
+                    pass
+                continue
+            models[fname[:-4]] = {"pid": pid, "port": port, "model": model}
+        return models
+
+    def refresh(self):
+        with self._refresh_lock:
+            models = self._scan_pid_files()
+
+            for name, info in _probe_external_json_models().items():
+                if name not in models:
+                    models[name] = info
+
+            for name, info in _probe_ollama_models().items():
+                if name not in models:
+                    models[name] = info
+
+            mj = _load_models_json()
+            types = {
+                name: ((mj.get(name) or {}).get("type") or "chat") for name in models
+            }
+            old = self._table
+            if old is not None and old.models == models and all(
+                name in old.kinds[t if t in ("embedding", "asr") else "chat"].models
+                for name, t in types.items()
+            ):
+                old.built_at = time.monotonic()
+                return
+            self._table = _RouteTable(models, types)
+            if old is not None:
+                added = models.keys() - old.models.keys()
+                removed = old.models.keys() - models.keys()
+                if added or removed:
+                    _log(f"[routes] 路由表更新 +{sorted(added)} -{sorted(removed)}")
+        _evict_backend_pools(_backend_base_url(info) for info in models.values())
+
+
+route_registry = RouteRegistry(RUN_DIR)
+
+
+def get_running_models():
+    """运行中的模型列表（run/*.pid + models.json 外部后端 + Ollama），来自内存路由表。
+    返回 {name: {pid, port, model, host?}}；调用方不得修改返回的 dict。"""
+    return route_registry.table().models
+
+
+def get_default_port():
+    """获取默认后端端口（第一个运行中的模型，或 8001）"""
+    models = get_running_models()
+    if models:
+        first = next(iter(models.values()))
+        return first["port"]
+    return int(os.environ.get("LLAMA_PORT", "8001"))
+
+
+def resolve_api_backend(api_path):
+    """解析 /api 之后的路径，返回 (backend_url, remaining_path, model_name)"""
+    stripped = api_path.lstrip("/")
+    if stripped == "models":
+        return None, "models", None
+    if stripped.split("?", 1)[0] == "system":
+        return None, "system", None
+    if stripped == "stream":
+        return None, "stream", None
+
+    parts = stripped.split("/", 1)
+    if parts[0] == "ollama":
+        remaining = "/" + parts[1] if len(parts) > 1 else "/"
+        return OLLAMA_HOST, remaining, None
+
+    models = get_running_models()
+    if len(parts) >= 1 and parts[0] in models:
+        model_name = parts[0]
+        remaining = "/" + parts[1] if len(parts) > 1 else "/"
+        return _backend_base_url(models[model_name]), remaining, model_name
+
+    if models:
+        default_name = next(iter(models))
+        return (
+            _backend_base_url(models[default_name]),
+            api_path,
+            default_name,
+        )
+    port = int(os.environ.get("LLAMA_PORT", "8001"))
+    return f"http://127.0.0.1:{port}", api_path, None
+
+
+def default_backend_url():
+    """第一个运行中模型的后端地址，无运行中模型时回落到 LLAMA_PORT。"""
+    models = get_running_models()
+    if models:
+        default_name = next(iter(models))
+        return _backend_base_url(models[default_name])
+    port = int(os.environ.get("LLAMA_PORT", "8001"))
+    return f"http://127.0.0.1:{port}"
+
+
+def _resolve_model_from_body(ctx, embedding_only=False, asr_only=False):
+    """从请求体的 model 字段匹配运行中后端，返回 (model_name, backend_url)。
+    匹配顺序：alias 精确匹配 → 短名精确匹配 → 默认第一个。
+    embedding_only=True 时只在 models.json 类型为 embedding 的后端中解析。
+    asr_only=True 时只在 type=asr 的后端中解析。"""
+    kind = "embedding" if embedding_only else "asr" if asr_only else "chat"
+    return _resolve_requested_model(ctx.model, kind, ctx.messages if kind == "chat" else None)
+
+
+def _resolve_requested_model(requested, kind="chat", messages=None):
+    routes = route_registry.table().kinds[kind]
+    if not routes.models:
+        return None, None
+    return _pick_model_backend(routes, requested, messages)
+
+
+def _resolve_model_from_multipart(body, content_type, asr_only=False):
+    """从 multipart/form-data 中提取 model 字段并匹配 ASR 后端。"""
+    requested = None
+    if body and content_type.lower().startswith("multipart/form-data"):
+        requested = _extract_multipart_field(body, content_type, "model")
+    return _resolve_requested_model(requested, "asr" if asr_only else "chat")
+
+
+def _pick_model_backend(routes, requested, messages=None):
+    """routes: _RouteIndex；按 alias/ollama_model/运行名索引直接命中，未匹配则取第一个。
+    同一 alias 有多个副本且 REPLICA_ROUTING=prefix 时，按对话前缀选副本（PrefixAffinityRouter）。"""
+    name = routes.lookup(requested) if isinstance(requested, str) and requested else None
+    if name is None:
+        name = next(iter(routes.models))
+    if messages and REPLICA_ROUTING == "prefix":
+        alias = routes.models[name].get("model")
+        replicas = routes.replicas.get(alias)
+        if replicas and len(replicas) > 1:
+            name = affinity_router.pick(alias, replicas, messages)
+    return name, _backend_base_url(routes.models[name])
+
+
+class PrefixAffinityRouter:
+    """Keeps the turns of a conversation on the replica that holds its prompt cache.
+
+    A request is keyed by hashes of its leading messages: the prefix up to
+    the first user message, up to the second, ... up to
+    ROUTE_AFFINITY_TURNS user messages.  Every later turn of a conversation
+    starts with the same messages, so its keys include the earlier turns'.
+    The replica that last served a key is remembered (LRU of
+    ROUTE_AFFINITY_ENTRIES keys) and the longest remembered key wins;
+    a conversation never seen before is placed by rendezvous hashing of its
+    first key, which spreads conversations evenly and keeps most of them in
+    place when replicas come and go.
+
+    When the preferred replica is saturated (ModelBudgetGate.load() >= 1:
+    every slot busy or requests already queued) the request spills over to
+    the least-loaded replica, which then becomes the remembered one.
+    """
+
+    def __init__(self, max_entries=ROUTE_AFFINITY_ENTRIES, turns=ROUTE_AFFINITY_TURNS):
+        self.max_entries = max_entries
+        self.turns = max(1, turns)
+        self._lock = threading.Lock()
+        self._owners = collections.OrderedDict()  # prefix key -> replica name
+        self._stats = collections.defaultdict(collections.Counter)  # alias -> hits/new/spills
+
+    def keys(self, messages):
+        """Prefix keys, shortest first: one per user message, at most ``turns``."""
+        keys = []
+        h = hashlib.blake2b(digest_size=16)
+        for msg in messages:
+            if not isinstance(msg, dict):
+                continue
+            role = msg.get("role") if isinstance(msg.get("role"), str) else ""
+            h.update(role.encode("utf-8", errors="replace"))
+            h.update(b"\0")
+            h.update(_message_text(msg).encode("utf-8", errors="replace"))
+            h.update(b"\0")
+            if role == "user":
+                keys.append(h.copy().digest())
+                if len(keys) >= self.turns:
+                    break
+        return keys
+
+    @staticmethod
+    def _load(name):
+        gate = _inference_gates.get(name)
+        return gate.load() if gate is not None else 0.0
+
+    def pick(self, alias, replicas, messages):
+        keys = self.keys(messages)
+        if not keys:
+            return replicas[0]
+        with self._lock:
+            preferred = next(
+                (self._owners[k] for k in reversed(keys) if self._owners.get(k) in replicas), None
+            )
+        outcome = "hits"
+        if preferred is None:
+            outcome = "new"
+            preferred = max(
+                replicas, key=lambda name: hashlib.blake2b(keys[0] + name.encode("utf-8"), digest_size=8).digest()
+            )
+        chosen = preferred
+        load = self._load(preferred)
+        if load >= 1:
+            spill = min(replicas, key=self._load)
+            if self._load(spill) < load:
+                chosen = spill
+                outcome = "spills"
+        with self._lock:
+            self._stats[alias][outcome] += 1
+            for k in keys:
+                self._owners[k] = chosen
+                self._owners.move_to_end(k)
+            while len(self._owners) > self.max_entries:
+                self._owners.popitem(last=False)
+        return chosen
+
+    def snapshot(self):
+        with self._lock:
+            groups = {}
+            for alias, c in self._stats.items():
+                seen = c["hits"] + c["spills"]
+                groups[alias] = {
+                    "hits": c["hits"],
+                    "spills": c["spills"],
+                    "new": c["new"],
+                    "hit_rate": round(c["hits"] / seen, 3) if seen else None,
+                }
+            return {"mode": REPLICA_ROUTING, "entries": len(self._owners), "groups": groups}
+
+
+affinity_router = PrefixAffinityRouter()
+
+
+# ── 推理请求队列（KV 预算感知） ──────────────────────────────────
+
+
+QUEUE_POLICIES = ("fifo", "sjf", "edf")
+LANES = ("interactive", "default", "batch")
+LANE_RANK = {lane: rank for rank, lane in enumerate(LANES)}
+
+
+def _lane_reservations(value):
+    """"interactive=1,default=0" 或 {"interactive": 1} → {lane: 数值}；未知 lane 忽略。"""
+    if isinstance(value, str):
+        pairs = (item.split("=", 1) for item in value.split(",") if "=" in item)
+        value = {k.strip(): v.strip() for k, v in pairs}
+    result = {}
+    for lane, amount in (value or {}).items():
+        if lane not in LANE_RANK:
+            continue
+        try:
+            result[lane] = max(0.0, float(amount))
+        except (TypeError, ValueError):
+            continue
+    return result
+
+
+def _lane_caps(total, reserved, minimum):
+    """每个 lane 可用的容量上限：total 减去更高优先级 lane 的预留，不低于 minimum。"""
+    caps = []
+    held = 0
+    for lane in LANES:
+        caps.append(max(minimum, total - held))
+        held += reserved.get(lane, 0)
+    return caps
+
+
+SHED_MESSAGE = "推理队列已满，已让位于更高优先级请求，请稍后重试"
+
+
+class _GateWaiter:
+    """One queued acquire, granted by the gate in lane + policy order.
+
+    Thread waiters block on ``wait()``; the asyncio engine passes a
+    ``callback`` that is fired (from the releasing thread) once the waiter is
+    granted or shed.  ``member`` is the gate holding the grant: the gate
+    itself, or for a ReplicaGroup the replica's ModelBudgetGate.
+    """
+
+    __slots__ = ("estimated_kv", "deadline", "lane", "key", "granted", "cancelled", "shed",
+                 "member", "_event", "_callback")
+
+    def __init__(self, estimated_kv, deadline, lane, key, callback=None):
+        self.estimated_kv = estimated_kv
+        self.deadline = deadline
+        self.lane = lane
+        self.key = key
+        self.granted = False
+        self.cancelled = False
+        self.shed = False
+        self.member = None
+        self._callback = callback
+        self._event = threading.Event() if callback is None else None
+
+    def wait(self, timeout=None):
+        """Block until granted or shed; False on timeout."""
+        return self._event.wait(timeout)
+
+    def _wake(self):
+        if self._event is not None:
+            self._event.set()
+        else:
+            self._callback()
+
+
+class _LaneGate:
+    """Wait queue shared by the inference gates.
+
+    Waiters are ordered by priority lane (interactive → default → batch) and
+    then by ``queue_policy``: ``fifo`` (arrival order), ``sjf`` (smallest
+    estimated KV first) or ``edf`` (earliest client deadline first, requests
+    without a deadline last).  Capacity is handed out head-first: a release
+    grants queued requests in order until the head no longer fits, so a
+    request is never overtaken by a later, lower-ranked one and only the
+    waiters actually granted are woken.  Slots reserved for a lane can only
+    be used by that lane and the lanes above it.  Admissions, queueing,
+    releases and sheds are reported to monitor_hub (/api/stream).
+    """
+
+    def __init__(self, max_slots, queue_policy="fifo", reserved_slots=None):
+        self.max_slots = max(1, int(max_slots))
+        self.queue_policy = queue_policy if queue_policy in QUEUE_POLICIES else "fifo"
+        self.reserved_slots = {
+            lane: int(n) for lane, n in _lane_reservations(reserved_slots).items() if n
+        }
+        # 最低优先级 lane 至少保留 1 个槽位
+        self._slot_caps = _lane_caps(self.max_slots, self.reserved_slots, 1)
+        self.name = ""             # gate 名称（/api/stream 事件中的 gate 字段）
+        self._lock = threading.Lock()
+        self._active_slots = 0
+        self._lane_active = collections.Counter()
+        self._waiters = []  # heap of (key, _GateWaiter)
+        self._waiting = 0
+        self._seq = 0
+
+    @property
+    def active_slots(self):
+        return self._active_slots
+
+    def _set_max_slots(self, max_slots):
+        """Resize the slot pool (caller holds the lock)."""
+        self.max_slots = max(1, int(max_slots))
+        self._slot_caps = _lane_caps(self.max_slots, self.reserved_slots, 1)
+
+    def _fits(self, estimated_kv, lane):
+        return self._active_slots < self._slot_caps[LANE_RANK[lane]]
+
+    def _take(self, estimated_kv, lane):
+        self._active_slots += 1
+        self._lane_active[lane] += 1
+        monitor_hub.gate_event("admit", self, lane)
+
+    def _give_back(self, estimated_kv, lane):
+        self._active_slots = max(0, self._active_slots - 1)
+        self._lane_active[lane] = max(0, self._lane_active[lane] - 1)
+        monitor_hub.gate_event("release", self, lane)
+
+    def _key(self, estimated_kv, deadline, lane):
+        self._seq += 1
+        rank = LANE_RANK[lane]
+        if self.queue_policy == "sjf":
+            return (rank, estimated_kv, self._seq)
+        if self.queue_policy == "edf":
+            return (rank, deadline if deadline is not None else float("inf"), self._seq)
+        return (rank, self._seq)
+
+    def _head(self):
+        while self._waiters and self._waiters[0][1].cancelled:
+            heapq.heappop(self._waiters)
+        return self._waiters[0][1] if self._waiters else None
+
+    def _dispatch(self):
+        """Grant queued waiters head-first while they fit; returns those to wake."""
+        woken = []
+        while True:
+            head = self._head()
+            if head is None or not self._fits(head.estimated_kv, head.lane):
+                return woken
+            heapq.heappop(self._waiters)
+            self._waiting -= 1
+            self._take(head.estimated_kv, head.lane)
+            head.granted = True
+            head.member = self
+            woken.append(head)
+
+    def _shed_below(self, lane):
+        """Drop the lowest-ranked waiter of a lane below ``lane`` (caller holds the lock)."""
+        rank = LANE_RANK[lane]
+        victim = None
+        for key, waiter in self._waiters:
+            if waiter.cancelled or key[0] <= rank:
+                continue
+            if victim is None or key > victim.key:
+                victim = waiter
+        if victim is not None:
+            victim.cancelled = True
+            victim.shed = True
+            self._waiting -= 1
+            monitor_hub.gate_event("shed", self, victim.lane)
+        return victim
+
+    def acquire_nonblocking(self, estimated_kv=0, deadline=None, lane="default"):
+        """Non-blocking acquire: the gate holding the grant (see _GateWaiter.member),
+        or None unless it fits and no queued request ranks ahead."""
+        with self._lock:
+            head = self._head()
+            if head is not None and head.key < self._key(estimated_kv, deadline, lane):
+                return None
+            if self._fits(estimated_kv, lane):
+                self._take(estimated_kv, lane)
+                return self
+            return None
+
+    def enqueue(self, estimated_kv=0, deadline=None, lane="default", callback=None):
+        """Join the wait queue; the returned waiter may already be granted.
+
+        deadline is a ``time.monotonic()`` value (used by ``edf``).  The caller
+        must ``cancel()`` a waiter it stops waiting for.
+        """
+        with self._lock:
+            key = self._key(estimated_kv, deadline, lane)
+            waiter = _GateWaiter(estimated_kv, deadline, lane, key, callback)
+            heapq.heappush(self._waiters, (key, waiter))
+            self._waiting += 1
+            woken = self._dispatch()
+            if not waiter.granted:
+                monitor_hub.gate_event("queue", self, lane)
+        for w in woken:
+            w._wake()
+        return waiter
+
+    def cancel(self, waiter):
+        """Leave the queue; a grant that raced with the cancel is returned to the pool."""
+        with self._lock:
+            if waiter.granted:
+                self._give_back(waiter.estimated_kv, waiter.lane)
+                waiter.granted = False
+                waiter.cancelled = True
+            elif not waiter.cancelled:
+                waiter.cancelled = True
+                self._waiting -= 1
+            woken = self._dispatch()
+        for w in woken:
+            w._wake()
+
+    def _release(self, estimated_kv, lane):
+        with self._lock:
+            self._give_back(estimated_kv, lane)
+            woken = self._dispatch()
+        for w in woken:
+            w._wake()
+
+    def _lane_snapshot(self):
+        waiting = collections.Counter(
+            w.lane for _, w in self._waiters if not w.cancelled
+        )
+        return {
+            lane: {
+                "active": self._lane_active[lane],
+                "waiting": waiting[lane],
+                "slot_cap": self._slot_caps[LANE_RANK[lane]],
+            }
+            for lane in LANES
+        }
+
+
+class _QueuedGate(_LaneGate):
+    """_LaneGate with a bounded request queue (see ``enter_queue``)."""
+
+    def __init__(self, max_slots, queue_policy="fifo", reserved_slots=None,
+                 max_queue_depth=MAX_QUEUE_DEPTH):
+        super().__init__(max_slots, queue_policy, reserved_slots)
+        self.max_queue_depth = max(1, int(max_queue_depth))
+        self._queue_depth = 0
+
+    @property
+    def queue_depth(self):
+        return self._queue_depth
+
+    def enter_queue(self, lane="default"):
+        """Admit a request into the model queue.
+
+        Returns False when the queue is full and nothing of a lower lane is
+        queued; otherwise the lowest-priority lower-lane waiter (if the queue
+        was full) is shed and woken.
+        """
+        with self._lock:
+            victim = None
+            if self._queue_depth >= self.max_queue_depth:
+                victim = self._shed_below(lane)
+                if victim is None:
+                    return False
+            self._queue_depth += 1
+            woken = self._dispatch() if victim is not None else []
+        if victim is not None:
+            victim._wake()
+        for w in woken:
+            w._wake()
+        return True
+
+    def leave_queue(self):
+        with self._lock:
+            self._queue_depth = max(0, self._queue_depth - 1)
+
+
+class ModelBudgetGate(_QueuedGate):
+    """Per-model KV budget pool with concurrency control.
+
+    Replaces the old Semaphore(1)-based InferenceGate.  Allows up to
+    ``max_slots`` concurrent requests as long as the sum of their
+    estimated KV token usage stays within ``total_budget``.  Queueing,
+    lanes and policies come from _LaneGate; ``reserved_kv_ratio`` keeps a
+    share of the KV budget for higher lanes, like ``reserved_slots``.
+
+    When the queue is full an arrival sheds the lowest-priority queued
+    request of a lower lane (which gets 429) instead of being rejected.
+
+    With live backend state (``update_live``, fed by BackendStatePoller) the
+    slot count is the one llama-server reports, and slots / KV the backend
+    spends on requests that did not pass this gate (direct clients, work
+    still finishing) are counted on top of the gate's own estimates.
+    """
+
+    def __init__(self, model_name, ctx_size=131072, max_slots=1,
+                 kv_budget_ratio=0.9, queue_policy="fifo", max_queue_depth=MAX_QUEUE_DEPTH,
+                 reserved_slots=None, reserved_kv_ratio=None):
+        super().__init__(max_slots, queue_policy, reserved_slots, max_queue_depth)
+        self.model_name = model_name
+        self.name = model_name
+        self.ctx_size = ctx_size
+        self.group = None          # ReplicaGroup this replica belongs to, if any
+        self.total_budget = int(ctx_size * kv_budget_ratio)
+        self.reserved_kv = {
+            lane: int(self.total_budget * min(ratio, 1.0))
+            for lane, ratio in _lane_reservations(reserved_kv_ratio).items() if ratio
+        }
+        self._budget_caps = _lane_caps(self.total_budget, self.reserved_kv, 0)
+        self._used_budget = 0
+        self._live = None          # BackendLiveState of the last successful poll
+        self._outside_slots = 0    # backend slots busy beyond this gate's admissions
+        self._outside_kv = 0
+
+    @property
+    def used_budget(self):
+        return self._used_budget
+
+    def _fits(self, estimated_kv, lane):
+        rank = LANE_RANK[lane]
+        if self._active_slots + self._outside_slots >= self._slot_caps[rank]:
+            return False
+        if self._used_budget + self._outside_kv + estimated_kv <= self._budget_caps[rank]:
+            return True
+        # First request always allowed to avoid deadlock
+        return self._active_slots == 0
+
+    def _take(self, estimated_kv, lane):
+        super()._take(estimated_kv, lane)
+        self._used_budget += estimated_kv
+
+    def _give_back(self, estimated_kv, lane):
+        super()._give_back(estimated_kv, lane)
+        self._used_budget = max(0, self._used_budget - estimated_kv)
+
+    def acquire(self, estimated_kv, timeout=None, deadline=None, lane="default"):
+        """Queue for a slot with the given KV budget.
+
+        Returns True if acquired, False on timeout or when shed.
+        """
+        waiter = self.enqueue(estimated_kv, deadline, lane)
+        if waiter.wait(timeout) and waiter.granted:
+            return True
+        self.cancel(waiter)
+        return False
+
+    def release(self, estimated_kv, lane="default"):
+        self._release(estimated_kv, lane)
+        if self.group is not None:
+            self.group.kick()
+
+    def cancel(self, waiter):
+        super().cancel(waiter)
+        if self.group is not None:
+            self.group.kick()
+
+    def balance_key(self):
+        """ReplicaGroup order: fewest outstanding requests, then most free KV budget."""
+        outstanding = self._active_slots + self._outside_slots + self._waiting
+        return outstanding, self._used_budget + self._outside_kv - self.total_budget
+
+    def load(self):
+        """Outstanding requests per slot: (active + outside + waiting) / max_slots; >= 1 means saturated."""
+        return (self._active_slots + self._outside_slots + self._waiting) / self.max_slots
+
+    def update_live(self, state):
+        """Apply one backend poll; ``None`` (unreachable / unsupported) falls back to estimates only.
+
+        Busy slots beyond the gate's own admissions count as outside load.
+        The backend's KV usage only counts when there is such outside load:
+        idle slots keep their prompt cache, which llama-server reuses freely.
+        """
+        resized = None
+        with self._lock:
+            self._live = state
+            if state is None:
+                self._outside_slots = 0
+                self._outside_kv = 0
+            else:
+                if state.n_slots and state.n_slots != self.max_slots:
+                    resized = (self.max_slots, state.n_slots)
+                    self._set_max_slots(state.n_slots)
+                self._outside_slots = max(0, state.busy_slots - self._active_slots)
+                kv_used = int(state.kv_usage_ratio * self.ctx_size) if state.kv_usage_ratio is not None else 0
+                self._outside_kv = max(0, kv_used - self._used_budget) if self._outside_slots else 0
+            woken = self._dispatch()
+        for w in woken:
+            w._wake()
+        if self.group is not None:
+            self.group.kick()
+        if resized:
+            _log(f"[budget] {self.model_name} 后端 /slots 报告 {resized[1]} 个槽位（原 {resized[0]}）")
+
+    def grow(self, extra_kv):
+        """Add to the KV held by an admitted request (see KvLease).
+
+        Never blocks or refuses: the backend is already generating, so the
+        budget may go over ``total_budget`` and later arrivals simply wait
+        until enough is released.
+        """
+        with self._lock:
+            self._used_budget += extra_kv
+
+    def budget_snapshot(self):
+        """Return a dict describing current budget state."""
+        with self._lock:
+            return {
+                "total": self.total_budget,
+                "used": self._used_budget,
+                "active_slots": self._active_slots,
+                "max_slots": self.max_slots,
+                "queue_depth": self._queue_depth,
+                "max_queue_depth": self.max_queue_depth,
+                "waiting": self._waiting,
+                "queue_policy": self.queue_policy,
+                "incremental_kv": incremental_kv_enabled(self.model_name),
+                "backend": None if self._live is None else dict(
+                    self._live.snapshot(),
+                    outside_slots=self._outside_slots,
+                    outside_kv=self._outside_kv,
+                ),
+                "calibration": kv_calibrator.snapshot(self.model_name),
+                "lanes": {
+                    lane: dict(info, budget_cap=self._budget_caps[LANE_RANK[lane]])
+                    for lane, info in self._lane_snapshot().items()
+                },
+            }
+
+
+def incremental_kv_enabled(model_name):
+    """models.json params.incremental_kv 优先，其次 KV_INCREMENTAL。"""
+    value = _get_model_params(model_name).get("incremental_kv", KV_INCREMENTAL)
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes")
+    return bool(value)
+
+
+class KvLease:
+    """The KV budget one admitted request holds on its ModelBudgetGate.
+
+    A plain lease holds ``prompt + max_tokens`` until released.  An
+    incremental lease (streaming requests, see incremental_kv_enabled) is
+    admitted with the prompt plus KV_GEN_ALLOWANCE; ``feed()`` counts the
+    streamed events (about one token each) and grows the hold by
+    KV_GROW_STEP whenever fewer than a quarter step of headroom is left,
+    never beyond ``prompt + max_tokens``.
+
+    ``release()`` is idempotent: the stream relay releases as soon as the
+    backend finishes, and the handler's ``finally`` covers every other path.
+    """
+
+    __slots__ = ("gate", "lane", "kv", "ceiling", "prompt", "generated", "incremental", "released")
+
+    def __init__(self, gate, estimated_kv, max_tokens, lane="default", incremental=False):
+        self.gate = gate
+        self.lane = lane
+        self.ceiling = estimated_kv
+        self.prompt = estimated_kv - max_tokens
+        self.kv = estimated_kv
+        if incremental:
+            self.kv = min(estimated_kv, self.prompt + KV_GEN_ALLOWANCE)
+        self.incremental = self.kv < self.ceiling
+        self.generated = 0
+        self.released = False
+
+    def feed(self, chunk):
+        if not self.incremental or self.released:
+            return
+        # SSE 事件（OpenAI 兼容）或 NDJSON 行（Ollama /api/chat）各约一个 token
+        self.generated += chunk.count(b"data:") + chunk.count(b'"done":')
+        if self.prompt + self.generated < self.kv - KV_GROW_STEP // 4:
+            return
+        extra = min(KV_GROW_STEP, self.ceiling - self.kv)
+        self.kv += extra
+        self.incremental = self.kv < self.ceiling
+        self.gate.grow(extra)
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.gate.release(self.kv, self.lane)
+
+
+class ReplicaGroup(_QueuedGate):
+    """Admission for several replicas (run/*.pid entries) of one alias.
+
+    One wait queue, with the lanes, ``queue_policy`` and shedding of a
+    ModelBudgetGate, feeds every replica, while each replica keeps its own
+    ModelBudgetGate for its slots and KV budget.  A request is admitted on
+    the replica with the fewest outstanding requests that has room for it,
+    ties going to the most free KV budget (ModelBudgetGate.balance_key).
+    Requests pinned to one replica queue on that replica's gate and rank
+    ahead of the group there.  Releases, cancels and backend polls on any
+    replica re-run the group queue (``kick``); the group lock is always
+    taken before a replica's.
+    """
+
+    def __init__(self, alias, queue_policy="fifo", max_queue_depth=MAX_QUEUE_DEPTH):
+        super().__init__(1, queue_policy, None, max_queue_depth)
+        self.alias = alias
+        self.name = alias
+        self.replica_queue_depth = self.max_queue_depth
+        self.members = []
+
+    def set_members(self, members):
+        with self._lock:
+            for member in self.members:
+                if member not in members:
+                    member.group = None
+            for member in members:
+                member.group = self
+            self.members = list(members)
+            self.max_slots = sum(m.max_slots for m in members)
+            self.max_queue_depth = self.replica_queue_depth * max(1, len(members))
+        self.kick()
+
+    def _admit(self, estimated_kv, deadline, lane):
+        """Grant on the best replica that has room; caller holds the group lock."""
+        for member in sorted(self.members, key=ModelBudgetGate.balance_key):
+            if member.acquire_nonblocking(estimated_kv, deadline, lane):
+                return member
+        return None
+
+    def _dispatch(self):
+        woken = []
+        while True:
+            head = self._head()
+            if head is None:
+                return woken
+            member = self._admit(head.estimated_kv, head.deadline, head.lane)
+            if member is None:
+                return woken
+            heapq.heappop(self._waiters)
+            self._waiting -= 1
+            head.granted = True
+            head.member = member
+            woken.append(head)
+
+    def kick(self):
+        with self._lock:
+            woken = self._dispatch()
+        for w in woken:
+            w._wake()
+
+    def acquire_nonblocking(self, estimated_kv=0, deadline=None, lane="default"):
+        with self._lock:
+            head = self._head()
+            if head is not None and head.key < self._key(estimated_kv, deadline, lane):
+                return None
+            return self._admit(estimated_kv, deadline, lane)
+
+    def cancel(self, waiter):
+        with self._lock:
+            member = None
+            if waiter.granted:
+                member = waiter.member
+                waiter.granted = False
+                waiter.cancelled = True
+            elif not waiter.cancelled:
+                waiter.cancelled = True
+                self._waiting -= 1
+            woken = self._dispatch()
+        for w in woken:
+            w._wake()
+        if member is not None:
+            member.release(waiter.estimated_kv, waiter.lane)
+
+    def budget_snapshot(self):
+        members = list(self.members)
+        snaps = [m.budget_snapshot() for m in members]
+        with self._lock:
+            return {
+                "replicas": [m.model_name for m in members],
+                "total": sum(snap["total"] for snap in snaps),
+                "used": sum(snap["used"] for snap in snaps),
+                "active_slots": sum(snap["active_slots"] for snap in snaps),
+                "max_slots": sum(snap["max_slots"] for snap in snaps),
+                "queue_depth": self._queue_depth,
+                "max_queue_depth": self.max_queue_depth,
+                "waiting": self._waiting,
+                "queue_policy": self.queue_policy,
+            }
+
+
+class GlobalBudgetGate(_LaneGate):
+    """Cross-model global concurrency limiter (FIFO within each lane)."""
+
+    def __init__(self, max_concurrent, reserved_slots=None):
+        super().__init__(max_concurrent, "fifo", reserved_slots)
+        self.name = "global"
+
+    @property
+    def active(self):
+        return self._active_slots
+
+    @property
+    def max_concurrent(self):
+        return self.max_slots
+
+    def acquire(self, timeout=None, lane="default"):
+        waiter = self.enqueue(lane=lane)
+        if waiter.wait(timeout) and waiter.granted:
+            return True
+        self.cancel(waiter)
+        return False
+
+    def release(self, lane="default"):
+        self._release(0, lane)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "active": self._active_slots,
+                "max": self.max_slots,
+                "waiting": self._waiting,
+                "lanes": self._lane_snapshot(),
+            }
+
+
+_gates_lock = threading.Lock()
+_inference_gates: dict = {}
+_global_gate = GlobalBudgetGate(MAX_GLOBAL_CONCURRENT, GLOBAL_LANE_RESERVED_SLOTS)
+
+
+def get_inference_gate(model_name):
+    with _gates_lock:
+        if model_name not in _inference_gates:
+            params = _get_model_params(model_name)
+            ctx_size = params.get("ctx_size", 131072)
+            max_slots = params.get("max_concurrent", 1)
+            kv_ratio = params.get("kv_budget_ratio", 0.9)
+            _inference_gates[model_name] = ModelBudgetGate(
+                model_name, ctx_size=ctx_size,
+                max_slots=max_slots, kv_budget_ratio=kv_ratio,
+                queue_policy=params.get("queue_policy", QUEUE_POLICY),
+                max_queue_depth=params.get("max_queue_depth", MAX_QUEUE_DEPTH),
+                reserved_slots=params.get("lane_reserved_slots", LANE_RESERVED_SLOTS),
+                reserved_kv_ratio=params.get("lane_reserved_kv_ratio", LANE_RESERVED_KV_RATIO),
+            )
+        return _inference_gates[model_name]
+
+
+def get_global_gate():
+    return _global_gate
+
+
+_replica_groups: dict = {}
+
+
+def get_replica_group(alias, names):
+    members = [get_inference_gate(name) for name in names]
+    with _gates_lock:
+        group = _replica_groups.get(alias)
+        if group is None:
+            params = _get_model_params(names[0])
+            group = ReplicaGroup(
+                alias,
+                queue_policy=params.get("queue_policy", QUEUE_POLICY),
+                max_queue_depth=params.get("max_queue_depth", MAX_QUEUE_DEPTH),
+            )
+            _replica_groups[alias] = group
+    if group.members != members:
+        group.set_members(members)
+    return group
+
+
+def get_admission_gate(model_name):
+    """推理准入门控：同 alias 有多个副本且 REPLICA_ROUTING=least 时为 ReplicaGroup，否则为该模型的 ModelBudgetGate。"""
+    if REPLICA_ROUTING == "least":
+        routes = route_registry.table().kinds["chat"]
+        info = routes.models.get(model_name)
+        replicas = routes.replicas.get(info.get("model")) if info else None
+        if replicas and len(replicas) > 1:
+            return get_replica_group(info["model"], replicas)
+    return get_inference_gate(model_name)
+
+
+def _bind_replica(lease, member, url, model_name):
+    """准入落在副本 member 上：lease 改挂到该副本，返回指向它的 (url, model_name)。"""
+    lease.gate = member
+    if member.model_name == model_name:
+        return url, model_name
+    models = get_running_models()
+    src, dst = models.get(model_name), models.get(member.model_name)
+    if src and dst:
+        base = _backend_base_url(src).rstrip("/")
+        if url.startswith(base):
+            url = _backend_base_url(dst).rstrip("/") + url[len(base):]
+    return url, member.model_name
+
+
+# ── 后端实时状态（llama-server /slots、/metrics） ──────────────────
+
+
+def _parse_prometheus(text):
+    """Prometheus 文本格式 → {指标名: 值}；忽略注释与带 label 的样本。"""
+    values = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        parts = line.split()
+        if len(parts) < 2 or "{" in parts[0]:
+            continue
+        try:
+            values[parts[0]] = float(parts[1])
+        except ValueError:
+            continue
+    return values
+
+
+class BackendLiveState:
+    """What one poll of a llama-server backend reported."""
+
+    __slots__ = ("n_slots", "busy_slots", "kv_usage_ratio", "requests_deferred", "polled_at")
+
+    def __init__(self, n_slots, busy_slots, kv_usage_ratio, requests_deferred):
+        self.n_slots = n_slots
+        self.busy_slots = busy_slots
+        self.kv_usage_ratio = kv_usage_ratio
+        self.requests_deferred = requests_deferred
+        self.polled_at = time.monotonic()
+
+    def snapshot(self):
+        return {
+            "n_slots": self.n_slots,
+            "busy_slots": self.busy_slots,
+            "kv_usage_ratio": self.kv_usage_ratio,
+            "requests_deferred": self.requests_deferred,
+            "age_sec": round(time.monotonic() - self.polled_at, 1),
+        }
+
+
+class BackendStatePoller:
+    """Background thread feeding live llama-server state into the model gates.
+
+    Every BACKEND_POLL_SEC each running llama-server chat backend (Ollama is
+    skipped) is asked for ``/slots`` (slot count, busy slots) and
+    ``/metrics`` (``kv_cache_usage_ratio``, ``requests_processing``,
+    ``requests_deferred``); the result goes to ModelBudgetGate.update_live.
+    A backend answering neither endpoint (started without --slots/--metrics,
+    or not llama-server) is skipped for BACKEND_POLL_UNSUPPORTED_BACKOFF
+    seconds; an unreachable one drops back to estimate-only admission until
+    the next successful poll.
+    """
+
+    def __init__(self, interval=BACKEND_POLL_SEC):
+        self.interval = interval
+        self._thread = None
+        self._backoff = {}  # base_url -> monotonic time until which polling is skipped
+
+    def start(self):
+        if self._thread is not None or self.interval <= 0:
+            return
+        self._thread = threading.Thread(target=self._run, name="backend-poller", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.poll_all()
+            except Exception as e:
+                _log(f"[backend] 状态轮询失败: {e}")
+            time.sleep(self.interval)
+
+    def poll_all(self):
+        now = time.monotonic()
+        for name, info in route_registry.table().kinds["chat"].models.items():
+            if info.get("ollama"):
+                continue
+            base_url = _backend_base_url(info)
+            if self._backoff.get(base_url, 0) > now:
+                continue
+            get_inference_gate(name).update_live(self.poll(base_url))
+
+    def _get(self, url):
+        """GET 一个状态端点：成功返回 body，不支持返回 None；网络错误抛 BackendError/OSError。"""
+        status, raw = backend_fetch(url, "GET", None, BACKEND_POLL_TIMEOUT)
+        return raw if status == 200 else None
+
+    def poll(self, base_url):
+        try:
+            slots_raw = self._get(base_url + "/slots")
+            metrics_raw = self._get(base_url + "/metrics")
+        except (BackendError, OSError):
+            return None
+        if slots_raw is None and metrics_raw is None:
+            self._backoff[base_url] = time.monotonic() + BACKEND_POLL_UNSUPPORTED_BACKOFF
+            return None
+
+        n_slots = busy = None
+        if slots_raw is not None:
+            try:
+                slots = json.loads(slots_raw)
+            except ValueError:
+                slots = None
+            if isinstance(slots, list) and slots:
+                n_slots = len(slots)
+                # 新版 llama-server 为 is_processing，旧版为 state（0 = idle）
+                busy = sum(
+                    1 for slot in slots if isinstance(slot, dict) and (
+                        slot.get("is_processing") if "is_processing" in slot else slot.get("state", 0) != 0
+                    )
+                )
+        metrics = _parse_prometheus(metrics_raw.decode("utf-8", errors="replace")) if metrics_raw else {}
+        if busy is None:
+            busy = int(metrics.get("llamacpp:requests_processing", 0))
+        deferred = metrics.get("llamacpp:requests_deferred")
+        return BackendLiveState(
+            n_slots, busy,
+            metrics.get("llamacpp:kv_cache_usage_ratio"),
+            int(deferred) if deferred is not None else None,
+        )
+
+
+backend_poller = BackendStatePoller()
+
+
+# ── Prometheus /metrics ──────────────────────────────────────
+
+
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+_TOKENS_PER_SEC_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500, 1000)
+
+_HISTOGRAMS = {
+    "serve_ui_queue_wait_seconds": ("推理请求从到达到获得准入的等待时间", _LATENCY_BUCKETS),
+    "serve_ui_ttfb_seconds": ("推理请求从到达到后端首个响应字节的时间", _LATENCY_BUCKETS),
+    "serve_ui_request_duration_seconds": ("推理请求从到达到响应结束的总耗时", _LATENCY_BUCKETS),
+    "serve_ui_tokens_per_second": ("后端生成速度（completion tokens / 首字节之后的耗时）", _TOKENS_PER_SEC_BUCKETS),
+}
+
+
+def _route_label(path):
+    """/metrics 的 route 标签：/v1/* 取路径本身，/api/<模型>/* 把模型段换成 *（模型另有 model 标签）。"""
+    path = path.split("?", 1)[0]
+    if path.startswith("/api/"):
+        parts = path.split("/", 3)
+        return "/api/*/" + (parts[3] if len(parts) > 3 else "")
+    return path
 
 
-def get_running_models():
-    """从 run/*.pid 读取运行中的模型列表，并合并 models.json 外部后端探测结果。
-    返回 {name: {pid, port, model, host?}}"""
-    models = {}
-    if os.path.isdir(RUN_DIR):
-        for fname in os.listdir(RUN_DIR):
-            if not fname.endswith(".pid"):
-                continue
-            fpath = os.path.join(RUN_DIR, fname)
-            try:
-                with open(fpath) as f:
-                    lines = f.read().strip().split("\n")
-                pid = int(lines[0].strip())
-                port = int(lines[1].strip()) if len(lines) > 1 else 8001
-                name = fname[:-4]
-                model = lines[2].strip() if len(lines) > 2 else name
-                if not model:
-                    model = name
-                try:
-                    os.kill(pid, 0)
-                except OSError:
-                    os.remove(fpath)
-                    continue
-                models[name] = {"pid": pid, "port": port, "model": model}
-            except (ValueError, IndexError, FileNotFoundError):
-                continue
+def _label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
 
-    for name, info in _probe_external_json_models().items():
-        if name not in models:
-            models[name] = info
 
-    for name, info in _probe_ollama_models().items():
-        if name not in models:
-            models[name] = info
+class ProxyMetrics:
+    """Counters and histograms behind the Prometheus ``/metrics`` endpoint.
 
-    return models
+    The request path only does a dict lookup and a few integer adds under
+    one short lock; cumulative buckets and text formatting happen at scrape
+    time.  Gate gauges (KV budget, slots, queue) are read from the gates'
+    snapshots when scraped, so admission itself is not instrumented.
+    """
 
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hist = {}  # (name, labels) -> [各桶计数..., +Inf 桶, sum, count]
+        self._requests = collections.Counter()  # (model, route, code) -> n
 
-def get_default_port():
-    """获取默认后端端口（第一个运行中的模型，或 8001）"""
-    models = get_running_models()
-    if models:
-        first = next(iter(models.values()))
-        return first["port"]
-    return int(os.environ.get("LLAMA_PORT", "8001"))
+    def count(self, model_name, route, code):
+        with self._lock:
+            self._requests[(model_name, route, str(code))] += 1
 
+    def _observe(self, name, labels, value):
+        buckets = _HISTOGRAMS[name][1]
+        i = bisect.bisect_left(buckets, value)
+        with self._lock:
+            row = self._hist.get((name, labels))
+            if row is None:
+                row = self._hist[(name, labels)] = [0] * (len(buckets) + 3)
+            row[i] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    def observe_inference(self, model_name, path, ctx, tap, admitted_at):
+        """One relayed inference: latency histograms and its outcome code."""
+        now = time.monotonic()
+        labels = (model_name, _route_label(path))
+        self.count(model_name, labels[1], tap.status or 200)
+        self._observe("serve_ui_queue_wait_seconds", labels, max(0.0, admitted_at - ctx.received_at))
+        self._observe("serve_ui_request_duration_seconds", labels, now - ctx.received_at)
+        if tap.first_at is not None:
+            self._observe("serve_ui_ttfb_seconds", labels, tap.first_at - ctx.received_at)
+            tokens = tap.completion_tokens() if tap.status is None else None
+            if tokens and now - tap.first_at > 0.05:
+                self._observe("serve_ui_tokens_per_second", labels, tokens / (now - tap.first_at))
+
+    def render(self):
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def sample(name, labels, value):
+            label_text = ",".join(f'{k}="{_label_value(v)}"' for k, v in labels)
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
 
-# ── 推理请求队列（KV 预算感知） ──────────────────────────────────
+        with self._lock:
+            hist = {key: list(row) for key, row in self._hist.items()}
+            requests = dict(self._requests)
 
+        family("serve_ui_requests_total", "counter", "推理请求数，按结果状态码（200/429/502/504 等）")
+        for (model, route, code), n in sorted(requests.items()):
+            sample("serve_ui_requests_total", (("model", model), ("route", route), ("code", code)), n)
 
-class ModelBudgetGate:
-    """Per-model KV budget pool with concurrency control.
+        for name, (help_text, buckets) in _HISTOGRAMS.items():
+            family(name, "histogram", help_text)
+            for (hist_name, (model, route)), row in sorted(hist.items()):
+                if hist_name != name:
+                    continue
+                labels = (("model", model), ("route", route))
+                cumulative = 0
+                for bound, n in zip(list(buckets) + ["+Inf"], row[:-2]):
+                    cumulative += n
+                    sample(name + "_bucket", labels + (("le", bound),), cumulative)
+                sample(name + "_sum", labels, round(row[-2], 6))
+                sample(name + "_count", labels, row[-1])
+
+        gauges = (
+            ("serve_ui_kv_budget_used_tokens", "used", "已预留的 KV 预算（token）"),
+            ("serve_ui_kv_budget_total_tokens", "total", "KV 预算上限（token）"),
+            ("serve_ui_active_slots", "active_slots", "正在推理的请求数"),
+            ("serve_ui_max_slots", "max_slots", "并发槽位上限"),
+            ("serve_ui_queue_depth", "queue_depth", "排队中（含已准入未结束）的请求数"),
+            ("serve_ui_queue_waiting", "waiting", "等待准入的请求数"),
+        )
+        snapshots = {name: gate.budget_snapshot() for name, gate in list(_inference_gates.items())}
+        for metric, key, help_text in gauges:
+            family(metric, "gauge", help_text)
+            for name, snap in sorted(snapshots.items()):
+                sample(metric, (("model", name),), snap[key])
 
-    Replaces the old Semaphore(1)-based InferenceGate.  Allows up to
-    ``max_slots`` concurrent requests as long as the sum of their
-    estimated KV token usage stays within ``total_budget``.
-    """
+        g = get_global_gate().snapshot()
+        for metric, key, help_text in (
+            ("serve_ui_global_active", "active", "全局正在推理的请求数"),
+            ("serve_ui_global_max", "max", "全局并发上限（MAX_GLOBAL_CONCURRENT）"),
+            ("serve_ui_global_waiting", "waiting", "等待全局并发配额的请求数"),
+        ):
+            family(metric, "gauge", help_text)
+            sample(metric, (), g[key])
+        return "\n".join(lines) + "\n"
 
-    def __init__(self, model_name, ctx_size=131072, max_slots=1,
-                 kv_budget_ratio=0.9):
-        self.model_name = model_name
-        self.total_budget = int(ctx_size * kv_budget_ratio)
-        self.max_slots = max(1, max_slots)
-        self._condition = threading.Condition()
-        self._active_slots = 0
-        self._used_budget = 0
-        self._queue_depth = 0
 
-    @property
-    def active_slots(self):
-        return self._active_slots
+proxy_metrics = ProxyMetrics()
 
-    @property
-    def used_budget(self):
-        return self._used_budget
 
-    @property
-    def queue_depth(self):
-        return self._queue_depth
+def build_models_payload():
+    """/api/models 响应：运行中模型 + 队列与 KV 预算 + Ollama 聚合 + 连接池统计。"""
+    models = get_running_models()
+    result = []
+    for name, info in models.items():
+        gate = _inference_gates.get(name)
+        entry = {
+            "name": name,
+            "model": info.get("model", name),
+            "port": info["port"],
+            "pid": info.get("pid"),
+            "external": bool(info.get("external")),
+            "ollama": bool(info.get("ollama")),
+            "ollama_model": info.get("ollama_model"),
+            "queue": gate.queue_depth if gate else 0,
+        }
+        if gate:
+            entry["budget"] = gate.budget_snapshot()
+        result.append(entry)
+    return {
+        "models": result,
+        "ollama": get_ollama_status(),
+        "global": get_global_gate().snapshot(),
+        "pools": pool_snapshots(),
+        "tokenizer": token_counter.snapshot(),
+        "routing": affinity_router.snapshot(),
+        "groups": {alias: group.budget_snapshot() for alias, group in list(_replica_groups.items())},
+        "completion_cache": completion_cache.snapshot(),
+        "embed_batching": embedding_batcher.snapshot(),
+        "access_log": access_log.snapshot(),
+        "stream": monitor_hub.snapshot(),
+    }
 
-    def enter_queue(self):
-        with self._condition:
-            if self._queue_depth >= MAX_QUEUE_DEPTH:
-                return False
-            self._queue_depth += 1
-            return True
 
-    def leave_queue(self):
-        with self._condition:
-            self._queue_depth = max(0, self._queue_depth - 1)
+def _sse_event(event, obj):
+    return f"event: {event}\ndata: {json.dumps(obj, ensure_ascii=False)}\n\n".encode("utf-8")
 
-    def _can_acquire(self, estimated_kv):
-        if self._active_slots >= self.max_slots:
-            return False
-        if self._used_budget + estimated_kv <= self.total_budget:
-            return True
-        # First request always allowed to avoid deadlock
-        return self._active_slots == 0
 
-    def acquire(self, estimated_kv, timeout=None):
-        """Try to acquire a slot with the given KV budget.
+class _MonitorSubscriber:
+    """One /api/stream client: a bounded backlog of encoded SSE batches."""
 
-        Returns True if acquired, False on timeout.
-        """
-        with self._condition:
-            if self._can_acquire(estimated_kv):
-                self._active_slots += 1
-                self._used_budget += estimated_kv
-                return True
-            if timeout is not None and timeout <= 0:
-                return False
-            deadline = (time.monotonic() + timeout) if timeout else None
-            while True:
-                remaining = None
-                if deadline is not None:
-                    remaining = deadline - time.monotonic()
-                    if remaining <= 0:
-                        return False
-                self._condition.wait(timeout=remaining)
-                if self._can_acquire(estimated_kv):
-                    self._active_slots += 1
-                    self._used_budget += estimated_kv
-                    return True
-
-    def acquire_nonblocking(self, estimated_kv):
-        """Non-blocking acquire. Returns True if immediately available."""
-        with self._condition:
-            if self._can_acquire(estimated_kv):
-                self._active_slots += 1
-                self._used_budget += estimated_kv
-                return True
-            return False
+    __slots__ = ("_items", "_wake", "dropped")
 
-    def release(self, estimated_kv):
-        with self._condition:
-            self._used_budget = max(0, self._used_budget - estimated_kv)
-            self._active_slots = max(0, self._active_slots - 1)
-            self._condition.notify_all()
+    def __init__(self, wake):
+        self._items = collections.deque()
+        self._wake = wake
+        self.dropped = 0
 
-    def budget_snapshot(self):
-        """Return a dict describing current budget state."""
-        with self._condition:
-            return {
-                "total": self.total_budget,
-                "used": self._used_budget,
-                "active_slots": self._active_slots,
-                "max_slots": self.max_slots,
-                "queue_depth": self._queue_depth,
-            }
+    def push(self, data):
+        if len(self._items) >= MONITOR_STREAM_BACKLOG:
+            self._items.popleft()
+            self.dropped += 1
+        self._items.append(data)
+        self._wake()
 
+    def drain(self):
+        parts = []
+        while self._items:
+            parts.append(self._items.popleft())
+        return b"".join(parts)
 
-class GlobalBudgetGate:
-    """Cross-model global concurrency limiter."""
 
-    def __init__(self, max_concurrent):
-        self._semaphore = threading.Semaphore(max(1, max_concurrent))
-        self._max = max(1, max_concurrent)
-        self._lock = threading.Lock()
-        self._active = 0
+class MonitorHub:
+    """Fan-out behind /api/stream (the monitor.html push channel).
 
-    @property
-    def active(self):
-        return self._active
+    While at least one client is subscribed, a single thread builds the
+    dashboard snapshot every SERVE_UI_STREAM_SEC::
 
-    @property
-    def max_concurrent(self):
-        return self._max
+        event: snapshot
+        data: {"ts", "system": /api/system, "models": /api/models,
+               "history": sampler records since the previous snapshot}
 
-    def acquire(self, timeout=None):
-        ok = self._semaphore.acquire(timeout=timeout)
-        if ok:
-            with self._lock:
-                self._active += 1
-        return ok
+    encodes it once and hands the same bytes to every subscriber, so N open
+    dashboards cost one /api/system + /api/models build per tick.  Gate
+    events (``gate_event``, called by _LaneGate with the gate lock held)
+    only append to a deque and wake the thread, which forwards them in
+    batches as ``event: gate`` / ``{"ts", "kind", "gate", "lane", "active",
+    "waiting"}`` with kind admit, queue, release or shed.  A new subscriber
+    first receives ``event: history`` (all sampler records) and the last
+    snapshot.  Subscribers that fall MONITOR_STREAM_BACKLOG batches behind
+    lose the oldest ones.
+    """
 
-    def acquire_nonblocking(self):
-        ok = self._semaphore.acquire(blocking=False)
-        if ok:
-            with self._lock:
-                self._active += 1
-        return ok
+    def __init__(self, interval=MONITOR_STREAM_SEC):
+        self.interval = interval if interval > 0 else 5.0
+        self._subscribers = []
+        self._events = collections.deque(maxlen=4096)
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._snapshot = None
+        self._history_ts = 0.0
+        self.snapshots = 0
+        self.events = 0
+
+    def subscribe(self, wake):
+        """Register a client; ``wake()`` is called (from the hub thread) when data is queued."""
+        sub = _MonitorSubscriber(wake)
+        sub.push(_sse_event("history", {
+            "records": system_sampler.history(0.0), "interval": system_sampler.interval,
+        }))
+        with self._lock:
+            if self._snapshot is not None:
+                sub.push(self._snapshot)
+            self._subscribers.append(sub)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="monitor-hub", daemon=True)
+                self._thread.start()
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            if sub in self._subscribers:
+                self._subscribers.remove(sub)
 
-    def release(self):
+    def gate_event(self, kind, gate, lane):
+        if not self._subscribers:
+            return
+        self._events.append((time.time(), kind, gate.name, lane, gate._active_slots, gate._waiting))
+        self._wakeup.set()
+
+    def _publish(self, data):
         with self._lock:
-            self._active = max(0, self._active - 1)
-        self._semaphore.release()
+            subscribers = list(self._subscribers)
+        for sub in subscribers:
+            try:
+                sub.push(data)
+            except Exception:
+                self.unsubscribe(sub)
+
+    def _build_snapshot(self):
+        history = system_sampler.history(self._history_ts)
+        if history:
+            self._history_ts = history[-1]["ts"]
+        return _sse_event("snapshot", {
+            "ts": round(time.time(), 3),
+            "system": get_system_info(),
+            "models": build_models_payload(),
+            "history": history,
+        })
+
+    def _run(self):
+        next_tick = time.monotonic()
+        while True:
+            self._wakeup.wait(max(0.0, next_tick - time.monotonic()))
+            self._wakeup.clear()
+            batch = []
+            while self._events:
+                ts, kind, name, lane, active, waiting = self._events.popleft()
+                batch.append(_sse_event("gate", {
+                    "ts": round(ts, 3), "kind": kind, "gate": name, "lane": lane,
+                    "active": active, "waiting": waiting,
+                }))
+            if batch:
+                self.events += len(batch)
+                self._publish(b"".join(batch))
+            if time.monotonic() >= next_tick:
+                try:
+                    snapshot = self._build_snapshot()
+                    with self._lock:
+                        self._snapshot = snapshot
+                    self.snapshots += 1
+                    self._publish(snapshot)
+                except Exception as e:
+                    _log(f"[stream] 快照生成失败: {e}")
+                next_tick = time.monotonic() + self.interval
+            with self._lock:
+                if not self._subscribers:
+                    # 无订阅者时线程退出，下一个订阅者重新启动；缓存快照作废（已过期）
+                    self._thread = None
+                    self._snapshot = None
+                    self._events.clear()
+                    return
 
     def snapshot(self):
         with self._lock:
-            return {"active": self._active, "max": self._max}
+            return {
+                "subscribers": len(self._subscribers),
+                "interval": self.interval,
+                "snapshots": self.snapshots,
+                "events": self.events,
+                "dropped": sum(sub.dropped for sub in self._subscribers),
+            }
 
 
-_gates_lock = threading.Lock()
-_inference_gates: dict = {}
-_global_gate = GlobalBudgetGate(MAX_GLOBAL_CONCURRENT)
+monitor_hub = MonitorHub()
 
 
-def get_inference_gate(model_name):
-    with _gates_lock:
-        if model_name not in _inference_gates:
-            params = _get_model_params(model_name)
-            ctx_size = params.get("ctx_size", 131072)
-            max_slots = params.get("max_concurrent", 1)
-            kv_ratio = params.get("kv_budget_ratio", 0.9)
-            _inference_gates[model_name] = ModelBudgetGate(
-                model_name, ctx_size=ctx_size,
-                max_slots=max_slots, kv_budget_ratio=kv_ratio,
+def build_openai_models_payload():
+    """OpenAI 标准格式的 /v1/models 模型列表（alias、ollama tag 与运行名均可作为 id）。"""
+    models = get_running_models()
+    data = []
+    created = int(time.time())
+    for name, info in models.items():
+        alias = info.get("model", name)
+        data.append(
+            {
+                "id": alias,
+                "object": "model",
+                "created": created,
+                "owned_by": "ollama" if info.get("ollama") else "local",
+            }
+        )
+        if info.get("ollama_model") and info["ollama_model"] != alias:
+            data.append(
+                {
+                    "id": info["ollama_model"],
+                    "object": "model",
+                    "created": created,
+                    "owned_by": "ollama",
+                }
             )
-        return _inference_gates[model_name]
+        if name != alias:
+            data.append(
+                {
+                    "id": name,
+                    "object": "model",
+                    "created": created,
+                    "owned_by": "local",
+                }
+            )
+    return {"object": "list", "data": data}
 
 
-def get_global_gate():
-    return _global_gate
+def _backend_headers(client_headers, method, body):
+    """客户端请求头 → 转发到后端的请求头（去掉逐跳头，注入 .api-key）。"""
+    headers = {}
+    for k, v in client_headers.items():
+        if k.lower() not in ("host", "connection", "content-length", "transfer-encoding"):
+            headers[k] = v
+    api_key = load_api_key()
+    if api_key:
+        headers["Authorization"] = f"Bearer {api_key}"
+    if method != "GET" and body:
+        headers["Content-Type"] = client_headers.get("Content-Type", "application/json")
+    if isinstance(body, UploadStream):
+        # 原样转发长度，避免 http.client 对文件型 body 改用 chunked 上传
+        headers["Content-Length"] = str(len(body))
+    return headers
 
 
-# ── HTTP Handler ──────────────────────────────────────────────
+# ── 请求流程（threading / asyncio 共用） ──────────────────────
 
 
-class ProxyHandler(SimpleHTTPRequestHandler):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, directory=STATIC_DIR, **kwargs)
+def _error_json(message):
+    return {"error": {"message": message, "type": "server_error"}}
 
-    def end_headers(self):
-        if not self.path.startswith(("/api/", "/v1/")):
-            self.send_header("Cache-Control", "no-cache")
-        super().end_headers()
 
-    def do_GET(self):
-        if self.path.startswith("/api/"):
-            self.proxy_request("GET")
-        elif self.path.startswith("/v1/"):
-            self.openai_request("GET")
-        else:
-            super().do_GET()
+class _ProxyFlows:
+    """Request logic shared by ProxyHandler and AsyncProxyConnection.
 
-    def do_POST(self):
-        if self.path.startswith("/api/"):
-            self.proxy_request("POST")
-        elif self.path.startswith("/v1/"):
-            self.openai_request("POST")
-        else:
-            self.send_error(HTTPStatus.METHOD_NOT_ALLOWED, "POST not supported for static files")
+    Routing, lane choice, KV estimation, gate admission and release, the
+    completion cache and the access-log decisions are written once, as
+    generators.  Whenever a flow needs I/O it yields ``(method_name, *args)``;
+    the engine's ``_drive()`` runs that method on itself (a plain call in the
+    threading engine, awaited in the asyncio engine) and sends the result
+    back.  An exception from the call (e.g. the client went away) is thrown
+    into the flow at the ``yield``, so its ``finally`` blocks still release
+    gates and leases.
 
-    def resolve_backend(self, api_path):
-        """解析 API 路径，返回 (backend_url, remaining_path, model_name)"""
-        stripped = api_path.lstrip("/")
-        if stripped == "models":
-            return None, "models", None
-        if stripped == "system":
-            return None, "system", None
-
-        parts = stripped.split("/", 1)
-        if parts[0] == "ollama":
-            remaining = "/" + parts[1] if len(parts) > 1 else "/"
-            return OLLAMA_HOST, remaining, None
-
-        models = get_running_models()
-        if len(parts) >= 1 and parts[0] in models:
-            model_name = parts[0]
-            remaining = "/" + parts[1] if len(parts) > 1 else "/"
-            return _backend_base_url(models[model_name]), remaining, model_name
-
-        if models:
-            default_name = next(iter(models))
-            return (
-                _backend_base_url(models[default_name]),
-                api_path,
-                default_name,
-            )
-        port = int(os.environ.get("LLAMA_PORT", "8001"))
-        return f"http://127.0.0.1:{port}", api_path, None
+    Both engines implement the I/O steps with the same names and arguments:
+    ``_request_body``, ``_upload_model``, ``_read_all``, ``_call`` (work that
+    may block: inline, or on the thread pool), ``send_json``, ``send_body``,
+    ``send_error_page``, ``_send_stream_headers``, ``write_chunk``,
+    ``end_chunked``, ``_write_stream_error``, ``_queue_wait``,
+    ``_flight_wait``, ``_forward_request``, ``_forward_with_keepalive`` and
+    ``handle_stream_endpoint``.
+    """
 
     # ── 请求路由 ──
 
-    def proxy_request(self, method):
+    def api_flow(self, method):
+        """/api/*：按路径前缀路由到后端。"""
         api_path = self.path[4:]  # strip /api
-        backend_url, remaining_path, model_name = self.resolve_backend(api_path)
+        backend_url, remaining_path, model_name = resolve_api_backend(api_path)
 
         if backend_url is None and remaining_path == "models":
-            self.handle_models_endpoint()
+            payload = yield ("_call", build_models_payload)
+            yield ("send_json", 200, payload)
             return
         if backend_url is None and remaining_path == "system":
-            self.handle_system_endpoint()
+            payload = yield ("_call", build_system_payload, self.path)
+            yield ("send_json", 200, payload)
+            return
+        if backend_url is None and remaining_path == "stream":
+            yield ("handle_stream_endpoint",)
             return
 
         url = backend_url.rstrip("/") + remaining_path
         clean_path = remaining_path.lstrip("/").split("?")[0]
 
-        body = None
-        if method == "POST":
-            content_len = int(self.headers.get("Content-Length", 0))
-            body = self.rfile.read(content_len) if content_len else None
+        body = yield ("_request_body", method, clean_path not in INFERENCE_PATHS)
 
         if clean_path in INFERENCE_PATHS and model_name:
-            self._gated_inference(url, method, body, model_name)
+            yield from self._cached_inference(url, method, RequestContext(body), model_name)
+        elif clean_path in EMBEDDING_PATHS and model_name and isinstance(body, UploadStream):
+            yield from self._forward_upload(url, method, body, model_name)
         elif clean_path in EMBEDDING_PATHS and model_name:
-            body_summary = _parse_body_summary(body, "embed")
-            full_body = body.decode("utf-8", errors="replace") if (LOG_BODY and body) else None
-            _log_request_summary("embed", self.path, method, self.client_address[0], model_name, body_summary, full_body)
-            _log(f"[embed] {self.client_address[0]} → {model_name}")
-            capture = bool(ACCESS_LOG_FILE)
-            resp_body = self._forward_request(url, method, body, API_PROXY_TIMEOUT, capture_response=capture)
-            _log_request_and_response(
-                "embed", self.path, method, self.client_address[0], model_name,
-                body_summary, full_body, resp_body,
-            )
+            yield from self._forward_embedding(url, method, RequestContext(body), model_name)
         elif clean_path in ASR_PATHS and model_name:
             _log(f"[asr] {self.client_address[0]} → {model_name}")
-            self._forward_request(url, method, body, API_PROXY_TIMEOUT)
+            yield ("_forward_request", url, method, body, API_PROXY_TIMEOUT)
         else:
             monitor_paths = ("health", "metrics", "slots")
             timeout = (
@@ -918,208 +4477,211 @@ class ProxyHandler(SimpleHTTPRequestHandler):
                 if clean_path in monitor_paths
                 else API_PROXY_TIMEOUT
             )
-            self._forward_request(url, method, body, timeout)
-
-    # ── OpenAI 兼容路由 (/v1/*) ──
-
-    def _check_auth(self):
-        """校验 Bearer token，若 .api-key 存在则要求客户端携带。
-        返回 True 表示通过（或无需认证），False 表示已返回 401。"""
-        expected = load_api_key()
-        if not expected:
-            return True
-        auth = self.headers.get("Authorization", "")
-        if auth == f"Bearer {expected}":
-            return True
-        self.send_response(401)
-        self.send_header("Content-Type", "application/json")
-        self.end_headers()
-        err = json.dumps(
-            {"error": {"message": "Invalid API key", "type": "invalid_request_error"}},
-        )
-        self.wfile.write(err.encode("utf-8"))
-        return False
+            yield ("_forward_request", url, method, body, timeout)
 
-    def openai_request(self, method):
-        """处理 /v1/* 路由，通过请求体 model 字段路由到对应后端"""
-        if not self._check_auth():
+    def openai_flow(self, method):
+        """/v1/*：校验 API key（若 .api-key 存在），通过请求体 model 字段路由到对应后端。"""
+        if not _auth_ok(self.headers):
+            yield ("send_json", 401, {"error": {"message": "Invalid API key", "type": "invalid_request_error"}})
             return
         clean_path = self.path.lstrip("/").split("?")[0]
 
         if clean_path == "v1/models":
-            self.handle_openai_models()
+            yield ("send_json", 200, build_openai_models_payload())
             return
 
-        body = None
-        if method == "POST":
-            content_len = int(self.headers.get("Content-Length", 0))
-            body = self.rfile.read(content_len) if content_len else None
+        body = yield ("_request_body", method, clean_path not in INFERENCE_PATHS)
+        requested = (yield ("_upload_model", body)) if isinstance(body, UploadStream) else None
+        if requested is None and isinstance(body, UploadStream) and clean_path in EMBEDDING_PATHS | ASR_PATHS:
+            # 前缀中找不到 model：为了正确路由退回完整读取
+            body = yield ("_read_all", body)
 
         if clean_path in INFERENCE_PATHS:
-            model_name, backend_url = self._resolve_model_from_body(body)
+            ctx = RequestContext(body)
+            model_name, backend_url = _resolve_model_from_body(ctx)
             if not backend_url:
-                self._send_error_safe(503, "No running models")
+                yield ("send_error_page", 503, "No running models")
                 return
             url = backend_url.rstrip("/") + self.path
-            self._gated_inference(url, method, body, model_name)
+            # 按 alias 请求时可在同 alias 的副本间均衡；直接写副本运行名则固定到该副本
+            yield from self._cached_inference(url, method, ctx, model_name, balance=ctx.model != model_name)
+        elif clean_path in EMBEDDING_PATHS and isinstance(body, UploadStream):
+            model_name, backend_url = _resolve_requested_model(requested, "embedding")
+            if not backend_url:
+                yield ("send_error_page", 503, "No running embedding models")
+                return
+            yield from self._forward_upload(backend_url.rstrip("/") + "/v1/embeddings", method, body, model_name)
         elif clean_path in EMBEDDING_PATHS:
-            model_name, backend_url = self._resolve_model_from_body(body, embedding_only=True)
+            ctx = RequestContext(body)
+            model_name, backend_url = _resolve_model_from_body(ctx, embedding_only=True)
             if not backend_url:
-                self._send_error_safe(503, "No running embedding models")
+                yield ("send_error_page", 503, "No running embedding models")
                 return
             url = backend_url.rstrip("/") + "/v1/embeddings"
-            body_summary = _parse_body_summary(body, "embed")
-            full_body = body.decode("utf-8", errors="replace") if (LOG_BODY and body) else None
-            _log_request_summary("embed", self.path, method, self.client_address[0], model_name, body_summary, full_body)
-            _log(f"[embed] {self.client_address[0]} → {model_name}")
-            capture = bool(ACCESS_LOG_FILE)
-            resp_body = self._forward_request(url, method, body, API_PROXY_TIMEOUT, capture_response=capture)
-            _log_request_and_response(
-                "embed", self.path, method, self.client_address[0], model_name,
-                body_summary, full_body, resp_body,
-            )
+            yield from self._forward_embedding(url, method, ctx, model_name)
         elif clean_path in ASR_PATHS:
             content_type = self.headers.get("Content-Type", "")
-            model_name, backend_url = self._resolve_model_from_multipart(
-                body, content_type, asr_only=True
-            )
+            if isinstance(body, UploadStream):
+                model_name, backend_url = _resolve_requested_model(requested, "asr")
+            else:
+                model_name, backend_url = yield ("_call", functools.partial(
+                    _resolve_model_from_multipart, body, content_type, asr_only=True
+                ))
             if not backend_url:
-                self._send_error_safe(503, "No running ASR models")
+                yield ("send_error_page", 503, "No running ASR models")
                 return
             url = backend_url.rstrip("/") + "/v1/audio/transcriptions"
             _log(f"[asr] {self.client_address[0]} → {model_name}")
-            self._forward_request(url, method, body, API_PROXY_TIMEOUT)
+            yield ("_forward_request", url, method, body, API_PROXY_TIMEOUT)
         else:
-            models = get_running_models()
-            if models:
-                default_name = next(iter(models))
-                backend_url = _backend_base_url(models[default_name])
-            else:
-                port = int(os.environ.get("LLAMA_PORT", "8001"))
-                backend_url = f"http://127.0.0.1:{port}"
-            url = backend_url.rstrip("/") + self.path
-            self._forward_request(url, method, body, API_PROXY_TIMEOUT)
-
-    def _resolve_model_from_body(self, body, embedding_only=False, asr_only=False):
-        """从请求体的 model 字段匹配运行中后端，返回 (model_name, backend_url)。
-        匹配顺序：alias 精确匹配 → 短名精确匹配 → 默认第一个。
-        embedding_only=True 时只在 models.json 类型为 embedding 的后端中解析。
-        asr_only=True 时只在 type=asr 的后端中解析。"""
-        mj = _load_models_json()
-        all_models = get_running_models()
-        models = {}
-        for name, info in all_models.items():
-            cfg = mj.get(name)
-            typ = (cfg.get("type") if cfg else None) or "chat"
-            if embedding_only:
-                if typ == "embedding":
-                    models[name] = info
-            elif asr_only:
-                if typ == "asr":
-                    models[name] = info
-            else:
-                if typ not in ("embedding", "asr"):
-                    models[name] = info
-        if not models:
-            return None, None
+            url = default_backend_url().rstrip("/") + self.path
+            yield ("_forward_request", url, method, body, API_PROXY_TIMEOUT)
 
-        requested = None
-        if body:
+    def _access_log(self, kind, method, model_name, body_summary, full_body, resp_body):
+        """响应结束后写 access log（仅配置了 ACCESS_LOG_FILE 时，摘要解析不占用事件循环）。"""
+        if ACCESS_LOG_FILE:
+            yield ("_call", _log_request_and_response, kind, self.path, method, self.client_address[0],
+                   model_name, body_summary, full_body, resp_body)
+
+    def _forward_embedding(self, url, method, ctx, model_name):
+        client_ip = self.client_address[0]
+        body = ctx.body
+        body_summary = ctx.summary("embed")
+        full_body = body.decode("utf-8", errors="replace") if (LOG_BODY and body) else None
+        _log_request_summary("embed", self.path, method, client_ip, model_name, body_summary, full_body)
+        _log(f"[embed] {client_ip} → {model_name}")
+        call = embedding_batcher.submit(url, model_name, ctx) if method == "POST" else None
+        if call is not None:
+            yield ("_flight_wait", call)
+            resp_body = call.body
             try:
-                requested = json.loads(body).get("model")
-            except (json.JSONDecodeError, UnicodeDecodeError):
+                yield ("send_body", call.status, [("Content-Type", "application/json")], resp_body)
+            except OSError:
                 pass
+        else:
+            capture = bool(ACCESS_LOG_FILE)
+            resp_body = yield ("_forward_request", url, method, body, API_PROXY_TIMEOUT, capture)
+        yield from self._access_log("embed", method, model_name, body_summary, full_body, resp_body)
 
-        return self._pick_model_backend(models, requested)
-
-    def _resolve_model_from_multipart(self, body, content_type, asr_only=False):
-        """从 multipart/form-data 中提取 model 字段并匹配 ASR 后端。"""
-        requested = None
-        if body and content_type.lower().startswith("multipart/form-data"):
-            requested = _extract_multipart_field(body, content_type, "model")
-        return self._resolve_model_from_body(
-            json.dumps({"model": requested}).encode("utf-8") if requested else None,
-            asr_only=asr_only,
-        )
-
-    def _pick_model_backend(self, models, requested):
-        if requested:
-            for name, info in models.items():
-                if info.get("ollama_model") == requested:
-                    return name, _backend_base_url(info)
-                if info.get("model") == requested:
-                    return name, _backend_base_url(info)
-            if requested in models:
-                info = models[requested]
-                return requested, _backend_base_url(info)
-
-        default_name = next(iter(models))
-        return (
-            default_name,
-            _backend_base_url(models[default_name]),
-        )
+    def _forward_upload(self, url, method, upload, model_name):
+        """大批量 embeddings：不合批，请求体边读边转发；日志只记录上传字节数。"""
+        body_summary = {"upload_bytes": len(upload)}
+        _log_request_summary("embed", self.path, method, self.client_address[0], model_name, body_summary)
+        resp_body = yield ("_forward_request", url, method, upload, API_PROXY_TIMEOUT, bool(ACCESS_LOG_FILE))
+        yield from self._access_log("embed", method, model_name, body_summary, None, resp_body)
 
     # ── 推理门控 ──
 
-    def _gated_inference(self, url, method, body, model_name):
-        gate = get_inference_gate(model_name)
+    def _cached_inference(self, url, method, ctx, model_name, balance=False):
+        """Serve deterministic requests from completion_cache; identical requests
+        arriving together wait for the first one instead of going upstream."""
+        key = completion_cache.key_for(ctx, model_name, self.path, self.headers)
+        if key is None:
+            yield from self._gated_inference(url, method, ctx, model_name, balance)
+            return
+        client_ip = self.client_address[0]
+        headers_sent = False
+        while True:
+            # 磁盘层的读写会阻塞，交给引擎的 _call（asyncio 模式下放到线程池）
+            if completion_cache.disk_dir:
+                hit = yield ("_call", completion_cache.get, key)
+            else:
+                hit = completion_cache.get(key)
+            if hit is not None:
+                yield from self._replay_cached(method, ctx, model_name, hit, headers_sent)
+                return
+            flight, leader = completion_cache.join(key)
+            if leader:
+                ctx.cache_key = key
+                try:
+                    yield from self._gated_inference(url, method, ctx, model_name, balance, headers_sent)
+                finally:
+                    completion_cache.finish(key, flight)
+                return
+            _log(f"[cache] {client_ip} → {model_name} 等待相同请求的结果")
+            if ctx.stream and not headers_sent:
+                yield ("_send_stream_headers",)
+                headers_sent = True
+            try:
+                # 与上游请求同样的超时：领头请求迟迟不结束时不再等待，改为普通（不缓存）请求
+                done = yield ("_flight_wait", flight, API_PROXY_TIMEOUT, headers_sent)
+            except OSError:
+                _log(f"[cache] {client_ip} 断开，停止等待 {model_name}")
+                return
+            if not done:
+                _log(f"[cache] {client_ip} 等待 {model_name} 相同请求超时，直接请求上游")
+                yield from self._gated_inference(url, method, ctx, model_name, balance, headers_sent)
+                return
+
+    def _replay_cached(self, method, ctx, model_name, hit, headers_sent):
+        stream, body = hit
+        _log(f"[cache] {self.client_address[0]} → {model_name} HIT ({len(body)} bytes)")
+        try:
+            if stream:
+                if not headers_sent:
+                    yield ("_send_stream_headers",)
+                yield ("write_chunk", body)
+                yield ("end_chunked",)
+            else:
+                yield ("send_body", 200, [("Content-Type", "application/json")], body)
+        except OSError:
+            pass
+        full_body = ctx.body.decode("utf-8", errors="replace") if (LOG_BODY and ctx.body) else None
+        yield from self._access_log("infer", method, model_name, ctx.summary("infer"), full_body, body)
+
+    def _gated_inference(self, url, method, ctx, model_name, balance=False, headers_sent=False):
+        gate = get_admission_gate(model_name) if balance else get_inference_gate(model_name)
         g_gate = get_global_gate()
         client_ip = self.client_address[0]
-        body = _prepare_inference_body(body, model_name)
+        body = _prepare_inference_body(ctx, model_name)
+        lane = _request_lane(self.headers)
 
-        if not gate.enter_queue():
-            self.send_response(429)
-            self.send_header("Content-Type", "application/json")
-            self.send_header("Retry-After", "30")
-            self.end_headers()
-            err = json.dumps(
-                {"error": {"message": "推理队列已满，请稍后重试", "type": "server_error"}},
-                ensure_ascii=False,
-            )
-            self.wfile.write(err.encode("utf-8"))
+        if not gate.enter_queue(lane):
+            proxy_metrics.count(model_name, _route_label(self.path), 429)
+            if headers_sent:
+                yield ("_write_stream_error", "推理队列已满，请稍后重试")
+            else:
+                yield ("send_json", 429, _error_json("推理队列已满，请稍后重试"), [("Retry-After", "30")])
             return
 
-        body_summary = _parse_body_summary(body, "infer")
+        body_summary = ctx.summary("infer")
         full_body = body.decode("utf-8", errors="replace") if (LOG_BODY and body) else None
         _log_request_summary("infer", self.path, method, client_ip, model_name, body_summary, full_body)
 
-        est_kv, _ = estimate_kv_tokens(body, model_name)
-
-        is_stream = False
-        if body:
-            try:
-                is_stream = json.loads(body).get("stream", False)
-            except (json.JSONDecodeError, UnicodeDecodeError):
-                pass
+        if exact_token_mode(model_name):
+            # 精确计数会同步调用后端 /tokenize
+            est_kv, max_tokens = yield ("_call", estimate_kv_tokens, ctx, model_name)
+        else:
+            est_kv, max_tokens = estimate_kv_tokens(ctx, model_name)
+        is_stream = ctx.stream
+        lease = KvLease(gate, est_kv, max_tokens, lane, is_stream and incremental_kv_enabled(model_name))
+        est_kv = lease.kv
+        deadline = _request_deadline(self.headers)
 
         t0 = time.monotonic()
         try:
             # Fast path: try both gates non-blocking
-            got_global = g_gate.acquire_nonblocking()
-            got_model = got_global and gate.acquire_nonblocking(est_kv)
-
-            if got_global and got_model:
-                snap = gate.budget_snapshot()
+            ctx.trace.mark("gate_wait")
+            got_global = g_gate.acquire_nonblocking(lane=lane)
+            member = got_global and gate.acquire_nonblocking(est_kv, deadline, lane)
+
+            if got_global and member:
+                ctx.trace.mark("model_gate")
+                ctx.trace.mark("global_gate")
+                url, model_name = _bind_replica(lease, member, url, model_name)
+                snap = member.budget_snapshot()
                 _log(
-                    f"[budget] {client_ip} → {model_name} "
+                    f"[budget] {client_ip} → {model_name} lane={lane} "
                     f"est={est_kv} used={snap['used']}/{snap['total']} "
                     f"slots={snap['active_slots']}/{snap['max_slots']} → ALLOW"
                 )
                 try:
                     _log(f"[infer] {client_ip} → {model_name}")
-                    capture = bool(ACCESS_LOG_FILE)
-                    if is_stream:
-                        self._send_stream_headers()
-                        resp_body = self._forward_with_keepalive(url, method, body, capture_response=capture)
-                    else:
-                        resp_body = self._forward_request(url, method, body, API_PROXY_TIMEOUT, capture_response=capture)
-                    _log_request_and_response(
-                        "infer", self.path, method, client_ip, model_name,
-                        body_summary, full_body, resp_body,
-                    )
+                    yield from self._relay_inference(url, method, ctx, model_name, body_summary, full_body,
+                                                     is_stream, headers_sent, lease=lease)
                 finally:
-                    gate.release(est_kv)
-                    g_gate.release()
+                    lease.release()
+                    g_gate.release(lane)
                     _log(
                         f"[infer] {client_ip} → {model_name} "
                         f"done ({time.monotonic() - t0:.1f}s)"
@@ -1127,12 +4689,12 @@ class ProxyHandler(SimpleHTTPRequestHandler):
                 return
 
             if got_global:
-                g_gate.release()
+                g_gate.release(lane)
 
             # Slow path: queue wait
             snap = gate.budget_snapshot()
             _log(
-                f"[budget] {client_ip} → {model_name} "
+                f"[budget] {client_ip} → {model_name} lane={lane} "
                 f"est={est_kv} used={snap['used']}/{snap['total']} "
                 f"slots={snap['active_slots']}/{snap['max_slots']} → QUEUE"
             )
@@ -1142,9 +4704,11 @@ class ProxyHandler(SimpleHTTPRequestHandler):
             )
 
             if is_stream:
-                self._queued_stream(gate, g_gate, est_kv, url, method, body, client_ip, model_name, body_summary, full_body)
+                yield from self._queued_stream(gate, g_gate, lease, deadline, lane, url, method, ctx,
+                                               model_name, body_summary, full_body, headers_sent)
             else:
-                self._queued_block(gate, g_gate, est_kv, url, method, body, client_ip, model_name, body_summary, full_body)
+                yield from self._queued_block(gate, g_gate, lease, deadline, lane, url, method, ctx,
+                                              model_name, body_summary, full_body)
 
             _log(
                 f"[infer] {client_ip} → {model_name} "
@@ -1153,99 +4717,198 @@ class ProxyHandler(SimpleHTTPRequestHandler):
         finally:
             gate.leave_queue()
 
-    def _queued_stream(self, gate, g_gate, est_kv, url, method, body,
-                       client_ip, model_name, body_summary=None, full_body=None):
-        """Streaming request: send headers + keepalive while queued, then relay."""
-        self._send_stream_headers()
+    def _relay_inference(self, url, method, ctx, model_name, body_summary, full_body,
+                         is_stream, headers_sent=False, lease=None):
+        admitted_at = time.monotonic()
+        tap = RecordingTap() if ctx.cache_key else UsageTap()
+        capture = bool(ACCESS_LOG_FILE)
+        if is_stream:
+            if not headers_sent:
+                yield ("_send_stream_headers",)
+            resp_body = yield ("_forward_with_keepalive", url, method, ctx.body, capture, tap, lease, ctx.trace)
+        else:
+            resp_body = yield ("_forward_request", url, method, ctx.body, API_PROXY_TIMEOUT,
+                               capture, tap, ctx.trace)
+        proxy_metrics.observe_inference(model_name, self.path, ctx, tap, admitted_at)
+        trace_export(ctx.trace, tap, self.path, model_name)
+        kv_calibrator.observe_tap(model_name, ctx, tap)
+        if ctx.cache_key:
+            if completion_cache.disk_dir:
+                stored = yield ("_call", completion_cache.put, ctx.cache_key, is_stream, tap.body())
+            else:
+                stored = completion_cache.put(ctx.cache_key, is_stream, tap.body())
+            if stored:
+                _log(f"[cache] {model_name} 已缓存响应")
+        yield from self._access_log("infer", method, model_name, body_summary or {}, full_body, resp_body)
+
+    def _stream_wait(self, gate, est_kv, deadline, lane, model_name):
+        """Queue on gate while writing SSE keepalives; the gate holding the grant
+        (see _GateWaiter.member), or None if the request gave up."""
+        client_ip = self.client_address[0]
+        try:
+            waiter = yield ("_queue_wait", gate, est_kv, deadline, lane, None, True)
+        except OSError:
+            _log(f"[queue] {client_ip} 断开，取消排队 {model_name}")
+            return None
+        if waiter.granted:
+            return waiter.member
+        proxy_metrics.count(model_name, _route_label(self.path), 429 if waiter.shed else 504)
+        if waiter.shed:
+            _log(f"[queue] {client_ip} 让位于更高优先级请求 {model_name}")
+            yield ("_write_stream_error", SHED_MESSAGE)
+        else:
+            _log(f"[queue] {client_ip} 超过截止时间，放弃排队 {model_name}")
+            yield ("_write_stream_error", "队列等待超时")
+        return None
 
-        # Wait for model gate (with keepalive)
-        while not gate.acquire(est_kv, timeout=QUEUE_KEEPALIVE_SEC):
-            try:
-                self._write_chunk(b": keepalive\n\n")
-            except (BrokenPipeError, ConnectionResetError, OSError):
-                _log(f"[queue] {client_ip} 断开，取消排队 {model_name}")
-                return
+    def _queued_stream(self, gate, g_gate, lease, deadline, lane, url, method, ctx,
+                       model_name, body_summary=None, full_body=None, headers_sent=False):
+        """Streaming request: send headers + keepalive while queued, then relay."""
+        if not headers_sent:
+            yield ("_send_stream_headers",)
 
-        # Got model gate; now acquire global (with keepalive)
-        while not g_gate.acquire(timeout=QUEUE_KEEPALIVE_SEC):
-            try:
-                self._write_chunk(b": keepalive\n\n")
-            except (BrokenPipeError, ConnectionResetError, OSError):
-                _log(f"[queue] {client_ip} 断开，取消排队 {model_name}")
-                gate.release(est_kv)
-                return
+        # Wait for model gate, then global gate (with keepalive); waiters keep their queue position
+        member = yield from self._stream_wait(gate, lease.kv, deadline, lane, model_name)
+        if member is None:
+            return
+        url, model_name = _bind_replica(lease, member, url, model_name)
+        ctx.trace.mark("model_gate")
+        if not (yield from self._stream_wait(g_gate, 0, deadline, lane, model_name)):
+            lease.release()
+            return
 
+        ctx.trace.mark("global_gate")
         try:
-            _log(f"[infer] {client_ip} → {model_name} (queued)")
-            capture = bool(ACCESS_LOG_FILE)
-            resp_body = self._forward_with_keepalive(url, method, body, capture_response=capture)
-            _log_request_and_response(
-                "infer", self.path, method, client_ip, model_name,
-                body_summary or {}, full_body, resp_body,
-            )
+            _log(f"[infer] {self.client_address[0]} → {model_name} (queued)")
+            yield from self._relay_inference(url, method, ctx, model_name, body_summary, full_body,
+                                             True, headers_sent=True, lease=lease)
         finally:
-            gate.release(est_kv)
-            g_gate.release()
-
-    def _queued_block(self, gate, g_gate, est_kv, url, method, body,
-                      client_ip, model_name, body_summary=None, full_body=None):
-        """Non-streaming request: block until budget available."""
-        if not gate.acquire(est_kv, timeout=API_PROXY_TIMEOUT):
-            self.send_response(504)
-            self.send_header("Content-Type", "application/json")
-            self.end_headers()
-            err = json.dumps(
-                {"error": {"message": "队列等待超时", "type": "server_error"}},
-                ensure_ascii=False,
-            )
-            self.wfile.write(err.encode("utf-8"))
+            lease.release()
+            g_gate.release(lane)
+
+    def _queued_block(self, gate, g_gate, lease, deadline, lane, url, method, ctx,
+                      model_name, body_summary=None, full_body=None):
+        """Non-streaming request: wait until budget available."""
+        waiter = yield ("_queue_wait", gate, lease.kv, deadline, lane, API_PROXY_TIMEOUT)
+        if not waiter.granted:
+            proxy_metrics.count(model_name, _route_label(self.path), 429 if waiter.shed else 504)
+            if waiter.shed:
+                _log(f"[queue] {self.client_address[0]} 让位于更高优先级请求 {model_name}")
+                yield ("send_json", 429, _error_json(SHED_MESSAGE), [("Retry-After", "30")])
+            else:
+                yield ("send_json", 504, _error_json("队列等待超时"))
             return
+        url, model_name = _bind_replica(lease, waiter.member, url, model_name)
+        ctx.trace.mark("model_gate")
 
-        if not g_gate.acquire(timeout=API_PROXY_TIMEOUT):
-            gate.release(est_kv)
-            self.send_response(504)
-            self.send_header("Content-Type", "application/json")
-            self.end_headers()
-            err = json.dumps(
-                {"error": {"message": "全局队列等待超时", "type": "server_error"}},
-                ensure_ascii=False,
-            )
-            self.wfile.write(err.encode("utf-8"))
+        if not (yield ("_queue_wait", g_gate, 0, deadline, lane, API_PROXY_TIMEOUT)).granted:
+            lease.release()
+            proxy_metrics.count(model_name, _route_label(self.path), 504)
+            yield ("send_json", 504, _error_json("全局队列等待超时"))
             return
 
-        try:
-            _log(f"[infer] {client_ip} → {model_name} (queued)")
-            capture = bool(ACCESS_LOG_FILE)
-            resp_body = self._forward_request(url, method, body, API_PROXY_TIMEOUT, capture_response=capture)
-            _log_request_and_response(
-                "infer", self.path, method, client_ip, model_name,
-                body_summary or {}, full_body, resp_body,
-            )
-        finally:
-            gate.release(est_kv)
-            g_gate.release()
+        ctx.trace.mark("global_gate")
+        try:
+            _log(f"[infer] {self.client_address[0]} → {model_name} (queued)")
+            yield from self._relay_inference(url, method, ctx, model_name, body_summary, full_body, False)
+        finally:
+            lease.release()
+            g_gate.release(lane)
+
+
+# ── HTTP Handler ──────────────────────────────────────────────
+
+
+class ProxyHandler(_ProxyFlows, SimpleHTTPRequestHandler):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, directory=STATIC_DIR, **kwargs)
+
+    def end_headers(self):
+        if not self.path.startswith(("/api/", "/v1/")):
+            self.send_header("Cache-Control", "no-cache")
+        super().end_headers()
+
+    def do_GET(self):
+        if self.path.startswith("/api/"):
+            self._drive(self.api_flow("GET"))
+        elif self.path.startswith("/v1/"):
+            self._drive(self.openai_flow("GET"))
+        elif self.path.split("?", 1)[0] == "/metrics":
+            self.handle_metrics_endpoint()
+        else:
+            super().do_GET()
+
+    def do_POST(self):
+        if self.path.startswith("/api/"):
+            self._drive(self.api_flow("POST"))
+        elif self.path.startswith("/v1/"):
+            self._drive(self.openai_flow("POST"))
+        else:
+            self.send_error(HTTPStatus.METHOD_NOT_ALLOWED, "POST not supported for static files")
+
+    def _drive(self, flow):
+        """Run a _ProxyFlows generator, performing each I/O step it yields in this thread."""
+        result = error = None
+        while True:
+            try:
+                step = flow.send(result) if error is None else flow.throw(error)
+            except StopIteration:
+                return
+            result = error = None
+            try:
+                result = getattr(self, step[0])(*step[1:])
+            except Exception as e:
+                error = e
+            except BaseException:
+                flow.close()
+                raise
+
+    def _call(self, fn, *args):
+        return fn(*args)
 
-    # ── 转发与保活 ──
+    # ── 请求体 ──
 
-    def _build_backend_request(self, url, method, body):
-        headers = {}
-        for k, v in self.headers.items():
-            if k.lower() not in ("host", "connection", "content-length"):
-                headers[k] = v
-        api_key = load_api_key()
-        if api_key:
-            headers["Authorization"] = f"Bearer {api_key}"
-        if method == "GET":
-            return urllib.request.Request(url, headers=headers, method="GET")
-        req = urllib.request.Request(
-            url, data=body, headers=headers, method="POST"
+    def _request_body(self, method, streamable=False):
+        """读取请求体；streamable 且不小于 STREAM_UPLOAD_MIN 时返回 UploadStream，边读边转发。"""
+        if method != "POST":
+            return None
+        content_len = int(self.headers.get("Content-Length", 0))
+        if not content_len:
+            return None
+        if streamable and STREAM_UPLOAD_MIN and content_len >= STREAM_UPLOAD_MIN:
+            return UploadStream(self.rfile, content_len)
+        return self.rfile.read(content_len)
+
+    def _upload_model(self, upload):
+        """流式上传的 model：请求头 / 查询参数优先，其次请求体前缀，都没有返回 None。"""
+        return _model_hint(self.path, self.headers) or _model_from_prefix(
+            upload.peek(ROUTE_PREFIX_BYTES), self.headers.get("Content-Type", "")
         )
-        if body:
-            req.add_header(
-                "Content-Type",
-                self.headers.get("Content-Type", "application/json"),
-            )
-        return req
+
+    def _read_all(self, upload):
+        return upload.read_all()
+
+    # ── 响应写出 ──
+
+    def send_body(self, code, headers, body):
+        self.send_response(code)
+        for key, value in headers:
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, code, obj, headers=()):
+        body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_body(code, [("Content-Type", "application/json"), *headers], body)
+
+    def send_error_page(self, code, message=""):
+        """向客户端发送错误页；若对端已断开则静默结束，避免 BrokenPipe 链式异常。"""
+        try:
+            self.send_error(code, message)
+        except (BrokenPipeError, ConnectionResetError, OSError) as e:
+            if not _is_client_disconnected(e):
+                raise
 
     def _send_stream_headers(self):
         self.send_response(200)
@@ -1254,62 +4917,80 @@ class ProxyHandler(SimpleHTTPRequestHandler):
         self.send_header("Transfer-Encoding", "chunked")
         self.end_headers()
 
-    def _write_chunk(self, data):
-        self.wfile.write(("%x\r\n" % len(data)).encode())
-        self.wfile.write(data)
-        self.wfile.write(b"\r\n")
+    def write_chunk(self, data):
+        # 块头、数据与块尾合成一次 send；wfile 不带缓冲（wbufsize=0），无需 flush
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+
+    def end_chunked(self):
+        self.wfile.write(b"0\r\n\r\n")
         self.wfile.flush()
 
-    def _send_error_safe(self, code, message=""):
-        """向客户端发送错误页；若对端已断开则静默结束，避免 BrokenPipe 链式异常。"""
+    def _write_stream_error(self, message):
+        """在已开始的 SSE 响应中写入错误事件并结束 chunked 流。"""
+        err = _error_json(message)
         try:
-            self.send_error(code, message)
-        except (BrokenPipeError, ConnectionResetError, OSError) as e:
-            if not _is_client_disconnected(e):
-                raise
+            self.write_chunk(f"data: {json.dumps(err, ensure_ascii=False)}\n\ndata: [DONE]\n\n".encode())
+            self.end_chunked()
+        except (BrokenPipeError, ConnectionResetError, OSError):
+            pass
+
+    # ── 排队等待 ──
+
+    def _queue_wait(self, gate, est_kv, deadline, lane, timeout=None, keepalive=False):
+        """Queue on gate until the waiter is granted or shed, timeout (None: no limit)
+        or the client deadline passes; returns the waiter (see _wait_gate).  With
+        keepalive an SSE comment is written every QUEUE_KEEPALIVE_SEC seconds; a
+        failed write cancels the waiter and propagates."""
+        waiter = gate.enqueue(est_kv, deadline, lane)
+        limit = time.monotonic() + _queue_timeout(deadline, threading.TIMEOUT_MAX if timeout is None else timeout)
+        try:
+            while True:
+                remaining = limit - time.monotonic()
+                if remaining <= 0:
+                    break
+                if waiter.wait(min(remaining, QUEUE_KEEPALIVE_SEC) if keepalive else remaining):
+                    break
+                if keepalive and time.monotonic() < limit:
+                    self.write_chunk(b": keepalive\n\n")
+        except BaseException:
+            gate.cancel(waiter)
+            raise
+        if not waiter.granted:
+            gate.cancel(waiter)
+        return waiter
+
+    def _flight_wait(self, flight, timeout=None, keepalive=False):
+        """Wait for a _Flight (completion cache, embedding batch); False if timeout
+        passed first.  With keepalive an SSE comment is written every QUEUE_KEEPALIVE_SEC seconds."""
+        limit = None if timeout is None else time.monotonic() + timeout
+        while not flight.event.is_set():
+            remaining = threading.TIMEOUT_MAX if limit is None else limit - time.monotonic()
+            if remaining <= 0:
+                return False
+            if flight.event.wait(min(remaining, QUEUE_KEEPALIVE_SEC) if keepalive else remaining):
+                break
+            if keepalive:
+                self.write_chunk(b": keepalive\n\n")
+        return True
 
-    def _forward_request(self, url, method, body, timeout, capture_response=False):
+    # ── 转发与保活 ──
+
+    def _forward_request(self, url, method, body, timeout, capture_response=False, tap=None, trace=None):
         """Forward request and relay full response (headers + body).
-        If capture_response is True, returns the response body bytes; otherwise returns None."""
-        out = [] if capture_response else None
+        If capture_response is True, returns a ResponseCapture of the body; otherwise returns None.
+        tap (e.g. UsageTap) is fed every relayed body chunk of a successful response; with a
+        RequestTrace the response carries Server-Timing / X-Queue-Time headers.
+        A backend Content-Length is kept and the body copied through one preallocated
+        buffer; chunked (streaming) responses are re-chunked as they arrive."""
+        out = ResponseCapture() if capture_response else None
+        headers = _backend_headers(self.headers, method, body)
         try:
-            req = self._build_backend_request(url, method, body)
-            with urllib.request.urlopen(req, timeout=timeout) as resp:
-                self.send_response(resp.status)
-                for k, v in resp.headers.items():
-                    if k.lower() not in ("transfer-encoding", "content-length"):
-                        self.send_header(k, v)
-                self.send_header("Transfer-Encoding", "chunked")
-                self.end_headers()
-                while True:
-                    chunk = resp.read(8192)
-                    if not chunk:
-                        break
-                    self._write_chunk(chunk)
-                    if out is not None:
-                        out.append(chunk)
-                self.wfile.write(b"0\r\n\r\n")
-            return b"".join(out) if out is not None else None
-        except urllib.error.HTTPError as e:
-            try:
-                self.send_response(e.code)
-                self.send_header("Content-Type", "application/json")
-                self.end_headers()
-                err_body = e.read()
-                self.wfile.write(err_body)
-            except (BrokenPipeError, ConnectionResetError, OSError) as w:
-                if _is_client_disconnected(w):
-                    return None
-                raise
-            if out is not None:
-                return err_body
-            return None
-        except urllib.error.URLError as e:
+            pool, conn, resp = backend_request(url, method, body, headers, timeout, trace)
+        except BackendError as e:
+            if tap is not None:
+                tap.status = 504 if e.timed_out else 502
             try:
-                if (
-                    isinstance(getattr(e, "reason", None), socket.timeout)
-                    or "timed out" in str(e).lower()
-                ):
+                if e.timed_out:
                     self.send_response(504)
                     self.send_header("Content-Type", "application/json")
                     self.end_headers()
@@ -1319,47 +5000,113 @@ class ProxyHandler(SimpleHTTPRequestHandler):
                         )
                     )
                 else:
-                    self._send_error_safe(502, str(e))
+                    self.send_error_page(502, str(e))
             except (BrokenPipeError, ConnectionResetError, OSError) as w:
                 if _is_client_disconnected(w):
                     return None
                 raise
             return None
+
+        try:
+            if resp.status >= 400:
+                if tap is not None:
+                    tap.status = resp.status
+                err_body = resp.read()
+                self.send_response(resp.status)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(err_body)
+                if out is not None:
+                    out.feed(err_body)
+                return out
+            self.send_response(resp.status)
+            for k, v in resp.getheaders():
+                if k.lower() not in ("transfer-encoding", "content-length", "connection", "keep-alive"):
+                    self.send_header(k, v)
+            if trace is not None:
+                for k, v in trace.headers():
+                    self.send_header(k, v)
+            if not resp.chunked and resp.length is not None:
+                self.send_header("Content-Length", str(resp.length))
+                self.end_headers()
+                buf = memoryview(bytearray(RELAY_BUFFER_SIZE))
+                while True:
+                    n = resp.readinto(buf)
+                    if not n:
+                        break
+                    chunk = buf[:n]
+                    self.wfile.write(chunk)
+                    if out is not None:
+                        out.feed(chunk)
+                    if tap is not None:
+                        tap.feed(chunk)
+                if trace is not None:
+                    trace.mark("last_byte")
+                return out
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            while True:
+                chunk = resp.read1(RELAY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.write_chunk(chunk)
+                if out is not None:
+                    out.feed(chunk)
+                if tap is not None:
+                    tap.feed(chunk)
+            if trace is not None:
+                trace.mark("last_byte")
+            self.wfile.write(b"0\r\n\r\n")
+            return out
         except (BrokenPipeError, ConnectionResetError, OSError) as e:
             if _is_client_disconnected(e):
                 return None
             raise
         except Exception as e:
-            self._send_error_safe(502, str(e))
+            if tap is not None:
+                tap.status = 502
+            self.send_error_page(502, str(e))
             return None
+        finally:
+            release_backend_conn(pool, conn, resp)
 
-    def _forward_with_keepalive(self, url, method, body, capture_response=False):
+    def _forward_with_keepalive(self, url, method, body, capture_response=False, tap=None, lease=None,
+                                trace=None):
         """Forward to backend with keepalive during long prompt processing.
         Stream headers must already be sent before calling this method.
         Uses a reader thread so the main thread can send keepalive while
         the backend is processing the prompt (no data flowing yet).
-        If capture_response is True, returns the concatenated response body bytes."""
-        req = self._build_backend_request(url, method, body)
+        If capture_response is True, returns a ResponseCapture of the relayed stream.
+        tap is fed every relayed backend chunk (see _forward_request); lease
+        (KvLease) is fed too and released as soon as the backend stream ends.
+        With a RequestTrace the stream ends with a ``: server-timing`` comment."""
+        headers = _backend_headers(self.headers, method, body)
         data_q = queue.Queue()
-        out = [] if capture_response else None
+        cancelled = threading.Event()
+        out = ResponseCapture() if capture_response else None
 
         def reader():
             try:
-                with urllib.request.urlopen(req, timeout=API_PROXY_TIMEOUT) as resp:
-                    while True:
-                        chunk = resp.read(8192)
-                        if not chunk:
-                            break
-                        data_q.put(("data", chunk))
+                pool, conn, resp = backend_request(url, method, body, headers, API_PROXY_TIMEOUT, trace)
+            except BackendError as e:
+                data_q.put(("error", str(e)))
+                return
+            try:
+                if resp.status >= 400:
+                    err_body = resp.read().decode("utf-8", errors="replace")
+                    data_q.put(("http_error", (resp.status, err_body)))
+                    return
+                while not cancelled.is_set():
+                    chunk = resp.read1(RELAY_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    data_q.put(("data", chunk))
                 data_q.put(("done", None))
-            except urllib.error.HTTPError as e:
-                try:
-                    err_body = e.read().decode("utf-8", errors="replace")
-                except Exception:
-                    err_body = ""
-                data_q.put(("http_error", (e.code, err_body)))
             except Exception as e:
                 data_q.put(("error", str(e)))
+            finally:
+                # 客户端断开时未读完的响应不能放回池中，关闭连接也让后端尽快停止生成
+                release_backend_conn(pool, conn, resp)
 
         t = threading.Thread(target=reader, daemon=True)
         t.start()
@@ -1369,17 +5116,23 @@ class ProxyHandler(SimpleHTTPRequestHandler):
                 try:
                     msg_type, payload = data_q.get(timeout=QUEUE_KEEPALIVE_SEC)
                 except queue.Empty:
-                    self._write_chunk(b": keepalive\n\n")
+                    self.write_chunk(b": keepalive\n\n")
                     continue
 
                 if msg_type == "data":
-                    self._write_chunk(payload)
+                    self.write_chunk(payload)
                     if out is not None:
-                        out.append(payload)
+                        out.feed(payload)
+                    if tap is not None:
+                        tap.feed(payload)
+                    if lease is not None:
+                        lease.feed(payload)
                 elif msg_type == "done":
                     break
                 elif msg_type == "http_error":
                     code, err_body = payload
+                    if tap is not None:
+                        tap.status = code
                     try:
                         err_json = json.loads(err_body)
                     except (json.JSONDecodeError, ValueError):
@@ -1390,18 +5143,20 @@ class ProxyHandler(SimpleHTTPRequestHandler):
                             }
                         }
                     chunk_data = f"data: {json.dumps(err_json)}\n\ndata: [DONE]\n\n".encode()
-                    self._write_chunk(chunk_data)
+                    self.write_chunk(chunk_data)
                     if out is not None:
-                        out.append(chunk_data)
+                        out.feed(chunk_data)
                     break
                 elif msg_type == "error":
+                    if tap is not None:
+                        tap.status = 502
                     err = {
                         "error": {"message": payload, "type": "server_error"}
                     }
                     chunk_data = f"data: {json.dumps(err)}\n\ndata: [DONE]\n\n".encode()
-                    self._write_chunk(chunk_data)
+                    self.write_chunk(chunk_data)
                     if out is not None:
-                        out.append(chunk_data)
+                        out.feed(chunk_data)
                     break
         except (BrokenPipeError, ConnectionResetError, OSError) as e:
             if _is_client_disconnected(e):
@@ -1409,107 +5164,902 @@ class ProxyHandler(SimpleHTTPRequestHandler):
             else:
                 raise
         finally:
+            cancelled.set()
+            if lease is not None:
+                lease.release()
             try:
+                if trace is not None:
+                    trace.finish(tap)
+                    self.write_chunk(trace.sse_comment())
                 self.wfile.write(b"0\r\n\r\n")
                 self.wfile.flush()
             except (BrokenPipeError, ConnectionResetError, OSError):
                 pass
-        return b"".join(out) if out is not None else None
+        return out
 
     # ── 端点处理 ──
 
-    def handle_openai_models(self):
-        """返回 OpenAI 标准格式的 /v1/models 模型列表"""
-        models = get_running_models()
-        data = []
-        created = int(time.time())
-        for name, info in models.items():
-            alias = info.get("model", name)
-            data.append(
-                {
-                    "id": alias,
-                    "object": "model",
-                    "created": created,
-                    "owned_by": "ollama" if info.get("ollama") else "local",
-                }
+    def handle_stream_endpoint(self):
+        """/api/stream：订阅 monitor_hub，持续推送快照与 gate 事件（SSE）"""
+        wakeup = threading.Event()
+        sub = monitor_hub.subscribe(wakeup.set)
+        self.close_connection = True
+        try:
+            self._send_stream_headers()
+            while True:
+                wakeup.wait(QUEUE_KEEPALIVE_SEC)
+                wakeup.clear()
+                self.write_chunk(sub.drain() or b": keepalive\n\n")
+        except (BrokenPipeError, ConnectionResetError, OSError):
+            pass
+        finally:
+            monitor_hub.unsubscribe(sub)
+
+    def handle_metrics_endpoint(self):
+        """Prometheus 文本格式的代理指标（见 ProxyMetrics）"""
+        self.send_body(200, [("Content-Type", METRICS_CONTENT_TYPE)], proxy_metrics.render().encode("utf-8"))
+
+    def log_message(self, format, *args):
+        if not self.path.startswith(("/api/", "/v1/", "/metrics")):
+            super().log_message(format, *args)
+
+
+# ── asyncio 服务模式（--engine asyncio） ──────────────────────
+#
+# 单线程事件循环：客户端 HTTP/1.1 keep-alive，SSE 中继与排队保活都由循环定时器完成，
+# 不再为每个连接/每个流式请求占用 OS 线程。路由、门控、补全缓存与日志决策都在
+# _ProxyFlows 中与 threading 模式共用，这里只实现其 I/O 步骤（排队等待、写出、中继）；
+# 路由查询直接读内存路由表，仍可能阻塞的调用（Ollama 状态、系统采集、multipart 解析、
+# access log 写文件）经 _call 放到默认线程池执行。
+
+
+def _resolve_future(fut):
+    if not fut.done():
+        fut.set_result(True)
+
+
+async def _wait_gate(gate, est_kv, deadline, lane="default", timeout=None, on_tick=None):
+    """asyncio 版门控排队：waiter 被授予（或被挤出）时由释放线程回调唤醒。
+
+    排队期间每 QUEUE_KEEPALIVE_SEC 秒调用一次 on_tick（如写 keepalive）；其抛出
+    的异常会先取消排队再向上传递。返回 waiter：``granted`` 表示已获得配额，
+    ``shed`` 表示让位于更高优先级请求，两者皆否表示超时（timeout 为 None 时
+    不限）或超过客户端截止时间。
+    """
+    loop = asyncio.get_running_loop()
+    woken = loop.create_future()
+
+    def wake():
+        try:
+            loop.call_soon_threadsafe(_resolve_future, woken)
+        except RuntimeError:
+            pass  # 事件循环已关闭
+
+    waiter = gate.enqueue(est_kv, deadline, lane, callback=wake)
+    limit = loop.time() + _queue_timeout(deadline, float("inf") if timeout is None else timeout)
+    try:
+        while not (waiter.granted or waiter.shed):
+            remaining = limit - loop.time()
+            if remaining <= 0:
+                break
+            tick = min(remaining, QUEUE_KEEPALIVE_SEC) if on_tick else remaining
+            await asyncio.wait({woken}, timeout=tick)
+            if not (waiter.granted or waiter.shed) and on_tick and loop.time() < limit:
+                await on_tick()
+    except BaseException:
+        gate.cancel(waiter)
+        raise
+    if not waiter.granted:
+        gate.cancel(waiter)
+    return waiter
+
+
+async def _wait_flight(flight, on_tick=None, timeout=None):
+    """asyncio 版等待 _Flight 完成（补全缓存单飞、嵌入合批）；期间每 QUEUE_KEEPALIVE_SEC 秒调用一次 on_tick。
+    给定 timeout（秒）时最多等待这么久，返回是否已完成。"""
+    loop = asyncio.get_running_loop()
+    woken = loop.create_future()
+
+    def wake():
+        try:
+            loop.call_soon_threadsafe(_resolve_future, woken)
+        except RuntimeError:
+            pass  # 事件循环已关闭
+
+    flight.add_callback(wake)
+    limit = None if timeout is None else loop.time() + timeout
+    while not woken.done():
+        remaining = None if limit is None else limit - loop.time()
+        if remaining is not None and remaining <= 0:
+            return False
+        tick = QUEUE_KEEPALIVE_SEC if on_tick else None
+        if remaining is not None:
+            tick = remaining if tick is None else min(tick, remaining)
+        await asyncio.wait({woken}, timeout=tick)
+        if not woken.done() and on_tick and (limit is None or loop.time() < limit):
+            await on_tick()
+    return True
+
+
+async def _offload(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+
+class _AsyncBackendConn:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.reusable = True
+
+    def is_stale(self):
+        return self.reader.at_eof() or self.writer.is_closing()
+
+    def close(self):
+        self.reusable = False
+        self.writer.close()
+
+
+class AsyncBackendPool:
+    """asyncio 版后端连接池，只在事件循环线程内访问。"""
+
+    def __init__(self, base_url, loop, max_idle=BACKEND_POOL_MAX_IDLE,
+                 idle_ttl=BACKEND_POOL_IDLE_TTL):
+        parsed = urllib.parse.urlsplit(base_url)
+        self.base_url = base_url
+        self.loop = loop
+        self.ssl = parsed.scheme == "https"
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or (443 if self.ssl else 80)
+        self.max_idle = max(0, max_idle)
+        self.idle_ttl = idle_ttl
+        self._idle = []
+        self._closed = False
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+
+    async def get(self, timeout):
+        now = self.loop.time()
+        while self._idle:
+            conn, idle_since = self._idle.pop()
+            if conn.is_stale() or (self.idle_ttl and now - idle_since > self.idle_ttl):
+                conn.close()
+                self.discarded += 1
+                continue
+            self.hits += 1
+            return conn, True
+        self.misses += 1
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=self.ssl or None,
+                                    limit=MAX_HEADER_BYTES),
+            timeout,
+        )
+        return _AsyncBackendConn(reader, writer), False
+
+    def put(self, conn):
+        if self._closed or not conn.reusable or conn.is_stale() or len(self._idle) >= self.max_idle:
+            conn.close()
+            return
+        self._idle.append((conn, self.loop.time()))
+
+    def close(self):
+        self._closed = True
+        idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            conn.close()
+
+    def snapshot(self):
+        return {
+            "idle": len(self._idle),
+            "max_idle": self.max_idle,
+            "hits": self.hits,
+            "misses": self.misses,
+            "discarded": self.discarded,
+        }
+
+
+
+def _get_async_backend_pool(base_url):
+    pool = _async_backend_pools.get(base_url)
+    if pool is None:
+        pool = AsyncBackendPool(base_url, asyncio.get_running_loop())
+        _async_backend_pools[base_url] = pool
+    return pool
+
+
+async def _read_response_head(conn, timeout):
+    """读取后端响应状态行与响应头，跳过 1xx。返回 (status, [(k, v)], {lower: v})。"""
+    while True:
+        head = await asyncio.wait_for(conn.reader.readuntil(b"\r\n\r\n"), timeout)
+        lines = head.decode("latin-1").split("\r\n")
+        parts = lines[0].split(" ", 2)
+        if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+            raise http.client.BadStatusLine(lines[0])
+        status = int(parts[1])
+        headers = []
+        lower = {}
+        for line in lines[1:]:
+            if not line or ":" not in line:
+                continue
+            k, v = line.split(":", 1)
+            v = v.strip()
+            headers.append((k, v))
+            lower[k.lower()] = v
+        if 100 <= status < 200:
+            continue
+        if parts[0] == "HTTP/1.0" or "close" in lower.get("connection", "").lower():
+            conn.reusable = False
+        return status, headers, lower
+
+
+async def _async_backend_request(url, method, body, headers, timeout, trace=None):
+    """asyncio 版 backend_request：返回 (pool, conn, status, headers, lower_headers)。"""
+    parts = urllib.parse.urlsplit(url)
+    base_url = f"{parts.scheme}://{parts.netloc}"
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+    pool = _get_async_backend_pool(base_url)
+    lines = [f"{method} {path} HTTP/1.1", f"Host: {parts.netloc}"]
+    for k, v in headers.items():
+        lines.append(f"{k}: {v}")
+    # UploadStream 的 Content-Length 已由 _backend_headers 设置，不能重复
+    if (body is not None or method == "POST") and not any(k.lower() == "content-length" for k in headers):
+        lines.append(f"Content-Length: {len(body or b'')}")
+    head = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1", errors="replace")
+    while True:
+        try:
+            conn, reused = await pool.get(timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise BackendError(e if not isinstance(e, asyncio.TimeoutError) else socket.timeout(str(e))) from e
+        try:
+            if isinstance(body, UploadStream):
+                conn.writer.write(head)
+                while True:
+                    data = await body.aread(RELAY_CHUNK_SIZE)
+                    if not data:
+                        break
+                    conn.writer.write(data)
+                    await conn.writer.drain()
+            else:
+                conn.writer.write(head + body if body else head)
+                await conn.writer.drain()
+            if trace is not None:
+                trace.mark("upstream_sent")
+            status, resp_headers, lower = await _read_response_head(conn, timeout)
+            if trace is not None:
+                trace.mark("upstream_headers")
+            return pool, conn, status, resp_headers, lower
+        except (asyncio.IncompleteReadError, ConnectionResetError, BrokenPipeError) as e:
+            conn.close()
+            if reused and (not isinstance(body, UploadStream) or body.rewind()):
+                continue
+            raise BackendError(e) from e
+        except asyncio.TimeoutError as e:
+            conn.close()
+            raise BackendError(socket.timeout("timed out")) from e
+        except (OSError, asyncio.LimitOverrunError, ValueError, http.client.HTTPException) as e:
+            conn.close()
+            raise BackendError(e) from e
+
+
+async def _iter_backend_body(conn, lower_headers, method):
+    """按 Content-Length / chunked / 读到 EOF 解析后端响应体，逐段产出（不攒满缓冲区）。"""
+    reader = conn.reader
+    if method == "HEAD":
+        return
+    if "chunked" in lower_headers.get("transfer-encoding", "").lower():
+        while True:
+            size_line = await reader.readline()
+            if not size_line:
+                raise http.client.IncompleteRead(b"")
+            size = int(size_line.split(b";", 1)[0].strip() or b"0", 16)
+            if size == 0:
+                while True:
+                    trailer = await reader.readline()
+                    if trailer in (b"\r\n", b"\n", b""):
+                        return
+            remaining = size
+            while remaining:
+                data = await reader.read(min(remaining, RELAY_CHUNK_SIZE))
+                if not data:
+                    raise http.client.IncompleteRead(b"")
+                remaining -= len(data)
+                yield data
+            await reader.readexactly(2)
+    elif "content-length" in lower_headers:
+        remaining = int(lower_headers["content-length"])
+        while remaining > 0:
+            data = await reader.read(min(remaining, RELAY_CHUNK_SIZE))
+            if not data:
+                raise http.client.IncompleteRead(b"")
+            remaining -= len(data)
+            yield data
+    else:
+        conn.reusable = False
+        while True:
+            data = await reader.read(RELAY_CHUNK_SIZE)
+            if not data:
+                return
+            yield data
+
+
+class _StreamWatchdog:
+    """事件循环定时器：空闲满 keepalive 间隔时写 SSE 注释，空闲超过 timeout 时中断上游。
+
+    每次写出只更新时间戳，不重建定时器，单个流的常态开销几乎为零。
+    """
+
+    def __init__(self, loop, interval, timeout, on_keepalive, on_timeout):
+        self.loop = loop
+        self.interval = interval
+        self.timeout = timeout
+        self.on_keepalive = on_keepalive
+        self.on_timeout = on_timeout
+        self.last_data = loop.time()
+        self.last_write = self.last_data
+        self._handle = None
+
+    def touch(self):
+        self.last_data = self.last_write = self.loop.time()
+
+    def start(self):
+        self._handle = self.loop.call_later(self.interval, self._tick)
+
+    def stop(self):
+        if self._handle:
+            self._handle.cancel()
+            self._handle = None
+
+    def _tick(self):
+        now = self.loop.time()
+        if self.timeout and now - self.last_data >= self.timeout:
+            self._handle = None
+            self.on_timeout()
+            return
+        if self.on_keepalive and now - self.last_write >= self.interval:
+            self.on_keepalive()
+            self.last_write = now
+        self._handle = self.loop.call_at(self.last_write + self.interval, self._tick)
+
+
+class AsyncProxyConnection(_ProxyFlows):
+    """asyncio 模式下的一个客户端连接：逐个处理 keep-alive 请求，请求流程见 _ProxyFlows。"""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        peer = writer.get_extra_info("peername")
+        self.client_address = (peer[0] if peer else "-", peer[1] if peer else 0)
+        self.loop = asyncio.get_running_loop()
+
+    # ── 连接与请求解析 ──
+
+    async def run(self):
+        try:
+            while await self._handle_one():
+                pass
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception as e:
+            _log(f"[async] {self.client_address[0]} 处理异常: {e!r}")
+        finally:
+            self.writer.close()
+
+    async def _handle_one(self):
+        try:
+            head = await asyncio.wait_for(
+                self.reader.readuntil(b"\r\n\r\n"), CLIENT_IDLE_TIMEOUT
             )
-            if info.get("ollama_model") and info["ollama_model"] != alias:
-                data.append(
-                    {
-                        "id": info["ollama_model"],
-                        "object": "model",
-                        "created": created,
-                        "owned_by": "ollama",
-                    }
+        except asyncio.LimitOverrunError:
+            self.keep_alive = False
+            self.request_version = "HTTP/1.0"
+            await self.send_error_page(431, "Request header fields too large")
+            return False
+        except asyncio.IncompleteReadError:
+            return False
+        request_line, _, header_block = head.partition(b"\r\n")
+        words = request_line.decode("latin-1").split()
+        if len(words) != 3 or not words[2].startswith("HTTP/"):
+            self.keep_alive = False
+            self.request_version = "HTTP/1.0"
+            await self.send_error_page(400, "Bad request syntax")
+            return False
+        self.command, self.path, self.request_version = words
+        self.headers = http.client.parse_headers(io.BytesIO(header_block))
+        if self.headers.get("Expect", "").lower() == "100-continue":
+            await self._write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        conn_hdr = self.headers.get("Connection", "").lower()
+        if self.request_version == "HTTP/1.1":
+            self.keep_alive = "close" not in conn_hdr
+        else:
+            self.keep_alive = "keep-alive" in conn_hdr
+        try:
+            self.body = await self._read_request_body()
+        except ValueError:
+            self.keep_alive = False
+            await self.send_error_page(400, "Bad chunked request body")
+            return False
+        if self.body is _BODY_TOO_LARGE:
+            self.keep_alive = False
+            await self.send_error_page(413, "Request body too large")
+            return False
+        await self.dispatch()
+        if isinstance(self.body, UploadStream) and not self.body.consumed:
+            # 流式上传未读完（如路由失败）：连接上还有请求体数据，不能继续复用
+            self.keep_alive = False
+        return self.keep_alive
+
+    async def _read_request_body(self):
+        """读取请求体。chunked 请求体超过 MAX_CHUNKED_BODY 时返回 _BODY_TOO_LARGE（不再读取），
+        块大小行非法时抛 ValueError。"""
+        if "chunked" in self.headers.get("Transfer-Encoding", "").lower():
+            parts = []
+            total = 0
+            while True:
+                size = int((await self.reader.readline()).split(b";", 1)[0].strip() or b"0", 16)
+                if size == 0:
+                    while (await self.reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                if size < 0:
+                    raise ValueError(size)
+                total += size
+                if total > MAX_CHUNKED_BODY:
+                    return _BODY_TOO_LARGE
+                parts.append(await self.reader.readexactly(size))
+                await self.reader.readexactly(2)
+            return b"".join(parts) or None
+        content_len = int(self.headers.get("Content-Length", 0) or 0)
+        if STREAM_UPLOAD_MIN and content_len >= STREAM_UPLOAD_MIN and self.command == "POST":
+            # 大请求体先不读：路由确定后由 _forward_request 边读边转发，推理等需要完整请求体时再读
+            return UploadStream(self.reader, content_len)
+        return await self.reader.readexactly(content_len) if content_len else None
+
+    async def _request_body(self, method, streamable=False):
+        if method != "POST":
+            return None
+        if isinstance(self.body, UploadStream) and not streamable:
+            self.body = await self.body.aread_all()
+        return self.body
+
+    async def _upload_model(self, upload):
+        return _model_hint(self.path, self.headers) or _model_from_prefix(
+            await upload.apeek(ROUTE_PREFIX_BYTES), self.headers.get("Content-Type", "")
+        )
+
+    async def dispatch(self):
+        if self.command not in ("GET", "HEAD", "POST"):
+            self.keep_alive = False
+            await self.send_error_page(501, f"Unsupported method ({self.command!r})")
+        elif self.path.startswith("/api/") and self.command != "HEAD":
+            await self._drive(self.api_flow(self.command))
+        elif self.path.startswith("/v1/") and self.command != "HEAD":
+            await self._drive(self.openai_flow(self.command))
+        elif self.path.split("?", 1)[0] == "/metrics" and self.command == "GET":
+            await self.send_body(200, [("Content-Type", METRICS_CONTENT_TYPE)], proxy_metrics.render().encode("utf-8"))
+        elif self.command == "POST":
+            await self.send_error_page(HTTPStatus.METHOD_NOT_ALLOWED, "POST not supported for static files")
+        else:
+            await self.serve_static()
+
+    # ── 响应写出 ──
+
+    def _status_line(self, code):
+        try:
+            phrase = HTTPStatus(code).phrase
+        except ValueError:
+            phrase = ""
+        return f"HTTP/1.1 {int(code)} {phrase}\r\n"
+
+    async def _write(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    def _head_bytes(self, code, headers):
+        lines = [self._status_line(code)]
+        for k, v in headers:
+            lines.append(f"{k}: {v}\r\n")
+        lines.append("Connection: keep-alive\r\n" if self.keep_alive else "Connection: close\r\n")
+        lines.append("\r\n")
+        return "".join(lines).encode("latin-1", errors="replace")
+
+    async def send_body(self, code, headers, body):
+        headers = list(headers) + [("Content-Length", str(len(body)))]
+        await self._write(self._head_bytes(code, headers) + (b"" if self.command == "HEAD" else body))
+
+    async def send_json(self, code, obj, headers=()):
+        body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        await self.send_body(code, [("Content-Type", "application/json"), *headers], body)
+
+    async def send_error_page(self, code, message=""):
+        try:
+            code = HTTPStatus(code)
+            explain = code.description
+            phrase = code.phrase
+        except ValueError:
+            explain = phrase = ""
+        self.keep_alive = False
+        body = (DEFAULT_ERROR_MESSAGE % {
+            "code": int(code),
+            "message": html.escape(message or phrase, quote=False),
+            "explain": html.escape(explain, quote=False),
+        }).encode("UTF-8", "replace")
+        try:
+            await self.send_body(code, [("Content-Type", DEFAULT_ERROR_CONTENT_TYPE)], body)
+        except (ConnectionError, OSError):
+            pass
+
+    async def start_chunked(self, code, headers):
+        """发送流式响应头：HTTP/1.1 客户端用 chunked，HTTP/1.0 客户端改为读到连接关闭。"""
+        self.chunked = self.request_version == "HTTP/1.1"
+        headers = list(headers)
+        if self.chunked:
+            headers.append(("Transfer-Encoding", "chunked"))
+        else:
+            self.keep_alive = False
+        await self._write(self._head_bytes(code, headers))
+
+    def _chunk_bytes(self, data):
+        if self.chunked:
+            return b"%x\r\n%s\r\n" % (len(data), data)
+        return data
+
+    async def start_fixed(self, code, headers, length):
+        """发送定长响应头；响应体随后经 write_chunk 原样写出（不分块）。"""
+        self.chunked = False
+        await self._write(self._head_bytes(code, list(headers) + [("Content-Length", length)]))
+
+    async def write_chunk(self, data):
+        await self._write(self._chunk_bytes(data))
+
+    async def end_chunked(self):
+        if self.chunked:
+            await self._write(b"0\r\n\r\n")
+
+    async def handle_stream_endpoint(self):
+        """/api/stream：订阅 monitor_hub；hub 线程经 call_soon_threadsafe 唤醒本连接。"""
+        wakeup = asyncio.Event()
+        sub = await _offload(monitor_hub.subscribe, functools.partial(self.loop.call_soon_threadsafe, wakeup.set))
+        self.keep_alive = False
+        try:
+            await self._send_stream_headers()
+            while True:
+                try:
+                    await asyncio.wait_for(wakeup.wait(), QUEUE_KEEPALIVE_SEC)
+                except asyncio.TimeoutError:
+                    pass
+                wakeup.clear()
+                await self.write_chunk(sub.drain() or b": keepalive\n\n")
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            monitor_hub.unsubscribe(sub)
+
+    async def _send_stream_headers(self):
+        await self.start_chunked(200, [
+            ("Content-Type", "text/event-stream"),
+            ("Cache-Control", "no-cache"),
+        ])
+
+    async def _write_stream_error(self, message):
+        """在已开始的 SSE 响应中写入错误事件并结束 chunked 流。"""
+        err = {"error": {"message": message, "type": "server_error"}}
+        try:
+            await self.write_chunk(f"data: {json.dumps(err, ensure_ascii=False)}\n\ndata: [DONE]\n\n".encode())
+            await self.end_chunked()
+        except (ConnectionError, OSError):
+            pass
+
+    # ── 静态文件 ──
+
+    async def serve_static(self):
+        rel = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        full = os.path.normpath(os.path.join(STATIC_DIR, rel.lstrip("/")))
+        if full != STATIC_DIR and not full.startswith(STATIC_DIR + os.sep):
+            await self.send_error_page(HTTPStatus.NOT_FOUND, "File not found")
+            return
+        if os.path.isdir(full):
+            full = os.path.join(full, "index.html")
+        try:
+            with open(full, "rb") as f:
+                body = f.read()
+            mtime = os.path.getmtime(full)
+        except OSError:
+            await self.send_error_page(HTTPStatus.NOT_FOUND, "File not found")
+            return
+        ctype = mimetypes.guess_type(full)[0] or "application/octet-stream"
+        sys.stderr.write(
+            f"{self.client_address[0]} - - [{time.strftime('%d/%b/%Y %H:%M:%S')}] "
+            f"\"{self.command} {self.path} {self.request_version}\" 200 -\n"
+        )
+        await self.send_body(200, [
+            ("Content-Type", ctype),
+            ("Last-Modified", email.utils.formatdate(mtime, usegmt=True)),
+            ("Cache-Control", "no-cache"),
+        ], body)
+
+    # ── 请求流程（_ProxyFlows）的 I/O 步骤 ──
+
+    async def _drive(self, flow):
+        """Run a _ProxyFlows generator, awaiting each I/O step it yields on the event loop."""
+        result = error = None
+        while True:
+            try:
+                step = flow.send(result) if error is None else flow.throw(error)
+            except StopIteration:
+                return
+            result = error = None
+            try:
+                result = await getattr(self, step[0])(*step[1:])
+            except Exception as e:
+                if isinstance(e, OSError):
+                    self.keep_alive = False
+                error = e
+            except BaseException:
+                flow.close()
+                raise
+
+    async def _call(self, fn, *args):
+        return await _offload(fn, *args)
+
+    async def _read_all(self, upload):
+        self.body = await upload.aread_all()
+        return self.body
+
+    async def _keepalive(self):
+        await self.write_chunk(b": keepalive\n\n")
+
+    async def _queue_wait(self, gate, est_kv, deadline, lane, timeout=None, keepalive=False):
+        return await _wait_gate(gate, est_kv, deadline, lane, timeout,
+                                on_tick=self._keepalive if keepalive else None)
+
+    async def _flight_wait(self, flight, timeout=None, keepalive=False):
+        return await _wait_flight(flight, on_tick=self._keepalive if keepalive else None, timeout=timeout)
+
+    # ── 转发与保活 ──
+
+    async def _forward_request(self, url, method, body, timeout, capture_response=False, tap=None, trace=None):
+        """Forward request and relay full response; returns a ResponseCapture when requested.
+        A backend Content-Length is kept, other responses are re-chunked."""
+        out = ResponseCapture() if capture_response else None
+        headers = _backend_headers(self.headers, method, body)
+        try:
+            pool, conn, status, resp_headers, lower = await _async_backend_request(
+                url, method, body, headers, timeout, trace
+            )
+        except BackendError as e:
+            if tap is not None:
+                tap.status = 504 if e.timed_out else 502
+            try:
+                if e.timed_out:
+                    await self.send_body(
+                        504, [("Content-Type", "application/json")],
+                        '{"error":"推理中，监控接口被阻塞，请稍后刷新"}'.encode("utf-8"),
+                    )
+                else:
+                    await self.send_error_page(502, str(e))
+            except (ConnectionError, OSError):
+                pass
+            return None
+
+        watchdog = _StreamWatchdog(self.loop, timeout, timeout, None, conn.close)
+        watchdog.start()
+        try:
+            if status >= 400:
+                if tap is not None:
+                    tap.status = status
+                parts = []
+                async for chunk in _iter_backend_body(conn, lower, method):
+                    watchdog.touch()
+                    parts.append(chunk)
+                pool.put(conn)
+                err_body = b"".join(parts)
+                await self.send_body(status, [("Content-Type", "application/json")], err_body)
+                if out is not None:
+                    out.feed(err_body)
+                return out
+            relay_headers = [
+                (k, v) for k, v in resp_headers
+                if k.lower() not in ("transfer-encoding", "content-length", "connection", "keep-alive")
+            ] + (trace.headers() if trace is not None else [])
+            if "content-length" in lower and "chunked" not in lower.get("transfer-encoding", "").lower():
+                await self.start_fixed(status, relay_headers, lower["content-length"])
+            else:
+                await self.start_chunked(status, relay_headers)
+            async for chunk in _iter_backend_body(conn, lower, method):
+                watchdog.touch()
+                await self.write_chunk(chunk)
+                if out is not None:
+                    out.feed(chunk)
+                if tap is not None:
+                    tap.feed(chunk)
+            if trace is not None:
+                trace.mark("last_byte")
+            pool.put(conn)
+            await self.end_chunked()
+            return out
+        except (ConnectionError, OSError, asyncio.IncompleteReadError,
+                http.client.HTTPException, ValueError):
+            # 客户端断开或后端中途失败：响应已部分写出，只能关闭两端连接
+            conn.close()
+            self.keep_alive = False
+            return None
+        finally:
+            watchdog.stop()
+
+    async def _forward_with_keepalive(self, url, method, body, capture_response=False, tap=None, lease=None,
+                                trace=None):
+        """Relay an SSE stream; stream headers must already be sent.
+
+        While the backend is still processing the prompt a loop timer writes
+        ``: keepalive`` comments — no reader thread is needed.  lease (KvLease)
+        grows with the streamed tokens and is released when the stream ends.
+        With a RequestTrace the stream ends with a ``: server-timing`` comment.
+        """
+        out = ResponseCapture() if capture_response else None
+        headers = _backend_headers(self.headers, method, body)
+        loop = self.loop
+        client_gone = False
+
+        def keepalive():
+            if not self.writer.is_closing():
+                self.writer.write(self._chunk_bytes(b": keepalive\n\n"))
+
+        async def fail(message_obj, status=502):
+            if tap is not None:
+                tap.status = status
+            chunk_data = f"data: {json.dumps(message_obj)}\n\ndata: [DONE]\n\n".encode()
+            await self.write_chunk(chunk_data)
+            if out is not None:
+                out.feed(chunk_data)
+
+        conn = None
+        watchdog = _StreamWatchdog(loop, QUEUE_KEEPALIVE_SEC, API_PROXY_TIMEOUT, keepalive,
+                                   lambda: conn.close() if conn else None)
+        watchdog.start()
+        try:
+            try:
+                pool, conn, status, _, lower = await _async_backend_request(
+                    url, method, body, headers, API_PROXY_TIMEOUT, trace
                 )
-            if name != alias:
-                data.append(
-                    {
-                        "id": name,
-                        "object": "model",
-                        "created": created,
-                        "owned_by": "local",
+            except BackendError as e:
+                await fail({"error": {"message": str(e), "type": "server_error"}})
+                return out
+
+            if status >= 400:
+                parts = []
+                async for chunk in _iter_backend_body(conn, lower, method):
+                    parts.append(chunk)
+                pool.put(conn)
+                try:
+                    err_json = json.loads(b"".join(parts).decode("utf-8", errors="replace"))
+                except (json.JSONDecodeError, ValueError):
+                    err_json = {
+                        "error": {
+                            "message": f"Backend error {status}",
+                            "type": "server_error",
+                        }
                     }
-                )
-        result = {"object": "list", "data": data}
-        body = json.dumps(result, ensure_ascii=False).encode("utf-8")
-        self.send_response(200)
-        self.send_header("Content-Type", "application/json")
-        self.send_header("Content-Length", str(len(body)))
-        self.end_headers()
-        self.wfile.write(body)
+                await fail(err_json, status)
+                return out
 
-    def handle_system_endpoint(self):
-        """返回系统资源信息（CPU/内存/进程）"""
-        data = get_system_info()
-        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
-        self.send_response(200)
-        self.send_header("Content-Type", "application/json")
-        self.send_header("Content-Length", str(len(body)))
-        self.end_headers()
-        self.wfile.write(body)
+            body_iter = _iter_backend_body(conn, lower, method)
+            while True:
+                try:
+                    chunk = await body_iter.__anext__()
+                except StopAsyncIteration:
+                    pool.put(conn)
+                    break
+                except (OSError, asyncio.IncompleteReadError, http.client.HTTPException, ValueError) as e:
+                    conn.close()
+                    await fail({"error": {"message": str(e) or "backend stream aborted", "type": "server_error"}})
+                    break
+                watchdog.touch()
+                self.writer.write(self._chunk_bytes(chunk))
+                if out is not None:
+                    out.feed(chunk)
+                if tap is not None:
+                    tap.feed(chunk)
+                if lease is not None:
+                    lease.feed(chunk)
+                await self.writer.drain()
+        except (ConnectionError, OSError):
+            client_gone = True
+            _log("[infer] 客户端断开")
+            if conn is not None:
+                # 未读完的响应不能复用；关闭连接也让后端尽快停止生成
+                conn.close()
+        finally:
+            watchdog.stop()
+            if lease is not None:
+                lease.release()
+            if not client_gone:
+                try:
+                    if trace is not None:
+                        trace.finish(tap)
+                        await self.write_chunk(trace.sse_comment())
+                    await self.end_chunked()
+                except (ConnectionError, OSError):
+                    pass
+        return out
 
-    def handle_models_endpoint(self):
-        """返回运行中的模型列表，包含队列与 KV 预算状态，以及 Ollama 聚合信息"""
-        models = get_running_models()
-        result = []
-        for name, info in models.items():
-            gate = _inference_gates.get(name)
-            entry = {
-                "name": name,
-                "model": info.get("model", name),
-                "port": info["port"],
-                "pid": info.get("pid"),
-                "external": bool(info.get("external")),
-                "ollama": bool(info.get("ollama")),
-                "ollama_model": info.get("ollama_model"),
-                "queue": gate.queue_depth if gate else 0,
-            }
-            if gate:
-                entry["budget"] = gate.budget_snapshot()
-            result.append(entry)
-        g_snap = get_global_gate().snapshot()
-        ollama = get_ollama_status()
-        payload = {
-            "models": result,
-            "ollama": ollama,
-            "global": g_snap,
-        }
-        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
-        self.send_response(200)
-        self.send_header("Content-Type", "application/json")
-        self.send_header("Content-Length", str(len(body)))
-        self.end_headers()
-        self.wfile.write(body)
 
-    def log_message(self, format, *args):
-        if not self.path.startswith(("/api/", "/v1/")):
-            super().log_message(format, *args)
+_BODY_TOO_LARGE = object()  # AsyncProxyConnection._read_request_body：chunked 请求体超出上限
+
+
+async def _handle_async_client(reader, writer):
+    await AsyncProxyConnection(reader, writer).run()
+
+
+def _raise_nofile_limit():
+    """asyncio 模式下单进程要承载数千连接，尽量把 RLIMIT_NOFILE 软限制提到硬限制。"""
+    try:
+        import resource
+    except ImportError:
+        return
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        target = hard if hard != resource.RLIM_INFINITY else 65536
+        if soft < target:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+    except (ValueError, OSError):
+        pass
+
+
+def _listen_socket(port):
+    # 与 threading 模式相同：优先绑定 :: 并关闭 IPV6_V6ONLY，同时接受 IPv4 / IPv6
+    try:
+        sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        sock.bind(("::", port))
+    except OSError:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(("", port))
+    sock.listen(1024)
+    sock.setblocking(False)
+    return sock
+
+
+def serve_asyncio(port):
+    _raise_nofile_limit()
+
+    async def run():
+        server = await asyncio.start_server(
+            _handle_async_client, sock=_listen_socket(port), limit=MAX_HEADER_BYTES,
+        )
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        sys.exit(0)
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Local LLM Deploy 前端 + API 代理")
+    parser.add_argument(
+        "--engine", choices=("threading", "asyncio"), default=SERVE_UI_ENGINE,
+        help="threading: 每连接一个线程（默认）；asyncio: 单事件循环，客户端 HTTP/1.1 keep-alive",
+    )
+    args = parser.parse_args()
     port = int(os.environ.get("UI_PORT", "8888"))
     api_key = load_api_key()
+    # 启动前同步探测一次 Ollama（并发请求，最多一次超时），使首个路由表与启动信息包含 Ollama 模型
+    ollama_status.refresh()
+    ollama_status.start()
+    route_registry.start()
+    backend_poller.start()
+    system_sampler.start()
+    kv_calibrator.start()
+    atexit.register(kv_calibrator.save)
+    atexit.register(access_log.close)
+    atexit.register(trace_writer.close)
+    # serve-ui.sh stop / launchd 发送 SIGTERM：转为正常退出，让 atexit 保存校准数据
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     models = get_running_models()
 
     print(f"前端服务: http://localhost:{port}/")
@@ -1535,19 +6085,28 @@ def main():
     print()
     print(f"OpenAI 兼容: http://localhost:{port}/v1  (通过 model 字段自动路由)")
     print(f"推理队列: 最大排队 {MAX_QUEUE_DEPTH}，保活间隔 {QUEUE_KEEPALIVE_SEC}s")
-    print(f"全局并发上限: {MAX_GLOBAL_CONCURRENT}，KV 粗算系数: {KV_CHARS_PER_TOKEN} chars/tok")
+    print(f"全局并发上限: {MAX_GLOBAL_CONCURRENT}，KV 粗算系数: {KV_CHARS_PER_TOKEN} chars/tok（按模型在线校准）")
     if models:
         for name in models:
             g = get_inference_gate(name)
             print(f"  {name}: max_slots={g.max_slots}, budget={g.total_budget} tok")
     if api_key:
-        print("认证: 已从 .api-key 加载")
+        lane_keys = load_api_key_lanes()
+        if lane_keys:
+            print(f"认证: 已从 .api-key 加载，另有 .api-key-lanes 中 {len(lane_keys)} 个 key 可通过认证")
+        else:
+            print("认证: 已从 .api-key 加载")
     else:
         print("认证: 未启用（无 .api-key）")
     if ACCESS_LOG_FILE:
         print(f"Access log: {ACCESS_LOG_FILE}")
+    print(f"服务模式: {args.engine}")
     print()
 
+    if args.engine == "asyncio":
+        serve_asyncio(port)
+        return
+
     class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
         daemon_threads = True
         allow_reuse_address = True
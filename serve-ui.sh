@@ -4,6 +4,7 @@
 #
 # 默认通过 launchd 用户守护进程运行（无 Terminal 窗口，不依赖 Cursor 会话）。
 # 需要 access 日志时先 export SERVE_UI_ACCESS_LOG=... SERVE_UI_LOG_BODY=1 再执行 start。
+# 切换到 asyncio 服务模式：export SERVE_UI_ENGINE=asyncio 再执行 start。
 
 SCRIPT_DIR="$(cd "$(dirname "$0")" && pwd)"
 cd "$SCRIPT_DIR" || exit 1
@@ -60,12 +61,15 @@ write_plist() {
     mkdir -p "$HOME/Library/LaunchAgents"
 
     python3 - "$PLIST" "$python_bin_path" "$SCRIPT_DIR" "$LOG_FILE" "$UI_PORT" \
-        "$SERVE_UI_ACCESS_LOG" "$SERVE_UI_LOG_BODY" "$API_PROXY_TIMEOUT" "$OLLAMA_HOST" <<'PY'
+        "$SERVE_UI_ACCESS_LOG" "$SERVE_UI_LOG_BODY" "$API_PROXY_TIMEOUT" "$OLLAMA_HOST" \
+        "$SERVE_UI_ENGINE" <<'PY'
+import os
 import plistlib
 import sys
 from pathlib import Path
 
-plist_path, python_bin, script_dir, log_file, ui_port, access_log, log_body, proxy_timeout, ollama_host = sys.argv[1:10]
+(plist_path, python_bin, script_dir, log_file, ui_port, access_log, log_body, proxy_timeout,
+ ollama_host, engine) = sys.argv[1:11]
 
 env = {}
 if ui_port:
@@ -78,6 +82,13 @@ if proxy_timeout:
     env["API_PROXY_TIMEOUT"] = proxy_timeout
 if ollama_host:
     env["OLLAMA_HOST"] = ollama_host
+if engine:
+    env["SERVE_UI_ENGINE"] = engine
+# access 日志的队列、轮转等设置（SERVE_UI_ACCESS_LOG_QUEUE / _POLICY / _MAX_MB / _ROTATE_SEC / _KEEP）
+# 与请求阶段 trace（SERVE_UI_TRACE_FILE / SERVE_UI_TRACE_SAMPLE）
+for key, value in os.environ.items():
+    if key.startswith(("SERVE_UI_ACCESS_LOG_", "SERVE_UI_TRACE_")) and value:
+        env[key] = value
 
 data = {
     "Label": "com.local-llm-deploy.serve-ui",
@@ -247,6 +258,9 @@ case "${1:-start}" in
         echo "  export SERVE_UI_LOG_BODY=1"
         echo "  export SERVE_UI_ACCESS_LOG=\"$SCRIPT_DIR/serve-ui-access.jsonl\""
         echo "  $0 start"
+        echo ""
+        echo "asyncio 服务模式（单事件循环，适合大量并发/排队的流式连接）:"
+        echo "  SERVE_UI_ENGINE=asyncio $0 start"
         ;;
     *)
         echo "未知子命令: $1"